@@ -0,0 +1,563 @@
+#!/usr/bin/env python3
+# Copyright (C) 2014 Peter Todd <pete@petertodd.org>
+#
+# This file is part of python-merbinnertree.
+#
+# It is subject to the license terms in the LICENSE file found in the top-level
+# directory of this distribution.
+#
+# No part of python-merbinnertree, including this file, may be copied,
+# modified, propagated, or distributed except according to the terms contained
+# in the LICENSE file.
+
+"""Benchmarks
+
+Run with the name of a benchmark, e.g. ./bench.py hash -n 1000000
+"""
+
+import argparse
+import os
+import random
+import tempfile
+import time
+import tracemalloc
+
+from merbinnertree import (SHA256MerbinnerTree, LegacySHA256MerbinnerTree,
+                           BLAKE2bMerbinnerTree, BLAKE2sMerbinnerTree, make_MerbinnerTree_class)
+from merbinnertree.intern import InternTable
+from merbinnertree.proofcache import ProofCache
+from merbinnertree.snapshot import Snapshot
+from merbinnertree.store import NodeStore, LRUNodeCache, ClockNodeCache
+from merbinnertree.verify import verify_proof, verify_proofs, VerificationError
+
+def random_items(n, seed=0):
+    rng = random.Random(seed)
+    return [(rng.getrandbits(256).to_bytes(32, 'big'), rng.getrandbits(256).to_bytes(32, 'big'))
+            for i in range(n)]
+
+@make_MerbinnerTree_class
+class SumTree(SHA256MerbinnerTree):
+    """Sum tree where each value adds its first byte"""
+    __slots__ = []
+    SUMSIZE = 8
+
+    @staticmethod
+    def calc_value_sum(value):
+        return value[0]
+
+@make_MerbinnerTree_class
+class InternedTree(SHA256MerbinnerTree):
+    """Tree whose nodes can be interned"""
+    __slots__ = []
+    WEAKREFS = True
+
+def report(name, elapsed, peak_bytes=None):
+    if peak_bytes is None:
+        print('%-40s %10.3fs' % (name, elapsed))
+    else:
+        print('%-40s %10.3fs %10.1f MiB' % (name, elapsed, peak_bytes / 2**20))
+
+def bench_hash(args):
+    """Time and memory for .hash on a freshly built tree"""
+    items = sorted(random_items(args.n), reverse=True)
+    for treecls in (LegacySHA256MerbinnerTree, SHA256MerbinnerTree):
+        tree = treecls.from_sorted_items(items)
+
+        tracemalloc.start()
+        start = time.perf_counter()
+        tree.hash
+        elapsed = time.perf_counter() - start
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        report('%s .hash, n=%d' % (treecls.__name__, args.n), elapsed, peak)
+        del tree
+
+def bench_compute_hashes(args):
+    """Recursive .hash compared to compute_hashes() on a freshly built tree"""
+    items = sorted(random_items(args.n), reverse=True)
+
+    tree = SHA256MerbinnerTree.from_sorted_items(items)
+    start = time.perf_counter()
+    tree.hash
+    report('.hash, n=%d' % args.n, time.perf_counter() - start)
+
+    for max_workers in (None, 4):
+        tree = SHA256MerbinnerTree.from_sorted_items(items)
+        start = time.perf_counter()
+        tree.compute_hashes(max_workers=max_workers)
+        report('compute_hashes(max_workers=%r), n=%d' % (max_workers, args.n),
+               time.perf_counter() - start)
+
+def bench_build(args):
+    """Building and hashing a tree in one process and in parallel"""
+    items = random_items(args.n)
+
+    start = time.perf_counter()
+    SHA256MerbinnerTree(items).compute_hashes()
+    report('constructor, n=%d' % args.n, time.perf_counter() - start)
+
+    for hash_only in (False, True):
+        start = time.perf_counter()
+        SHA256MerbinnerTree.from_items_parallel(items, hash_only=hash_only)
+        report('from_items_parallel(hash_only=%r), n=%d' % (hash_only, args.n),
+               time.perf_counter() - start)
+
+def bench_serialize(args):
+    """Encoding and decoding single-key proofs"""
+    items = random_items(args.n)
+    tree = SHA256MerbinnerTree(items)
+    tree.compute_hashes()
+    proofs = [tree.prove_contains([key]) for key, value in items[0:10000]]
+
+    start = time.perf_counter()
+    encoded = [proof.serialize() for proof in proofs]
+    elapsed = time.perf_counter() - start
+    report('serialize %d proofs, n=%d' % (len(proofs), args.n), elapsed)
+    print('%.1f bytes/proof' % (sum(len(buf) for buf in encoded) / len(encoded)))
+
+    start = time.perf_counter()
+    for buf in encoded:
+        SHA256MerbinnerTree.deserialize(buf)
+    report('deserialize %d proofs, n=%d' % (len(proofs), args.n), time.perf_counter() - start)
+
+def bench_verify(args):
+    """Verifying single-key proofs, compared to deserializing and hashing them"""
+    items = random_items(args.n)
+    tree = SHA256MerbinnerTree(items)
+    batch = [(tree.prove_contains([key]).serialize(), tree.hash, [key]) for key, value in items[0:10000]]
+
+    start = time.perf_counter()
+    for proof, root_hash, keys in batch:
+        pruned_tree = SHA256MerbinnerTree.deserialize(proof)
+        assert pruned_tree.hash == root_hash
+        keys[0] in pruned_tree
+    elapsed = time.perf_counter() - start
+    report('deserialize and hash %d proofs, n=%d' % (len(batch), args.n), elapsed)
+    print('%.0f proofs/s' % (len(batch) / elapsed))
+
+    start = time.perf_counter()
+    verify_proofs(SHA256MerbinnerTree, batch)
+    elapsed = time.perf_counter() - start
+    report('verify_proofs %d proofs, n=%d' % (len(batch), args.n), elapsed)
+    print('%.0f proofs/s' % (len(batch) / elapsed))
+
+def bench_adversarial(args):
+    """Rejecting hostile proofs, with and without limits
+
+    -n is the size of each hostile proof in bytes.
+    """
+    treecls = SHA256MerbinnerTree
+    pruned = b'\x02' + b'\x00' * 32
+
+    # A complete tree of pruned nodes of about n bytes, which is valid right
+    # up until its root hash doesn't match.
+    balanced = pruned
+    while len(balanced) * 2 < args.n:
+        balanced = b'\x01' + balanced * 2
+    balanced = b'\x01' + balanced
+
+    hostile = [
+        # As deep as possible: a chain of inner nodes with pruned siblings.
+        ('deep chain', b'\x01' + b'\x01' * 256 + pruned * 257, {'max_depth': 64}),
+        ('many nodes', balanced, {'max_nodes': 1000}),
+        ('many bytes', balanced, {'max_bytes': 10000}),
+        # An endless varint
+        ('long varint', b'\x01\x03' + b'\x00' * 32 + b'\xff' * args.n, {}),
+        # A value longer than the proof
+        ('long value', b'\x01\x03' + b'\x00' * 32 + b'\xff\xff\xff\x7f' + b'\x00' * args.n, {}),
+    ]
+    root_hash = b'\x00' * 32
+
+    for name, buf, limits in hostile:
+        print('%s, %d bytes:' % (name, len(buf)))
+        for use_limits in (False, True):
+            if use_limits and not limits:
+                continue
+            kwargs = limits if use_limits else {}
+
+            start = time.perf_counter()
+            try:
+                treecls.deserialize(buf, **kwargs)
+            except treecls.DeserializationError:
+                pass
+            report('  deserialize %r' % kwargs, time.perf_counter() - start)
+
+            start = time.perf_counter()
+            try:
+                verify_proof(treecls, buf, root_hash, [], **kwargs)
+            except VerificationError:
+                pass
+            report('  verify_proof %r' % kwargs, time.perf_counter() - start)
+
+def bench_diff(args):
+    """diff() of a tree with a few changes, compared to diffing items()"""
+    items = random_items(args.n)
+    old = SHA256MerbinnerTree(items)
+    new = old.put_many([(key, b'changed') for key, value in items[0:3]])
+
+    start = time.perf_counter()
+    old_items = dict(old.items())
+    new_items = dict(new.items())
+    changed = [key for key in old_items.keys() | new_items.keys() if old_items.get(key) != new_items.get(key)]
+    report('diff items(), n=%d' % args.n, time.perf_counter() - start)
+
+    start = time.perf_counter()
+    assert len(list(old.diff(new))) == len(changed)
+    report('diff(), n=%d' % args.n, time.perf_counter() - start)
+
+def bench_merge(args):
+    """Merging many single-key proofs, pairwise and with merge_all()"""
+    items = random_items(args.n)
+    tree = SHA256MerbinnerTree(items)
+    proofs = [tree.prove_contains([key]) for key, value in items[0:1000]]
+
+    start = time.perf_counter()
+    merged = proofs[0]
+    for proof in proofs[1:]:
+        merged = merged.merge(proof)
+    report('merge() %d proofs, n=%d' % (len(proofs), args.n), time.perf_counter() - start)
+
+    start = time.perf_counter()
+    SHA256MerbinnerTree.merge_all(proofs)
+    report('merge_all() %d proofs, n=%d' % (len(proofs), args.n), time.perf_counter() - start)
+
+def bench_witness(args):
+    """Proving batches of changes, and applying them with just the witness"""
+    items = random_items(args.n)
+    tree = SHA256MerbinnerTree(items)
+    tree.compute_hashes()
+    batches = [[(key, b'changed') for key, value in items[i:i+10]] for i in range(0, 10000, 10)]
+
+    start = time.perf_counter()
+    witnesses = [tree.prove_put_many(changes) for changes in batches]
+    report('prove_put_many %d batches, n=%d' % (len(batches), args.n), time.perf_counter() - start)
+    print('%.1f bytes/witness' % (sum(len(witness.serialize()) for witness in witnesses) / len(witnesses)))
+
+    start = time.perf_counter()
+    for witness, changes in zip(witnesses, batches):
+        SHA256MerbinnerTree.apply_with_witness(witness, changes, tree.hash).hash
+    report('apply_with_witness %d batches, n=%d' % (len(batches), args.n), time.perf_counter() - start)
+
+def bench_proofcache(args):
+    """Serving proofs of hot keys, with and without a ProofCache"""
+    items = random_items(args.n)
+    tree = SHA256MerbinnerTree(items)
+    tree.compute_hashes()
+    rng = random.Random(0)
+    hot_keys = [key for key, value in items[0:100]]
+    requests = [[rng.choice(hot_keys)] for i in range(20000)]
+
+    start = time.perf_counter()
+    for keys in requests:
+        tree.prove_contains(keys).serialize()
+    report('prove_contains, n=%d' % args.n, time.perf_counter() - start)
+
+    cache = ProofCache(max_entries=1000)
+    start = time.perf_counter()
+    for keys in requests:
+        cache.prove_contains_serialized(tree, keys)
+    report('ProofCache, n=%d' % args.n, time.perf_counter() - start)
+    print('hit rate %.3f, %d bytes saved' % (cache.hit_rate, cache.bytes_saved))
+
+    # The root moves, changing keys that aren't hot
+    tree = tree.put_many([(key, b'changed') for key, value in items[-10:]])
+    tree.compute_hashes()
+    start = time.perf_counter()
+    for keys in requests:
+        cache.prove_contains_serialized(tree, keys)
+    report('ProofCache after root change, n=%d' % args.n, time.perf_counter() - start)
+    print('%d proofs rebuilt reusing the old ones' % cache.reuses)
+
+def bench_iter_proofs(args):
+    """Proofs for every key, one prove_contains() at a time and with iter_proofs()"""
+    items = random_items(args.n)
+    tree = SHA256MerbinnerTree(items)
+    tree.compute_hashes()
+    keys = sorted((key for key, value in items), reverse=True)
+
+    start = time.perf_counter()
+    for key in keys:
+        tree.prove_contains([key]).serialize()
+    report('prove_contains, n=%d' % args.n, time.perf_counter() - start)
+
+    for group_size in (1, 16):
+        start = time.perf_counter()
+        for group, proof in tree.iter_proofs(keys, group_size):
+            pass
+        report('iter_proofs(group_size=%d), n=%d' % (group_size, args.n), time.perf_counter() - start)
+
+def bench_iterate(args):
+    """Iterating through all items, and a range of 1% of them"""
+    items = random_items(args.n)
+    tree = SHA256MerbinnerTree(items)
+    keys = sorted(key for key, value in items)
+
+    start = time.perf_counter()
+    for item in tree.items():
+        pass
+    report('items(), n=%d' % args.n, time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for i in range(0, args.n, args.n // 100):
+        for item in tree.range(keys[i], keys[min(i + args.n // 100, args.n - 1)]):
+            pass
+    report('range() over 1%% at a time, n=%d' % args.n, time.perf_counter() - start)
+
+def bench_counts(args):
+    """len(), and random sampling with select()"""
+    tree = SHA256MerbinnerTree(random_items(args.n))
+
+    start = time.perf_counter()
+    len(tree)
+    report('first len(), n=%d' % args.n, time.perf_counter() - start)
+
+    start = time.perf_counter()
+    len(tree)
+    report('second len(), n=%d' % args.n, time.perf_counter() - start)
+
+    start = time.perf_counter()
+    tree.sample(1000)
+    report('sample(1000), n=%d' % args.n, time.perf_counter() - start)
+
+def bench_sums(args):
+    """range_sum() and prove_range_sum() on a sum tree"""
+    items = random_items(args.n)
+    keys = sorted(key for key, value in items)
+    rng = random.Random(1)
+    ranges = [sorted(rng.sample(keys, 2)) for i in range(10000)]
+
+    start = time.perf_counter()
+    tree = SumTree(items)
+    tree.compute_hashes()
+    report('build and hash, n=%d' % args.n, time.perf_counter() - start)
+
+    start = time.perf_counter()
+    tree.sum()
+    report('sum(), n=%d' % args.n, time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for lo, hi in ranges:
+        tree.range_sum(lo, hi)
+    report('%d range_sum(), n=%d' % (len(ranges), args.n), time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for lo, hi in ranges[0:20]:
+        sum(value[0] for key, value in tree.range(lo, hi))
+    report('20 sums over range(), n=%d' % args.n, time.perf_counter() - start)
+
+    start = time.perf_counter()
+    size = 0
+    for lo, hi in ranges:
+        size += len(tree.prove_range_sum(lo, hi)[1].serialize())
+    report('%d prove_range_sum(), n=%d' % (len(ranges), args.n), time.perf_counter() - start)
+    print('average proof size %.0f bytes' % (size / len(ranges)))
+
+def bench_backends(args):
+    """Build, update and proof workloads with each hash backend"""
+    items = random_items(args.n)
+    changes = random_items(100 * 100, seed=1)
+    proof_keys = [key for key, value in random.Random(2).sample(items, min(args.n, 10000))]
+
+    for name, treecls in (('sha256', SHA256MerbinnerTree),
+                          ('blake2b', BLAKE2bMerbinnerTree),
+                          ('blake2s', BLAKE2sMerbinnerTree)):
+        start = time.perf_counter()
+        tree = treecls(items)
+        tree.compute_hashes()
+        report('%s build, n=%d' % (name, args.n), time.perf_counter() - start)
+
+        start = time.perf_counter()
+        new_tree = tree
+        for i in range(0, len(changes), 100):
+            new_tree = new_tree.put_many(changes[i:i+100])
+            new_tree.compute_hashes()
+        report('%s 100 x put_many(100), n=%d' % (name, args.n), time.perf_counter() - start)
+
+        # Fresh tree so that no proof reuses hashes cached by another
+        tree = treecls(items)
+        start = time.perf_counter()
+        for key in proof_keys:
+            tree.prove_contains([key]).serialize()
+        report('%s %d proofs, n=%d' % (name, len(proof_keys), args.n), time.perf_counter() - start)
+        del tree, new_tree
+
+def bench_snapshot(args):
+    """Memory use and lookups of a Snapshot compared to the tree"""
+    # The items are made while tracing, as the tree holds onto their keys
+    # and values and the snapshot copies them.
+    tracemalloc.start()
+    items = random_items(args.n)
+    tree = SHA256MerbinnerTree(items)
+    tree.compute_hashes()
+    del items
+    tree_bytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    lookups = [key for key, value in random.Random(1).sample(list(tree.items()), min(20000, args.n))]
+
+    start = time.perf_counter()
+    tracemalloc.start()
+    snapshot = Snapshot.from_tree(tree)
+    snapshot_bytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    report('Snapshot.from_tree(), n=%d' % args.n, time.perf_counter() - start)
+    print('tree %.1f MiB, snapshot %.1f MiB (%.1fx smaller)' %
+          (tree_bytes / 2**20, snapshot_bytes / 2**20, tree_bytes / snapshot_bytes))
+
+    for name, obj in (('tree', tree), ('snapshot', snapshot)):
+        start = time.perf_counter()
+        for key in lookups:
+            obj[key]
+        report('%s %d lookups, n=%d' % (name, len(lookups), args.n), time.perf_counter() - start)
+
+        start = time.perf_counter()
+        for key in lookups[0:5000]:
+            obj.prove_contains([key])
+        report('%s 5000 proofs, n=%d' % (name, args.n), time.perf_counter() - start)
+
+    start = time.perf_counter()
+    snapshot.to_tree()
+    report('to_tree(), n=%d' % args.n, time.perf_counter() - start)
+
+def bench_arena(args):
+    """deserialize() with and without arena=True"""
+    buf = SHA256MerbinnerTree(random_items(args.n)).serialize()
+    lookups = [key for key, value in random.Random(1).sample(random_items(args.n), min(20000, args.n))]
+
+    for arena in (False, True):
+        tracemalloc.start()
+        tree = SHA256MerbinnerTree.deserialize(buf, arena=arena)
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        del tree
+
+        start = time.perf_counter()
+        tree = SHA256MerbinnerTree.deserialize(buf, arena=arena)
+        report('deserialize(arena=%r), n=%d' % (arena, args.n), time.perf_counter() - start, current)
+
+        start = time.perf_counter()
+        tree.compute_hashes()
+        report('compute_hashes(), n=%d' % args.n, time.perf_counter() - start)
+
+        start = time.perf_counter()
+        for key in lookups:
+            tree[key]
+        report('%d lookups, n=%d' % (len(lookups), args.n), time.perf_counter() - start)
+
+        start = time.perf_counter()
+        for key, value in tree.items():
+            pass
+        report('items(), n=%d' % args.n, time.perf_counter() - start)
+        del tree
+
+def bench_intern(args):
+    """Ten overlapping snapshots built separately, with and without interning"""
+    items = random_items(args.n)
+    changes = random_items(args.n, seed=1)
+    versions = []
+    for i in range(10):
+        # Each version changes a different 1% of the items
+        version_items = list(items)
+        for j in range(i * args.n // 100, (i + 1) * args.n // 100):
+            version_items[j] = (items[j][0], changes[j][1])
+        versions.append(version_items)
+
+    for intern in (False, True):
+        treecls = InternedTree if intern else SHA256MerbinnerTree
+        tracemalloc.start()
+        table = InternTable() if intern else None
+        trees = [treecls(version_items, intern=table) for version_items in versions]
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        del trees, table
+
+        start = time.perf_counter()
+        table = InternTable() if intern else None
+        trees = [treecls(version_items, intern=table) for version_items in versions]
+        report('10 versions, intern=%r, n=%d' % (intern, args.n), time.perf_counter() - start, current)
+
+        start = time.perf_counter()
+        for tree in trees[1:]:
+            for diff in trees[0].diff(tree):
+                pass
+        report('9 diffs, n=%d' % args.n, time.perf_counter() - start)
+        del trees
+
+def bench_store(args):
+    """Random lookups in a tree loaded from a NodeStore through a cache"""
+    items = random_items(args.n)
+    lookups = [random.choice(items)[0] for i in range(20000)]
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, 'nodes')
+        with NodeStore(SHA256MerbinnerTree, path) as store:
+            root_hash = store.add(SHA256MerbinnerTree(items))
+
+        for cachecls in (LRUNodeCache, ClockNodeCache):
+            for max_nodes in (args.n // 100, args.n // 10):
+                cache = cachecls(max_nodes=max_nodes, pin_levels=8)
+                with NodeStore(SHA256MerbinnerTree, path, cache=cache) as store:
+                    tree = store.get(root_hash)
+                    start = time.perf_counter()
+                    for key in lookups:
+                        tree[key]
+                    elapsed = time.perf_counter() - start
+                report('%s(max_nodes=%d), n=%d' % (cachecls.__name__, max_nodes, args.n), elapsed)
+                print('%.0f lookups/s, hit rate %.3f' % (len(lookups) / elapsed, cache.hit_rate))
+
+def bench_get(args):
+    """Point lookups with __getitem__ and __contains__"""
+    items = random_items(args.n)
+    tree = SHA256MerbinnerTree(items)
+    keys = [key for key, value in items[0:100000]]
+    missing_keys = [key for key, value in random_items(len(keys), seed=1)]
+
+    start = time.perf_counter()
+    for key in keys:
+        tree[key]
+    elapsed = time.perf_counter() - start
+    report('__getitem__, n=%d' % args.n, elapsed)
+    print('%.0f lookups/s' % (len(keys) / elapsed))
+
+    start = time.perf_counter()
+    for key in missing_keys:
+        key in tree
+    elapsed = time.perf_counter() - start
+    report('__contains__ missing keys, n=%d' % args.n, elapsed)
+    print('%.0f lookups/s' % (len(keys) / elapsed))
+
+BENCHMARKS = {
+    'build': bench_build,
+    'hash': bench_hash,
+    'serialize': bench_serialize,
+    'store': bench_store,
+    'compute_hashes': bench_compute_hashes,
+    'get': bench_get,
+    'verify': bench_verify,
+    'adversarial': bench_adversarial,
+    'diff': bench_diff,
+    'merge': bench_merge,
+    'witness': bench_witness,
+    'proofcache': bench_proofcache,
+    'iter_proofs': bench_iter_proofs,
+    'iterate': bench_iterate,
+    'counts': bench_counts,
+    'sums': bench_sums,
+    'backends': bench_backends,
+    'snapshot': bench_snapshot,
+    'arena': bench_arena,
+    'intern': bench_intern,
+}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('benchmark', choices=sorted(BENCHMARKS))
+    parser.add_argument('-n', type=int, default=100000,
+                        help='number of items in the tree (default: %(default)d)')
+    args = parser.parse_args()
+
+    BENCHMARKS[args.benchmark](args)
+
+if __name__ == '__main__':
+    main()
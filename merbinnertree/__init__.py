@@ -9,7 +9,64 @@
 # modified, propagated, or distributed except according to the terms contained
 # in the LICENSE file.
 
+import concurrent.futures
 import hashlib
+import heapq
+import operator
+import os
+import pickle
+import random
+import tempfile
+
+# Versions of the scheme used to calculate node hashes from node hash data.
+#
+# Version 0 used the hash data itself as the node hash, which made the hash of
+# an inner node as big as its whole subtree. It's only kept so that roots
+# stored under it can be checked and migrated.
+HASH_SCHEME_V0 = 0
+
+# Version 1 hashes node hash data with the tree's hash_func(), giving every
+# node a fixed-size hash.
+HASH_SCHEME_V1 = 1
+
+# Version of the binary serialization format; see stream_serialize()
+SERIALIZATION_VERSION = 1
+
+# Node tags in serialized trees
+TAG_EMPTY = 0x00
+TAG_INNER = 0x01
+TAG_PRUNED_INNER = 0x02
+TAG_FULL_LEAF = 0x03
+TAG_PRUNED_LEAF = 0x04
+
+def _varint_encode(n):
+    """Encode a non-negative integer as an unsigned LEB128 varint"""
+    r = bytearray()
+    while n > 0x7f:
+        r.append(n & 0x7f | 0x80)
+        n >>= 7
+    r.append(n)
+    return bytes(r)
+
+def _varint_decode(buf, pos):
+    """Decode a varint from buf at pos
+
+    Returns (n, new_pos). Raises IndexError if buf ends first, and ValueError
+    if the varint isn't minimally encoded or is more than 64 bits.
+    """
+    n = 0
+    shift = 0
+    while True:
+        b = buf[pos]
+        pos += 1
+        n |= (b & 0x7f) << shift
+        if not b & 0x80:
+            if b == 0 and shift:
+                raise ValueError('non-minimal varint')
+            return (n, pos)
+        shift += 7
+        if shift >= 64:
+            raise ValueError('varint too large')
 
 def make_MerbinnerTree_baseclass(basecls=object):
     class MerbinnerTree(basecls):
@@ -18,6 +75,16 @@ def make_MerbinnerTree_baseclass(basecls=object):
 
         _mt_baseclass = None
 
+        # Scheme used to calculate node hashes; see HASH_SCHEME_V1
+        HASH_SCHEME = HASH_SCHEME_V1
+
+        # Size in bytes of the sums committed to by a sum tree, or None if the
+        # tree doesn't keep sums; see calc_value_sum()
+        SUMSIZE = None
+
+        # Whether nodes can be weakly referenced, which an InternTable needs
+        WEAKREFS = False
+
         def __setattr__(self, name, value):
             raise AttributeError('Object is immutable')
 
@@ -25,27 +92,308 @@ def make_MerbinnerTree_baseclass(basecls=object):
             raise AttributeError('Object is immutable')
 
         class PrunedError(Exception):
-            def __init__(msg, key, depth):
-                super(PrunedError, self).__init__(msg)
+            def __init__(self, msg, key, depth):
+                super().__init__(msg)
                 self.key = key
                 self.depth = depth
 
-        def __new__(cls, items=None):
+        class DeserializationError(ValueError):
+            """Serialized tree is invalid"""
+
+        def __new__(cls, items=None, intern=None):
             if items is None:
                 return cls.EmptyNodeClass()
 
             else:
-                leaf_nodes = [cls.FullLeafNodeClass(k, v) for k,v in items]
-                return cls.InnerNodeClass._mt_from_leaf_nodes(leaf_nodes, 0)
+                return cls.from_sorted_items(sorted(items, key=operator.itemgetter(0), reverse=True), intern)
+
+        @classmethod
+        def from_sorted_items(cls, items, intern=None):
+            """Create a tree from items already sorted in tree order
+
+            Tree order is the order keys() returns keys in: descending when
+            keys are compared as byte strings. items may be any iterable of
+            (key, value) pairs; it's consumed in a single pass, and only the
+            nodes along the current root-to-leaf spine are held in memory
+            while the tree is built.
+
+            If intern, an InternTable, is given, the tree is interned with it
+            before being returned; so are the trees from the other
+            constructors and deserialize().
+
+            Raises ValueError if items are out of order or a key is repeated.
+            """
+            def leaf_nodes():
+                for key, value in items:
+                    cls.check_key(key)
+                    cls.check_value(value)
+                    yield cls.FullLeafNodeClass(key, value)
+
+            return cls._mt_interned(cls.InnerNodeClass._mt_from_sorted_leaf_nodes(leaf_nodes(), 0), intern)
+
+        @classmethod
+        def _mt_interned(cls, tree, intern):
+            """Internal: tree interned with intern, if it isn't None"""
+            if intern is not None:
+                tree = intern.intern(tree)
+            return tree
+
+        @classmethod
+        def from_unsorted_items(cls, items, max_chunk_size=1000000, tmpdir=None, intern=None):
+            """Create a tree from items in any order
+
+            Items are sorted with an external merge sort: every max_chunk_size
+            items are sorted in memory and spilled to a temporary file in
+            tmpdir, and the sorted chunks are then merged and fed to
+            from_sorted_items().
+            """
+            return cls.from_sorted_items(_external_sort(items, max_chunk_size, tmpdir), intern)
+
+        @classmethod
+        def from_items_parallel(cls, items, max_workers=None, shard_bits=None, hash_only=False, intern=None):
+            """Create a tree from items in any order using multiple processes
+
+            Items are split into 2**shard_bits shards by the top shard_bits
+            bits of their keys. Each shard is an independent subtree, which is
+            built and hashed in a worker process of a ProcessPoolExecutor
+            with max_workers workers, then sent back in compact form and
+            stitched together with the rest.
+
+            If hash_only is true the workers only send back the hash of each
+            shard's subtree, and the result is a pruned tree with everything
+            below the shards pruned; its hash is the root hash of the tree.
+
+            The tree class must be importable by the worker processes.
+            """
+            if max_workers is None:
+                max_workers = os.cpu_count() or 1
+
+            if shard_bits is None:
+                shard_bits = min((max_workers * 4 - 1).bit_length(), 16)
+
+            if not 0 <= shard_bits <= min(16, cls.KEYSIZE * 8):
+                raise ValueError('shard_bits must be between 0 and 16; got %r' % shard_bits)
+
+            shift = cls.KEYSIZE * 8 - shard_bits
+            shards = [[] for i in range(2**shard_bits)]
+            for item in items:
+                cls.check_key(item[0])
+                shards[int.from_bytes(item[0], 'big') >> shift].append(item)
+
+            with concurrent.futures.ProcessPoolExecutor(max_workers) as executor:
+                futures = [executor.submit(_build_shard, cls._mt_baseclass, shard, shard_bits, hash_only)
+                           for shard in shards]
+                del shards
+                nodes = [cls._mt_from_compact(future.result()) for future in futures]
+
+            # Stitch the shards together a level at a time. Remember that
+            # keys with a 1 bit go on the left.
+            while len(nodes) > 1:
+                nodes = [cls.InnerNodeClass(nodes[i+1], nodes[i]) for i in range(0, len(nodes), 2)]
+            return cls._mt_interned(nodes[0], intern)
+
+        def _mt_to_compact(self, hash_only):
+            """Internal: convert to a compact form for sending to other processes
+
+            The compact form is a list of node entries in pre-order: None for
+            an empty node, ('I', hash) for an inner node, ('P', hash) for a
+            pruned inner node, ('L', key, value, hash) for a full leaf and
+            ('l', key, value_hash) for a pruned leaf. Pruned entries of sum
+            trees have the node's sum added to the end. Values must be
+            picklable. If hash_only is true the tree is pruned first.
+            """
+            sums = self.SUMSIZE is not None
+            entries = []
+            stack = [self._mt_get_keys({}, (), 0, True) if hash_only else self]
+            while stack:
+                node = stack.pop()
+                if isinstance(node, self.LazyInnerNodeClass):
+                    node = node._mt_load()
+
+                if isinstance(node, self.EmptyNodeClass):
+                    entries.append(None)
+                elif isinstance(node, self.InnerNodeClass):
+                    entries.append(('I', node.hash))
+                    stack.append(node.right)
+                    stack.append(node.left)
+                elif isinstance(node, self.PrunedInnerNodeClass):
+                    entries.append(('P', node.hash, node._mt_sum()) if sums else ('P', node.hash))
+                elif isinstance(node, self.FullLeafNodeClass):
+                    entries.append(('L', node.key, node.value, node.hash))
+                else:
+                    if sums:
+                        entries.append(('l', node.key, node.value_hash, node._mt_sum()))
+                    else:
+                        entries.append(('l', node.key, node.value_hash))
+            return entries
+
+        @classmethod
+        def _mt_from_compact(cls, entries):
+            """Internal: convert from the form created by _mt_to_compact()"""
+            # Going through the entries backwards means children are always
+            # created before their parents.
+            stack = []
+            empty_node = cls.EmptyNodeClass()
+            for entry in reversed(entries):
+                if entry is None:
+                    node = empty_node
+                elif entry[0] == 'I':
+                    node = cls.InnerNodeClass(stack.pop(), stack.pop())
+                    object.__setattr__(node, '_mt_cached_hash', entry[1])
+                elif entry[0] == 'P':
+                    node = cls.PrunedInnerNodeClass(*entry[1:])
+                elif entry[0] == 'L':
+                    node = cls.FullLeafNodeClass(entry[1], entry[2])
+                    object.__setattr__(node, '_mt_cached_hash', entry[3])
+                else:
+                    node = cls.PrunedLeafNodeClass(*entry[1:])
+                stack.append(node)
+
+            assert len(stack) == 1
+            return stack[0]
+
+        @classmethod
+        def root_hash_of(cls, keys, value_hashes):
+            """Calculate the root hash of a tree without building it
+
+            keys and value_hashes are N x KEYSIZE and N x (value hash size)
+            NumPy uint8 arrays. Returns the same hash as building the tree and
+            reading .hash; see merbinnertree.arrayhash. Without NumPy a
+            slower pure-Python version is used.
+            """
+            from merbinnertree.arrayhash import root_hash_of
+            return root_hash_of(cls, keys, value_hashes)
 
         @property
         def hash(self):
             try:
                 return self._mt_cached_hash
             except AttributeError:
-                object.__setattr__(self, '_mt_cached_hash', self.calc_hash_data())
+                object.__setattr__(self, '_mt_cached_hash', self.calc_hash(self.calc_hash_data()))
                 return self._mt_cached_hash
 
+        @classmethod
+        def calc_hash(cls, hash_data):
+            """Calculate a node hash from node hash data"""
+            if cls.HASH_SCHEME == HASH_SCHEME_V1:
+                return cls.hash_func(hash_data)
+            elif cls.HASH_SCHEME == HASH_SCHEME_V0:
+                return hash_data
+            else:
+                raise ValueError('unknown hash scheme %r' % cls.HASH_SCHEME)
+
+        @classmethod
+        def calc_hashes(cls, hash_datas):
+            """Calculate node hashes for a batch of node hash data
+
+            Returns a list of hashes in the same order.
+            """
+            if cls.HASH_SCHEME == HASH_SCHEME_V1:
+                return cls.hash_many(hash_datas)
+            else:
+                return [cls.calc_hash(hash_data) for hash_data in hash_datas]
+
+        @classmethod
+        def hash_many(cls, datas):
+            """Hash a batch of data with hash_func()
+
+            Returns a list of hashes in the same order. This is where batches
+            of node hash data end up, such as every node at one level of
+            compute_hashes(), so a tree class with a vectorized or threaded
+            hash implementation can override it.
+            """
+            hash_func = cls.hash_func
+            return [hash_func(data) for data in datas]
+
+        def compute_hashes(self, max_workers=None):
+            """Calculate every node hash in the tree that isn't cached yet
+
+            Unlike reading .hash, which recurses through the tree, nodes
+            missing a cached hash are found with an explicit stack, grouped by
+            their height above the deepest of them, and hashed a level at a
+            time with calc_hashes(). Subtrees whose hash is already cached
+            aren't visited.
+
+            If max_workers is more than one, independent subtrees are hashed
+            by a thread pool of that size first. hashlib releases the GIL
+            while hashing large inputs, and free-threaded builds of Python can
+            run the threads in parallel.
+
+            Returns the root hash.
+            """
+            if max_workers is not None and max_workers > 1:
+                subtrees = self._mt_split_unhashed(max_workers * 4)
+                if len(subtrees) > 1:
+                    with concurrent.futures.ThreadPoolExecutor(max_workers) as executor:
+                        for ignored in executor.map(lambda subtree: subtree.compute_hashes(), subtrees):
+                            pass
+
+            # The empty node is a singleton that would otherwise show up many
+            # times.
+            self.EmptyNodeClass().hash
+
+            levels = []
+            heights = []
+            stack = [(self, False)]
+            while stack:
+                node, children_done = stack.pop()
+
+                if children_done:
+                    right_height = heights.pop()
+                    left_height = heights.pop()
+                    height = max(left_height, right_height) + 1
+
+                else:
+                    try:
+                        node._mt_cached_hash
+                    except AttributeError:
+                        pass
+                    else:
+                        heights.append(-1)
+                        continue
+
+                    if isinstance(node, self.InnerNodeClass):
+                        stack.append((node, True))
+                        stack.append((node.right, False))
+                        stack.append((node.left, False))
+                        continue
+
+                    height = 0
+
+                if height == len(levels):
+                    levels.append([])
+                levels[height].append(node)
+                heights.append(height)
+
+            for level in levels:
+                node_hashes = self.calc_hashes([node.calc_hash_data() for node in level])
+                for node, node_hash in zip(level, node_hashes):
+                    object.__setattr__(node, '_mt_cached_hash', node_hash)
+
+            return self.hash
+
+        def _mt_split_unhashed(self, n):
+            """Internal: split the tree into at least n unhashed subtrees
+
+            Returns fewer if the tree doesn't have that many inner nodes
+            without a cached hash near the top.
+            """
+            subtrees = [self]
+            while len(subtrees) < n:
+                next_subtrees = []
+                for subtree in subtrees:
+                    try:
+                        subtree._mt_cached_hash
+                    except AttributeError:
+                        if isinstance(subtree, self.InnerNodeClass):
+                            next_subtrees.append(subtree.left)
+                            next_subtrees.append(subtree.right)
+
+                if len(next_subtrees) <= len(subtrees):
+                    break
+                subtrees = next_subtrees
+            return subtrees
+
         @classmethod
         def check_key(cls, key):
             if not isinstance(key, bytes):
@@ -57,6 +405,14 @@ def make_MerbinnerTree_baseclass(basecls=object):
         def check_value(cls, value):
             raise NotImplementedError
 
+        @classmethod
+        def calc_value_sum(cls, value):
+            """Calculate the amount a value adds to the sums of a sum tree
+
+            Must be a non-negative int. Only used if SUMSIZE isn't None.
+            """
+            raise NotImplementedError
+
         @classmethod
         def key_side(cls, key, depth):
             return key[depth // 8] >> (7 - depth % 8) & 0b1
@@ -76,16 +432,54 @@ def make_MerbinnerTree_baseclass(basecls=object):
             """
             raise NotImplementedError
 
+        def _mt_pruned(self):
+            """Internal: pruned inner node standing in for this inner node"""
+            if self.SUMSIZE is None:
+                return self.PrunedInnerNodeClass(self.hash)
+            else:
+                return self.PrunedInnerNodeClass(self.hash, self._mt_sum())
+
+        def _mt_get_leaf(self, key):
+            """Internal: find the leaf node for a single key
+
+            Fast path for point lookups: walks down the tree in a loop, testing
+            bits of the key converted to an int once, without the containers
+            _mt_get_keys() creates at every level.
+
+            Returns the leaf node, which may be pruned, or None if the key
+            isn't in the tree.
+            """
+            InnerNodeClass = self.InnerNodeClass
+            LeafNodeClass = self.LeafNodeClass
+            EmptyNodeClass = self.EmptyNodeClass
+            LazyInnerNodeClass = self.LazyInnerNodeClass
+
+            key_int = int.from_bytes(key, 'big')
+            shift = self.KEYSIZE * 8 - 1
+            node = self
+            while True:
+                if isinstance(node, InnerNodeClass):
+                    node = node.left if key_int >> shift & 1 else node.right
+                    shift -= 1
+
+                elif isinstance(node, LeafNodeClass):
+                    return node if node._mt_key_view() == key else None
+
+                elif isinstance(node, EmptyNodeClass):
+                    return None
+
+                elif isinstance(node, LazyInnerNodeClass):
+                    node = node._mt_load()
+
+                else:
+                    raise self.PrunedError('get', key, self.KEYSIZE * 8 - 1 - shift)
 
         def __getitem__(self, key):
             """Return value associated with key"""
             self.check_key(key)
-            result = {}
-            self._mt_get_keys(result, (key,), 0, False)
-
-            # Note how if the key is not found, this will return the KeyError
-            # for us.
-            found_node = result[key]
+            found_node = self._mt_get_leaf(key)
+            if found_node is None:
+                raise KeyError(key)
 
             try:
                 return found_node.value
@@ -94,20 +488,11 @@ def make_MerbinnerTree_baseclass(basecls=object):
                 # even though we could confirm that the key is present in the
                 # tree.
                 assert isinstance(found_node, self.PrunedLeafNodeClass)
-                raise PrunedError
+                raise self.PrunedError('get', key, None)
 
         def __contains__(self, key):
             self.check_key(key)
-            result = {}
-            self._mt_get_keys(result, (key,), 0, False)
-
-            try:
-                found_node = result[key]
-            except KeyError:
-                # FIXME: do we really need to do this?
-                return False
-            else:
-                return True
+            return self._mt_get_leaf(key) is not None
 
         def prove_contains(self, keys, result=None):
             """Prove the that the tree contains or does not contain one or more keys"""
@@ -122,35 +507,199 @@ def make_MerbinnerTree_baseclass(basecls=object):
             pruned_tree = self._mt_get_keys(result, keys, 0, True)
             return pruned_tree
 
-        def _mt_put_keys(self, changed_keys, items, depth, prove):
+        def iter_proofs(self, keys, group_size=1, encode=True):
+            """Generate separate proofs for many keys in a single walk
+
+            keys must be in tree order, and are split into groups of
+            group_size keys. Generates (group, proof) for each group in turn,
+            where group is a list of its keys and proof is the same as
+            prove_contains(group), serialized if encode is true.
+
+            The tree is walked once, in key order. Only the nodes on the path
+            to the current group are held onto, along with the pruned
+            siblings along that path, which are made and encoded once and
+            then shared by every proof that goes through them.
+            """
+            keybits = self.KEYSIZE * 8
+            version_part = bytes([SERIALIZATION_VERSION])
+            inner_part = bytes([TAG_INNER])
+
+            # Path to the current group, as (child, prefix, suffix) for each
+            # inner node along it, where child is the next node along the
+            # path. If encode is true, prefix and suffix are everything that
+            # goes before and after the child in the encoded proof. Otherwise
+            # they're the pruned sibling on one side of the child, and None
+            # on the other.
+            path = []
+
+            def groups():
+                group = []
+                prev_key = None
+                for key in keys:
+                    self.check_key(key)
+                    if prev_key is not None and key >= prev_key:
+                        raise ValueError('keys not in tree order: %r follows %r' % (key, prev_key))
+                    prev_key = key
+                    group.append(key)
+                    if len(group) == group_size:
+                        yield group
+                        group = []
+                if group:
+                    yield group
+
+            prev_key_int = None
+            for group in groups():
+                first_key_int = int.from_bytes(group[0], 'big')
+                last_key_int = int.from_bytes(group[-1], 'big')
+
+                # Keep the part of the path this group shares with the last,
+                # down to where this group splits.
+                split_depth = keybits - (first_key_int ^ last_key_int).bit_length()
+                if prev_key_int is not None:
+                    split_depth = min(split_depth, keybits - (prev_key_int ^ first_key_int).bit_length())
+                del path[split_depth:]
+                prev_key_int = last_key_int
+
+                depth = len(path)
+                node = path[-1][0] if path else self
+                while True:
+                    if isinstance(node, self.LazyInnerNodeClass):
+                        node = node._mt_load()
+                    if not isinstance(node, self.InnerNodeClass):
+                        break
+
+                    shift = keybits - 1 - depth
+                    side = first_key_int >> shift & 1
+                    if side != last_key_int >> shift & 1:
+                        # The group splits here.
+                        break
+
+                    if side:
+                        child, sibling = node.left, node.right
+                    else:
+                        child, sibling = node.right, node.left
+                    sibling = sibling._mt_get_keys({}, (), depth+1, True)
+                    if encode:
+                        sibling = b''.join(sibling._mt_serialized_node_parts())
+                        prefix, suffix = path[-1][1:] if path else (version_part, b'')
+                        if side:
+                            path.append((child, prefix + inner_part, sibling + suffix))
+                        else:
+                            path.append((child, prefix + inner_part + sibling, suffix))
+                    else:
+                        if side:
+                            path.append((child, None, sibling))
+                        else:
+                            path.append((child, sibling, None))
+
+                    node = child
+                    depth += 1
+
+                proof = node._mt_get_keys({}, group, depth, True)
+                if encode:
+                    prefix, suffix = path[-1][1:] if path else (version_part, b'')
+                    proof = b''.join((prefix, *proof._mt_serialized_node_parts(), suffix))
+                else:
+                    for child, left, right in reversed(path):
+                        if left is None:
+                            proof = self.InnerNodeClass(proof, right)
+                        else:
+                            proof = self.InnerNodeClass(left, proof)
+
+                yield (group, proof)
+
+        def _mt_put_keys(self, old_leaves, items, depth, prove):
             """Internal: change key(s) to specified node(s)
 
             Changing a key to an EmptyNodeClass instance has the effect of
             removing it.
 
+            Every key that is changed is added to the old_leaves dict, with
+            the leaf it replaced, or None if it was added. Keys set to the
+            value they already have are left out, as are keys to be removed
+            that aren't in the tree.
+
             Returns (new_tree, pruned_tree)
             """
             raise NotImplementedError
 
+        def _mt_check_missing_keys(self, items, old_leaves):
+            """Internal: raise KeyError for keys to be removed that weren't found"""
+            missing_keys = [key for key, node in items
+                            if isinstance(node, self.EmptyNodeClass) and key not in old_leaves]
+            if missing_keys:
+                raise KeyError(missing_keys)
+
+        def _mt_apply_items(self, items, added, modified, removed):
+            """Internal: apply checked (key, node) items in a single pass
+
+            The keys that were added, modified and removed are added to
+            whichever of those sets aren't None. Raises KeyError if a key to
+            be removed isn't in the tree.
+            """
+            old_leaves = {}
+            (new_tree, ignored) = self._mt_put_keys(old_leaves, items, 0, False)
+            self._mt_check_missing_keys(items, old_leaves)
+
+            for key, node in items:
+                if key not in old_leaves:
+                    continue
+
+                old_leaf = old_leaves[key]
+                if old_leaf is None:
+                    if added is not None:
+                        added.add(key)
+
+                elif isinstance(node, self.EmptyNodeClass):
+                    if removed is not None:
+                        removed.add(key)
+
+                elif modified is not None:
+                    # Pruned leaves can only be compared by value hash.
+                    if not (isinstance(old_leaf, self.PrunedLeafNodeClass) and
+                            old_leaf.value_hash == self.calc_value_hash(node.value)):
+                        modified.add(key)
+
+            return new_tree
+
+        def _mt_check_change_keys(self, changes):
+            """Internal: check the keys of a batch of changes
+
+            Yields (key, value) pairs; raises ValueError if a key is repeated.
+            """
+            seen_keys = set()
+            for key, value in changes:
+                self.check_key(key)
+                if key in seen_keys:
+                    raise ValueError('key %r changed more than once' % key)
+                seen_keys.add(key)
+                yield (key, value)
+
         def put(self, key, value):
             """Set key to value
 
             Returns a new tree with that key set.
             """
-            self.check_key(key)
-            self.check_value(value)
+            return self.put_many(((key, value),))
 
-            leaf_node = self.FullLeafNodeClass(key, value)
+        def put_many(self, items, added=None, modified=None):
+            """Set many keys to values at once
 
-            changed_keys = set()
-            (new_tree, ignored) = self._mt_put_keys(changed_keys, [(key, leaf_node)], 0, False)
-            assert len(changed_keys) <= 1
+            items is an iterable of (key, value) pairs. All the changes are
+            made in a single pass down the tree, so the nodes they have in
+            common are only copied once.
 
-            # Check that the put was successful
-            if key not in changed_keys:
-                raise KeyError(key)
+            Returns a new tree with those keys set; keys already set to the
+            same value are left as they are. If added or modified is not None,
+            the keys that were new, or had a different value, are added to
+            it.
+            """
+            checked_items = []
+            for key, value in self._mt_check_change_keys(items):
+                self.check_value(value)
+                checked_items.append((key, self.FullLeafNodeClass(key, value)))
 
-            return new_tree
+            return self._mt_apply_items(checked_items, added, modified, None)
 
         def put_value_hash(self, key, value_hash):
             """Set key to a value hash
@@ -162,25 +711,105 @@ def make_MerbinnerTree_baseclass(basecls=object):
 
         def remove(self, key):
             """Remove key from tree"""
-            self.check_key(key)
+            try:
+                return self.remove_many((key,))
+            except KeyError:
+                raise KeyError(key) from None
 
-            changed_keys = set()
-            (new_tree, ignored) = self._mt_put_keys(changed_keys, [(key, self.EmptyNodeClass())], 0, False)
+        def remove_many(self, keys, removed=None):
+            """Remove many keys from the tree at once
 
-            # Check that the remove was succesful
-            if key not in changed_keys:
-                raise KeyError(key)
+            Returns a new tree without those keys. Raises KeyError, with a
+            list of every missing key as its argument, if any of the keys
+            aren't in the tree. If removed is not None, the keys are added to
+            it.
+            """
+            empty_node = self.EmptyNodeClass()
+            checked_items = []
+            for key, ignored in self._mt_check_change_keys((key, None) for key in keys):
+                checked_items.append((key, empty_node))
 
-            return new_tree
+            return self._mt_apply_items(checked_items, None, None, removed)
+
+        def _mt_check_changes(self, changes):
+            """Internal: check a batch of changes, as taken by apply()
+
+            Returns a list of (key, node) items.
+            """
+            empty_node = self.EmptyNodeClass()
+            checked_items = []
+            for key, value in self._mt_check_change_keys(changes):
+                if value is None:
+                    checked_items.append((key, empty_node))
+                else:
+                    self.check_value(value)
+                    checked_items.append((key, self.FullLeafNodeClass(key, value)))
+            return checked_items
+
+        def apply(self, changes, added=None, modified=None, removed=None):
+            """Apply a batch of puts and removes at once
+
+            changes is an iterable of (key, value) pairs; a value of None
+            removes the key instead of setting it. Otherwise the same as
+            put_many() and remove_many(): one new tree is made in a single
+            pass, keys are reported in added, modified and removed, and
+            KeyError is raised if a key to be removed is missing.
+            """
+            return self._mt_apply_items(self._mt_check_changes(changes), added, modified, removed)
+
+        def prove_put_many(self, changes):
+            """Prove a batch of changes
+
+            changes is as for apply(). Returns the witness for them: the
+            pruned tree with just enough of this tree to make the changes
+            with apply_with_witness(). Everything in the witness is pruned
+            down to hashes, even the leaves being changed.
+
+            Raises KeyError if a key to be removed is missing.
+            """
+            items = self._mt_check_changes(changes)
+            old_leaves = {}
+            new_tree, witness = self._mt_put_keys(old_leaves, items, 0, True)
+            self._mt_check_missing_keys(items, old_leaves)
+            return witness
+
+        @classmethod
+        def apply_with_witness(cls, witness, changes, root_hash):
+            """Apply a batch of changes to a tree without having the tree
+
+            witness is what prove_put_many(changes) returned for the tree,
+            and root_hash the hash of the tree, which the witness is checked
+            against. Returns the pruned tree resulting from the changes; its
+            hash is the hash the full tree would have after apply(changes).
+
+            Raises ValueError if the witness doesn't match root_hash,
+            PrunedError if it doesn't have what the changes need, and
+            KeyError if a key to be removed is missing.
+            """
+            if not isinstance(witness, cls._mt_baseclass):
+                raise TypeError('witness must be a %r; got %r' % (cls._mt_baseclass, witness.__class__))
+            if witness.hash != root_hash:
+                raise ValueError('witness does not match root hash')
+            return witness.apply(changes)
 
         def _mt_update(self, tree, depth):
             """Internal implementation of update()"""
             raise NotImplementedError
 
         def update(self, tree):
-            """Update """
-            if not ininstance(tree, self.__class__.__base__):
-                raise TypeError('trees are of different classes')
+            """Update the tree with the items of another tree
+
+            Like dict.update(), returns a tree with all the items of both
+            trees, taking the other tree's value for keys in both. Either
+            tree may be pruned, so long as the parts of this tree that the
+            other tree's items go into aren't; otherwise PrunedError is
+            raised.
+
+            Parts of this tree that the other tree doesn't change are reused,
+            including subtrees the other tree has a pruned copy of.
+            """
+            if getattr(tree, '_mt_baseclass', None) is not self._mt_baseclass:
+                raise TypeError("Can't update: trees are of different classes")
             return self._mt_update(tree, 0)
 
         def _mt_merge(self, tree, depth):
@@ -188,13 +817,71 @@ def make_MerbinnerTree_baseclass(basecls=object):
             raise NotImplementedError
 
         def merge(self, tree):
-            """Merge two pruned trees together"""
-            if not ininstance(tree, self.__class__.__base__):
+            """Merge two pruned trees together
+
+            Both trees must have the same hash. The result has the same hash
+            too, and can prove anything either tree could prove; each part of
+            it is taken from whichever tree has it least pruned, reusing the
+            existing nodes.
+            """
+            if getattr(tree, '_mt_baseclass', None) is not self._mt_baseclass:
                 raise TypeError("Can't merge: trees are of different classes")
             if self.hash != tree.hash:
                 raise ValueError("Can't merge: trees have different hashes")
             return self._mt_merge(tree, 0)
 
+        @classmethod
+        def merge_all(cls, trees):
+            """Merge any number of pruned trees with the same hash together
+
+            The result is the same as merging them one at a time, but each
+            part of the trees is only walked once, rather than once per
+            merge.
+            """
+            trees = list(trees)
+            if not trees:
+                raise ValueError("Can't merge: no trees")
+            for tree in trees:
+                if getattr(tree, '_mt_baseclass', None) is not cls._mt_baseclass:
+                    raise TypeError("Can't merge: trees are of different classes")
+            root_hash = trees[0].hash
+            for tree in trees[1:]:
+                if tree.hash != root_hash:
+                    raise ValueError("Can't merge: trees have different hashes")
+            return cls._mt_merge_all(trees)
+
+        @classmethod
+        def _mt_merge_all(cls, nodes):
+            """Internal implementation of merge_all()"""
+            # Pruned inner nodes add nothing to what any other node would.
+            unpruned = [node for node in nodes if not isinstance(node, cls.PrunedInnerNodeClass)]
+            if not unpruned:
+                return nodes[0]
+            nodes = unpruned
+
+            if isinstance(nodes[0], cls.LeafNodeClass):
+                for node in nodes:
+                    if isinstance(node, cls.FullLeafNodeClass):
+                        return node
+                return nodes[0]
+
+            elif isinstance(nodes[0], cls.EmptyNodeClass):
+                return nodes[0]
+
+            # Inner nodes. Lazy nodes can load everything under them, so
+            # there's nothing to add to one.
+            for node in nodes:
+                if isinstance(node, cls.LazyInnerNodeClass):
+                    return node
+
+            nodes = list({id(node): node for node in nodes}.values())
+            if len(nodes) == 1:
+                return nodes[0]
+
+            left = cls._mt_merge_all([node.left for node in nodes])
+            right = cls._mt_merge_all([node.right for node in nodes])
+            return nodes[0]._mt_merged_inner(nodes, left, right)
+
         def _mt_iter_nodes(self):
             """Iterate through all nodes in the tree
 
@@ -202,32 +889,825 @@ def make_MerbinnerTree_baseclass(basecls=object):
             """
             yield self
 
+        def _mt_iter_leaves(self, lo=None, hi=None, reverse=False, strict=False):
+            """Internal: iterate through the leaf nodes in tree order
+
+            Only leaves with keys, as ints, in lo <= key < hi are generated,
+            either of which may be None for no bound; subtrees entirely
+            outside of that are skipped without looking inside them. If
+            reverse is true leaves are generated in reverse tree order.
+
+            Pruned inner nodes are skipped, unless strict is true and they
+            might have keys in range, in which case PrunedError is raised.
+            """
+            keybits = self.KEYSIZE * 8
+            InnerNodeClass = self.InnerNodeClass
+            LeafNodeClass = self.LeafNodeClass
+            LazyInnerNodeClass = self.LazyInnerNodeClass
+            PrunedInnerNodeClass = self.PrunedInnerNodeClass
+
+            if lo is None and hi is None and not strict:
+                stack = [self]
+                while stack:
+                    node = stack.pop()
+                    if isinstance(node, LazyInnerNodeClass):
+                        node = node._mt_load()
+
+                    if isinstance(node, InnerNodeClass):
+                        if reverse:
+                            stack.append(node.left)
+                            stack.append(node.right)
+                        else:
+                            stack.append(node.right)
+                            stack.append(node.left)
+                    elif isinstance(node, LeafNodeClass):
+                        yield node
+                return
+
+            if lo is None:
+                lo = 0
+            if hi is None:
+                hi = 1 << keybits
+
+            # (node, prefix, depth), where the node covers the keys from
+            # prefix << (keybits - depth), inclusive, to (prefix + 1) <<
+            # (keybits - depth), exclusive.
+            stack = [(self, 0, 0)]
+            while stack:
+                node, prefix, depth = stack.pop()
+                shift = keybits - depth
+                if (prefix + 1) << shift <= lo or prefix << shift >= hi:
+                    continue
+
+                if isinstance(node, LazyInnerNodeClass):
+                    node = node._mt_load()
+
+                if isinstance(node, InnerNodeClass):
+                    if reverse:
+                        stack.append((node.left, prefix << 1 | 1, depth + 1))
+                        stack.append((node.right, prefix << 1, depth + 1))
+                    else:
+                        stack.append((node.right, prefix << 1, depth + 1))
+                        stack.append((node.left, prefix << 1 | 1, depth + 1))
+
+                elif isinstance(node, LeafNodeClass):
+                    if lo <= int.from_bytes(node.key, 'big') < hi:
+                        yield node
+
+                elif strict and isinstance(node, PrunedInnerNodeClass):
+                    raise self.PrunedError('iterate', (prefix << shift).to_bytes(self.KEYSIZE, 'big'), depth)
+
         # FIXME: do we care that what the following return isn't "set-like"?
         def keys(self):
-            for node in self._mt_iter_nodes():
-                try:
-                    yield node.key
-                except AttributeError:
-                    continue
+            for node in self._mt_iter_leaves():
+                yield node.key
 
         def values(self):
-            for node in self._mt_iter_nodes():
+            for node in self._mt_iter_leaves():
                 try:
                     yield node.value
                 except AttributeError:
                     continue
 
         def items(self):
-            for node in self._mt_iter_nodes():
+            for node in self._mt_iter_leaves():
                 try:
                     yield (node.key, node.value)
                 except AttributeError:
                     continue
 
+        def _mt_iter_items_strict(self, leaves):
+            """Internal: items of leaves, raising PrunedError for pruned leaves"""
+            for node in leaves:
+                try:
+                    yield (node.key, node.value)
+                except AttributeError:
+                    raise self.PrunedError('iterate', node.key, None)
+
+        def range(self, start=None, end=None, reverse=False):
+            """Iterate through the items with start <= key < end
+
+            Either bound may be None for no bound. Items are generated in tree
+            order, or in reverse if reverse is true, and only the subtrees
+            with keys in range are walked. Raises PrunedError if any part of
+            the range is pruned.
+            """
+            lo = hi = None
+            if start is not None:
+                self.check_key(start)
+                lo = int.from_bytes(start, 'big')
+            if end is not None:
+                self.check_key(end)
+                hi = int.from_bytes(end, 'big')
+            if lo is not None and hi is not None and lo >= hi:
+                return iter(())
+            return self._mt_iter_items_strict(self._mt_iter_leaves(lo, hi, reverse, True))
+
+        def iter_prefix(self, prefix, nbits=None, reverse=False):
+            """Iterate through the items with keys starting with prefix
+
+            Only the first nbits bits of prefix are compared, all of them if
+            nbits is None. Otherwise the same as range().
+            """
+            if not isinstance(prefix, bytes):
+                raise TypeError('prefix must be bytes instance; got %r instead' % prefix.__class__)
+            if nbits is None:
+                nbits = len(prefix) * 8
+            if not 0 <= nbits <= min(len(prefix), self.KEYSIZE) * 8:
+                raise ValueError('nbits must be between 0 and the length of prefix in bits; got %r' % nbits)
+
+            shift = self.KEYSIZE * 8 - nbits
+            lo = int.from_bytes(prefix, 'big') >> (len(prefix) * 8 - nbits) << shift
+            hi = lo + (1 << shift)
+            return self._mt_iter_items_strict(self._mt_iter_leaves(lo, hi, reverse, True))
+
+        def _mt_count(self):
+            """Internal: number of leaves in the tree
+
+            Raises PrunedError if part of the tree is pruned.
+            """
+            raise NotImplementedError
+
+        def __len__(self):
+            """Number of items in the tree
+
+            Inner nodes cache the number of leaves under them the first time
+            it's needed, so after the first call this takes constant time.
+            Pruned leaves count; raises PrunedError if any inner node is
+            pruned.
+            """
+            return self._mt_count()
+
+        def __bool__(self):
+            # Every node but an empty one has at least one leaf under it,
+            # pruned or not, so there's no need to count them.
+            return True
+
+        def select(self, i):
+            """Return the i-th item in tree order
+
+            Negative i counts from the end, like list indexing. Takes time
+            proportional to the depth of the tree once counts are cached; see
+            __len__(). Raises IndexError if i is out of range.
+            """
+            n = self._mt_count()
+            if i < 0:
+                i += n
+            if not 0 <= i < n:
+                raise IndexError('tree index out of range')
+
+            node = self
+            while True:
+                if isinstance(node, self.LazyInnerNodeClass):
+                    node = node._mt_load()
+                if not isinstance(node, self.InnerNodeClass):
+                    return self._mt_leaf_item(node)
+
+                left_count = node.left._mt_count()
+                if i < left_count:
+                    node = node.left
+                else:
+                    i -= left_count
+                    node = node.right
+
+        def rank(self, key):
+            """Return the number of items before key in tree order
+
+            That's the index of key's item if key is in the tree, and the
+            number of keys greater than key either way. Takes time
+            proportional to the depth of the tree, like select().
+            """
+            self.check_key(key)
+            key_int = int.from_bytes(key, 'big')
+            shift = self.KEYSIZE * 8 - 1
+            i = 0
+            node = self
+            while True:
+                if isinstance(node, self.LazyInnerNodeClass):
+                    node = node._mt_load()
+
+                if isinstance(node, self.InnerNodeClass):
+                    if key_int >> shift & 1:
+                        node = node.left
+                    else:
+                        i += node.left._mt_count()
+                        node = node.right
+                    shift -= 1
+
+                elif isinstance(node, self.LeafNodeClass):
+                    return i + (node.key > key)
+
+                elif isinstance(node, self.EmptyNodeClass):
+                    return i
+
+                else:
+                    raise self.PrunedError('rank', key, self.KEYSIZE * 8 - 1 - shift)
+
+        def sample(self, n, rng=random):
+            """Return n distinct items chosen uniformly at random
+
+            Items are in random order. rng is the random.Random instance
+            used, or the random module by default. Each item is found with
+            select(), so this takes time proportional to n times the depth
+            of the tree. Raises ValueError if n is more than len(self).
+            """
+            return [self.select(i) for i in rng.sample(range(self._mt_count()), n)]
+
+        def _mt_sum(self):
+            """Internal: sum of the values of the leaves in a sum tree"""
+            raise NotImplementedError
+
+        def _mt_range_sum(self, lo, hi, prove):
+            """Internal: sum of the leaves with lo <= key < hi, as ints
+
+            Subtrees entirely in range add their cached sum without being
+            looked into, and subtrees entirely out of range are skipped, so
+            only the paths to the two ends of the range are walked.
+
+            Returns (sum, pruned_tree), where pruned_tree is None unless prove
+            is true.
+            """
+            if self.SUMSIZE is None:
+                raise TypeError('%r is not a sum tree' % self._mt_baseclass)
+            keybits = self.KEYSIZE * 8
+            InnerNodeClass = self.InnerNodeClass
+            LeafNodeClass = self.LeafNodeClass
+            LazyInnerNodeClass = self.LazyInnerNodeClass
+            PrunedInnerNodeClass = self.PrunedInnerNodeClass
+
+            def walk(node, prefix, depth):
+                shift = keybits - depth
+                node_lo = prefix << shift
+                node_hi = (prefix + 1) << shift
+
+                # The root is always looked into, as nothing commits to the
+                # sum of a pruned root.
+                if depth and (node_hi <= lo or node_lo >= hi):
+                    return (0, node._mt_get_keys({}, (), depth, True) if prove else None)
+                elif depth and lo <= node_lo and node_hi <= hi:
+                    return (node._mt_sum(), node._mt_get_keys({}, (), depth, True) if prove else None)
+
+                if isinstance(node, LazyInnerNodeClass):
+                    node = node._mt_load()
+
+                if isinstance(node, InnerNodeClass):
+                    left_sum, left = walk(node.left, prefix << 1 | 1, depth + 1)
+                    right_sum, right = walk(node.right, prefix << 1, depth + 1)
+                    if prove:
+                        if left is not node.left or right is not node.right:
+                            node = InnerNodeClass(left, right)
+                    return (left_sum + right_sum, node if prove else None)
+
+                elif isinstance(node, LeafNodeClass):
+                    node_sum = node._mt_sum() if lo <= int.from_bytes(node.key, 'big') < hi else 0
+                    return (node_sum, node._mt_get_keys({}, (), depth, True) if prove else None)
+
+                elif isinstance(node, PrunedInnerNodeClass):
+                    raise self.PrunedError('sum', node_lo.to_bytes(self.KEYSIZE, 'big'), depth)
+
+                else:
+                    return (0, node)
+
+            return walk(self, 0, 0)
+
+        def _mt_sum_bounds(self, start, end):
+            """Internal: range_sum() bounds as ints"""
+            lo = 0
+            hi = 1 << (self.KEYSIZE * 8)
+            if start is not None:
+                self.check_key(start)
+                lo = int.from_bytes(start, 'big')
+            if end is not None:
+                self.check_key(end)
+                hi = int.from_bytes(end, 'big')
+            return (lo, hi)
+
+        def sum(self):
+            """Return the sum of calc_value_sum() over every item in a sum tree
+
+            Inner nodes cache the sums of their children, so after the first
+            call this takes constant time. Raises TypeError if the tree isn't
+            a sum tree.
+            """
+            return self.range_sum()
+
+        def range_sum(self, start=None, end=None):
+            """Return the sum for the items with start <= key < end
+
+            Either bound may be None for no bound. Takes time proportional to
+            the depth of the tree once sums are cached; see sum(). Pruned
+            subtrees entirely in or out of the range are fine, but PrunedError
+            is raised if one straddles either end of it, or if the root is
+            pruned.
+            """
+            lo, hi = self._mt_sum_bounds(start, end)
+            if lo >= hi:
+                return 0
+            return self._mt_range_sum(lo, hi, False)[0]
+
+        def prove_range_sum(self, start=None, end=None):
+            """Prove the sum for the items with start <= key < end
+
+            Returns (sum, pruned_tree). pruned_tree has the same hash as the
+            tree, and range_sum(start, end) on it gives the same sum; only the
+            paths to the two ends of the range are left unpruned, so its size
+            is proportional to the depth of the tree.
+            """
+            lo, hi = self._mt_sum_bounds(start, end)
+            if lo >= hi:
+                return (0, self._mt_get_keys({}, (), 0, True))
+            return self._mt_range_sum(lo, hi, True)
+
+        def _mt_neighbor(self, key, after):
+            """Internal: leaf with the nearest key after or before key
+
+            After means greater when keys are compared as bytes, which is
+            before in tree order. Returns None if there isn't one.
+            """
+            self.check_key(key)
+            key_int = int.from_bytes(key, 'big')
+            if after:
+                leaves = self._mt_iter_leaves(key_int + 1, None, True, True)
+            else:
+                leaves = self._mt_iter_leaves(None, key_int, False, True)
+            return next(leaves, None)
+
+        def _mt_leaf_item(self, leaf):
+            if leaf is None:
+                return None
+            try:
+                return (leaf.key, leaf.value)
+            except AttributeError:
+                raise self.PrunedError('get', leaf.key, None)
+
+        def successor(self, key):
+            """Return the item with the smallest key greater than key
+
+            Returns None if there is no such item. Only the path to where key
+            would be is walked, backtracking to the nearest subtree with
+            greater keys, so this takes time proportional to the depth of the
+            tree. Raises PrunedError if the answer is in a pruned part of the
+            tree.
+            """
+            return self._mt_leaf_item(self._mt_neighbor(key, True))
+
+        def predecessor(self, key):
+            """Return the item with the largest key less than key
+
+            Otherwise the same as successor().
+            """
+            return self._mt_leaf_item(self._mt_neighbor(key, False))
+
+        def closest(self, key):
+            """Return the item whose key is closest to key
+
+            Keys are compared as big-endian integers; the item for key itself
+            is returned if there is one, and ties go to the smaller key.
+            Returns None if the tree is empty.
+            """
+            self.check_key(key)
+            leaf = self._mt_get_leaf(key)
+            if leaf is None:
+                key_int = int.from_bytes(key, 'big')
+                before = self._mt_neighbor(key, False)
+                after = self._mt_neighbor(key, True)
+                if before is None or (after is not None and
+                        int.from_bytes(after.key, 'big') - key_int < key_int - int.from_bytes(before.key, 'big')):
+                    leaf = after
+                else:
+                    leaf = before
+            return self._mt_leaf_item(leaf)
+
+        def prove_neighbors(self, key):
+            """Prove which keys are adjacent to key
+
+            Returns (predecessor, successor, pruned_tree), where predecessor
+            and successor are the keys on either side of key, or None if
+            there isn't one. pruned_tree proves both of them, along with
+            whether or not key itself is in the tree. Any subtree between
+            them is empty, so pruned_tree also proves that nothing lies
+            between them: calling predecessor() and successor() on it gives
+            the same answers.
+            """
+            before = self._mt_neighbor(key, False)
+            after = self._mt_neighbor(key, True)
+            keys = [key]
+            if before is not None:
+                keys.append(before.key)
+            if after is not None:
+                keys.append(after.key)
+            return (before and before.key, after and after.key, self.prove_contains(keys))
+
+        def diff(self, other, unresolved=None):
+            """Find the differences between this tree and another
+
+            Generates (key, old_leaf, new_leaf) for every key whose value
+            differs, in tree order. old_leaf is the leaf node for key in this
+            tree and new_leaf in other, or None if the key isn't in that tree;
+            leaves may be pruned, in which case only their value hashes are
+            known.
+
+            Subtrees that are the same object, or whose hashes are both
+            already known to be equal, are skipped without looking inside
+            them. Diffing trees that share most of their nodes, such as a
+            tree and one derived from it with put(), takes time proportional
+            to the size of the difference rather than of the trees.
+
+            Parts of the trees that differ but are pruned can't be diffed. If
+            unresolved is None they raise PrunedError; otherwise a (prefix,
+            depth) tuple for each is added to unresolved and the rest of the
+            trees are diffed anyway; keys in those parts are never generated,
+            from either tree. The first depth bits of prefix, a key sized
+            bytes, are the path to the pruned part.
+            """
+            if getattr(other, '_mt_baseclass', None) is not self._mt_baseclass:
+                raise TypeError('Can only diff with another %r; got %r' % (self._mt_baseclass, other.__class__))
+
+            keysize = self.KEYSIZE
+            keybits = keysize * 8
+            InnerNodeClass = self.InnerNodeClass
+            LazyInnerNodeClass = self.LazyInnerNodeClass
+            PrunedInnerNodeClass = self.PrunedInnerNodeClass
+            LeafNodeClass = self.LeafNodeClass
+
+            def unresolved_region(prefix, depth):
+                prefix = (prefix << (keybits - depth)).to_bytes(keysize, 'big')
+                if unresolved is None:
+                    raise self.PrunedError('diff', prefix, depth)
+                unresolved.append((prefix, depth))
+
+            def leaves(node, prefix, depth):
+                """Generate (high_key, low_key, leaf) in tree order
+
+                Pruned regions are reported as unresolved, and generated with
+                leaf None and the range of keys they cover.
+                """
+                stack = [(node, prefix, depth)]
+                while stack:
+                    node, prefix, depth = stack.pop()
+                    if isinstance(node, LazyInnerNodeClass):
+                        node = node._mt_load()
+
+                    if isinstance(node, InnerNodeClass):
+                        stack.append((node.right, prefix << 1, depth + 1))
+                        stack.append((node.left, prefix << 1 | 1, depth + 1))
+                    elif isinstance(node, LeafNodeClass):
+                        key = node.key
+                        yield (key, key, node)
+                    elif isinstance(node, PrunedInnerNodeClass):
+                        unresolved_region(prefix, depth)
+                        low = prefix << (keybits - depth)
+                        high = low | ((1 << (keybits - depth)) - 1)
+                        yield (high.to_bytes(keysize, 'big'), low.to_bytes(keysize, 'big'), None)
+
+            stack = [(self, other, 0, 0)]
+            while stack:
+                old, new, prefix, depth = stack.pop()
+                if old is new:
+                    continue
+                try:
+                    if old._mt_cached_hash == new._mt_cached_hash:
+                        continue
+                except AttributeError:
+                    pass
+
+                if isinstance(old, LazyInnerNodeClass):
+                    old = old._mt_load()
+                if isinstance(new, LazyInnerNodeClass):
+                    new = new._mt_load()
+
+                if isinstance(old, InnerNodeClass) and isinstance(new, InnerNodeClass):
+                    stack.append((old.right, new.right, prefix << 1, depth + 1))
+                    stack.append((old.left, new.left, prefix << 1 | 1, depth + 1))
+
+                elif isinstance(old, PrunedInnerNodeClass) or isinstance(new, PrunedInnerNodeClass):
+                    if old.hash != new.hash:
+                        unresolved_region(prefix, depth)
+
+                else:
+                    # One side is a leaf or empty, so the differences are
+                    # found by merging the leaves of both sides, which are
+                    # in the same order. Leaves that fall in a pruned region
+                    # of the other side can't be diffed; the region has
+                    # already been reported as unresolved.
+                    old_leaves = leaves(old, prefix, depth)
+                    new_leaves = leaves(new, prefix, depth)
+                    old_entry = next(old_leaves, None)
+                    new_entry = next(new_leaves, None)
+                    while old_entry is not None or new_entry is not None:
+                        if new_entry is None or (old_entry is not None and old_entry[1] > new_entry[0]):
+                            if old_entry[2] is not None:
+                                yield (old_entry[0], old_entry[2], None)
+                            old_entry = next(old_leaves, None)
+
+                        elif old_entry is None or new_entry[1] > old_entry[0]:
+                            if new_entry[2] is not None:
+                                yield (new_entry[0], None, new_entry[2])
+                            new_entry = next(new_leaves, None)
+
+                        elif old_entry[2] is None or new_entry[2] is None:
+                            # Overlapping a pruned region: drop the leaf in
+                            # it, or, for two regions, the one that ends
+                            # first.
+                            if old_entry[2] is not None or (new_entry[2] is None and old_entry[1] > new_entry[1]):
+                                old_entry = next(old_leaves, None)
+                            else:
+                                new_entry = next(new_leaves, None)
+
+                        else:
+                            old_leaf = old_entry[2]
+                            new_leaf = new_entry[2]
+                            if old_leaf.hash != new_leaf.hash:
+                                yield (old_entry[0], old_leaf, new_leaf)
+                            old_entry = next(old_leaves, None)
+                            new_entry = next(new_leaves, None)
+
+        @classmethod
+        def serialize_value(cls, value):
+            """Convert a value to bytes for serialization"""
+            raise NotImplementedError
+
+        @classmethod
+        def deserialize_value(cls, buf):
+            """Convert a memoryview of a serialized value back to a value"""
+            raise NotImplementedError
+
+        @classmethod
+        def calc_serialized_value_hash(cls, buf):
+            """Calculate the value hash of a serialized value
+
+            buf is a memoryview of the serialized value. Tree classes whose
+            values hash the same as their serialization can override this to
+            hash buf directly, without making the value.
+            """
+            return cls.calc_value_hash(cls.deserialize_value(buf))
+
+        def _mt_serialized_parts(self):
+            """Internal: generate the serialized tree in parts"""
+            yield bytes([SERIALIZATION_VERSION])
+            yield from self._mt_serialized_node_parts()
+
+        def _mt_serialized_node_parts(self):
+            """Internal: generate the serialized nodes, without the version"""
+            if self.HASH_SCHEME != HASH_SCHEME_V1:
+                raise ValueError("Can't serialize: hash scheme %r hashes aren't a fixed size" % self.HASH_SCHEME)
+
+            empty_part = bytes([TAG_EMPTY])
+            inner_part = bytes([TAG_INNER])
+            pruned_inner_part = bytes([TAG_PRUNED_INNER])
+            full_leaf_part = bytes([TAG_FULL_LEAF])
+            pruned_leaf_part = bytes([TAG_PRUNED_LEAF])
+            sumsize = self.SUMSIZE
+
+            stack = [self]
+            while stack:
+                node = stack.pop()
+                if isinstance(node, self.LazyInnerNodeClass):
+                    node = node._mt_load()
+
+                if isinstance(node, self.InnerNodeClass):
+                    yield inner_part
+                    stack.append(node.right)
+                    stack.append(node.left)
+
+                elif isinstance(node, self.EmptyNodeClass):
+                    yield empty_part
+
+                elif isinstance(node, self.PrunedInnerNodeClass):
+                    yield pruned_inner_part
+                    yield node.hash
+                    if sumsize is not None:
+                        yield node._mt_sum().to_bytes(sumsize, 'big')
+
+                elif isinstance(node, self.FullLeafNodeClass):
+                    value = node._mt_serialized_value()
+                    yield full_leaf_part
+                    yield node.key
+                    yield _varint_encode(len(value))
+                    yield value
+
+                else:
+                    yield pruned_leaf_part
+                    yield node.key
+                    yield node.value_hash
+                    if sumsize is not None:
+                        yield node._mt_sum().to_bytes(sumsize, 'big')
+
+        def stream_serialize(self, f):
+            """Serialize the tree to a writable file-like object
+
+            The serialization starts with a SERIALIZATION_VERSION byte,
+            followed by every node in pre-order, left before right:
+
+                empty:        <TAG_EMPTY>
+                inner:        <TAG_INNER> <left> <right>
+                pruned inner: <TAG_PRUNED_INNER> <hash>
+                full leaf:    <TAG_FULL_LEAF> <key> <varint len(value)> <value>
+                pruned leaf:  <TAG_PRUNED_LEAF> <key> <value hash>
+
+            Keys and hashes are fixed size, and varints are unsigned LEB128.
+            In sum trees pruned nodes are followed by their sum, SUMSIZE
+            bytes big-endian. The encoding of any given tree is unique.
+            """
+            for part in self._mt_serialized_parts():
+                f.write(part)
+
+        def serialize(self):
+            """Serialize the tree to bytes; see stream_serialize()"""
+            return b''.join(self._mt_serialized_parts())
+
+        @classmethod
+        def deserialize(cls, buf, max_depth=None, max_nodes=None, max_bytes=None, arena=False, intern=None):
+            """Deserialize a tree from a buffer
+
+            buf may be any object supporting the buffer protocol; it's parsed
+            through a memoryview. Keys, values and the hashes of pruned nodes
+            are copied, so buf may be modified afterwards unless arena is
+            true.
+
+            If arena is true, full leaves aren't given keys and values of
+            their own: they're ArenaLeafNodeClass nodes that keep where
+            theirs are in buf, so loading a big tree from a read buffer or
+            mmap doesn't put a key and value on the heap for every leaf.
+            Values aren't deserialized until they're read.
+
+            intern is as for from_sorted_items().
+
+            For untrusted input, max_depth, max_nodes and max_bytes limit how
+            deep the tree may be, how many nodes it may have and how long buf
+            may be. Trees are never deeper than KEYSIZE*8 regardless. Input
+            is rejected as soon as it goes over a limit, so the work done
+            is never more than its length.
+
+            Raises DeserializationError if buf isn't a valid serialized tree
+            within the limits.
+            """
+            buf = memoryview(buf).toreadonly().cast('B')
+            if max_bytes is not None and len(buf) > max_bytes:
+                raise cls.DeserializationError('serialized tree is %d bytes; limit is %d' % (len(buf), max_bytes))
+            if not len(buf) or buf[0] != SERIALIZATION_VERSION:
+                raise cls.DeserializationError('unknown serialization version')
+
+            tree, pos = cls._mt_deserialize(buf, 1, max_depth=max_depth, max_nodes=max_nodes, arena=arena)
+            if pos != len(buf):
+                raise cls.DeserializationError('%d extra bytes after serialized tree' % (len(buf) - pos))
+            return cls._mt_interned(tree, intern)
+
+        @classmethod
+        def _mt_deserialize(cls, buf, pos, depth=0, check_paths=True, make_pruned_inner=None,
+                            max_depth=None, max_nodes=None, arena=False):
+            """Internal: deserialize one tree from buf starting at pos
+
+            Nodes are checked to be where the tree would have put them, so
+            the result is always a valid, if possibly pruned, tree. The tree
+            is a subtree at depth; leaf keys are only checked against the
+            path to them if check_paths is true, as the path above depth
+            isn't known.
+
+            make_pruned_inner(hash, depth), if given, is called instead of
+            PrunedInnerNodeClass for pruned inner nodes; it isn't supported
+            for sum trees.
+
+            max_depth, max_nodes and arena are as for deserialize().
+
+            Returns (tree, new_pos).
+            """
+            base_depth = depth
+            sumsize = cls.SUMSIZE
+            if make_pruned_inner is None:
+                make_pruned_inner = lambda pruned_hash, depth: cls.PrunedInnerNodeClass(pruned_hash)
+            elif sumsize is not None:
+                raise ValueError("Can't use make_pruned_inner with a sum tree")
+
+            keysize = cls.KEYSIZE
+            keybits = keysize * 8
+            if max_depth is None or max_depth > keybits:
+                max_depth = keybits
+            n_nodes = 0
+            hashsize = cls.HASHSIZE
+            empty_node = cls.EmptyNodeClass()
+            InnerNodeClass = cls.InnerNodeClass
+            LeafNodeClass = cls.LeafNodeClass
+            EmptyNodeClass = cls.EmptyNodeClass
+
+            # Inner nodes whose children are still being deserialized, as
+            # [prefix, left] pairs; prefix is the bits of the path to the
+            # inner node, and left is None until the left child is done.
+            stack = []
+            prefix = 0
+            try:
+                while True:
+                    depth = base_depth + len(stack)
+                    tag = buf[pos]
+                    pos += 1
+
+                    n_nodes += 1
+                    if max_nodes is not None and n_nodes > max_nodes:
+                        raise cls.DeserializationError('more than %d nodes' % max_nodes)
+
+                    if tag == TAG_INNER:
+                        if depth >= max_depth:
+                            raise cls.DeserializationError('tree deeper than %d levels' % max_depth)
+                        stack.append([prefix, None])
+                        # Left side first, which is the 1 side.
+                        prefix = prefix << 1 | 1
+                        continue
+
+                    elif tag == TAG_EMPTY:
+                        node = empty_node
+
+                    elif tag == TAG_PRUNED_INNER:
+                        if sumsize is None:
+                            if pos + hashsize > len(buf):
+                                raise IndexError
+                            node = make_pruned_inner(bytes(buf[pos:pos+hashsize]), depth)
+                            pos += hashsize
+                        else:
+                            if pos + hashsize + sumsize > len(buf):
+                                raise IndexError
+                            node_sum = int.from_bytes(buf[pos+hashsize:pos+hashsize+sumsize], 'big')
+                            node = cls.PrunedInnerNodeClass(bytes(buf[pos:pos+hashsize]), node_sum)
+                            pos += hashsize + sumsize
+
+                    elif tag == TAG_FULL_LEAF or tag == TAG_PRUNED_LEAF:
+                        if pos + keysize > len(buf):
+                            raise IndexError
+                        key_pos = pos
+                        key = buf[pos:pos+keysize]
+                        pos += keysize
+                        if (check_paths and depth
+                                and int.from_bytes(key, 'big') >> (keybits - depth) != prefix):
+                            raise cls.DeserializationError('leaf key %r in the wrong place' % bytes(key))
+                        if not (arena and tag == TAG_FULL_LEAF):
+                            key = bytes(key)
+
+                        if tag == TAG_FULL_LEAF:
+                            value_len, pos = _varint_decode(buf, pos)
+                            if pos + value_len > len(buf):
+                                raise IndexError
+                            if arena:
+                                node = cls.ArenaLeafNodeClass(buf, key_pos)
+                            else:
+                                value = cls.deserialize_value(buf[pos:pos+value_len])
+                                node = cls.FullLeafNodeClass(key, value)
+                            pos += value_len
+
+                        elif sumsize is None:
+                            if pos + hashsize > len(buf):
+                                raise IndexError
+                            node = cls.PrunedLeafNodeClass(key, bytes(buf[pos:pos+hashsize]))
+                            pos += hashsize
+
+                        else:
+                            if pos + hashsize + sumsize > len(buf):
+                                raise IndexError
+                            node_sum = int.from_bytes(buf[pos+hashsize:pos+hashsize+sumsize], 'big')
+                            node = cls.PrunedLeafNodeClass(key, bytes(buf[pos:pos+hashsize]), node_sum)
+                            pos += hashsize + sumsize
+
+                    else:
+                        raise cls.DeserializationError('unknown node tag %r' % tag)
+
+                    # Attach the finished node to its parent, finishing the
+                    # parent too if this was its right child, and so on.
+                    while stack:
+                        frame = stack[-1]
+                        if frame[1] is None:
+                            frame[1] = node
+                            prefix = frame[0] << 1
+                            break
+
+                        left = frame[1]
+                        stack.pop()
+                        if ((isinstance(left, EmptyNodeClass) and isinstance(node, (EmptyNodeClass, LeafNodeClass)))
+                                or (isinstance(node, EmptyNodeClass) and isinstance(left, LeafNodeClass))):
+                            raise cls.DeserializationError('inner node that should have been collapsed')
+                        node = InnerNodeClass(left, node)
+
+                    else:
+                        return (node, pos)
+
+            except IndexError:
+                raise cls.DeserializationError('serialized tree truncated')
+            except ValueError as err:
+                if isinstance(err, cls.DeserializationError):
+                    raise
+                raise cls.DeserializationError(str(err))
+
     return MerbinnerTree
 
 def make_MerbinnerTree_class(treecls):
     treecls._mt_baseclass = treecls
+
+    # Sum trees keep a sum in inner nodes, cached, and pruned nodes, where
+    # it's part of what they stand in for. Other trees don't pay for the slot.
+    sums = treecls.SUMSIZE is not None
+    sum_slots = ['_mt_cached_sum'] if sums else []
+
+    # Likewise only trees that are interned pay for weak references to the
+    # nodes an InternTable keeps; basecls may already have made them
+    # possible.
+    weakref_slots = ['__weakref__'] if treecls.WEAKREFS and not treecls.__weakrefoffset__ else []
     class MerbinnerTreeEmptyNodeClass(treecls):
         __slots__ = []
 
@@ -244,7 +1724,7 @@ def make_MerbinnerTree_class(treecls):
             # keys.
             return self
 
-        def _mt_put_keys(self, changed_keys, items, depth, prove):
+        def _mt_put_keys(self, old_leaves, items, depth, prove):
             # There's no keys in this part of the tree, so any non-empty items
             # can be simply passed to _mt_from_leaf_nodes() to create a new
             # tree populated with them. Empty items meanwhile indicate that the
@@ -255,7 +1735,7 @@ def make_MerbinnerTree_class(treecls):
             # Remember that the EmptyNodeClass is a singleton.
             for key, node in items:
                 if node is not self:
-                    changed_keys.add(key)
+                    old_leaves[key] = None
                     leaf_nodes.append(node)
 
             # _mt_from_leaf_nodes() handles the empty and len(leaf_nodes) == 1
@@ -275,13 +1755,22 @@ def make_MerbinnerTree_class(treecls):
         def _mt_merge(self, tree, depth):
             return tree
 
+        def _mt_count(self):
+            return 0
+
+        def _mt_sum(self):
+            return 0
+
+        def __bool__(self):
+            return False
+
         def calc_hash_data(self):
             """Calculate the data that is hashed to produce the node hash"""
             return b'\x00'
     treecls.EmptyNodeClass = MerbinnerTreeEmptyNodeClass
 
     class MerbinnerTreeInnerNodeClass(treecls):
-        __slots__ = ['left', 'right']
+        __slots__ = ['left', 'right', '_mt_cached_count'] + sum_slots + weakref_slots
         def __new__(cls, left, right):
             # Ensure attempts to create deeper than necessary inner nodes fail
             # and instead return the depth-optimized version instead.
@@ -292,6 +1781,9 @@ def make_MerbinnerTree_class(treecls):
                 return left
 
             # Ensure that if left and right are leaf nodes they are on the correct sides
+            #
+            # This orders the keys, which memoryviews can't do, so it uses key
+            # rather than _mt_key_view(); it goes away with python -O.
             assert (not (isinstance(left, cls.LeafNodeClass) and isinstance(right, cls.LeafNodeClass))
                     or left.key > right.key)
 
@@ -300,9 +1792,21 @@ def make_MerbinnerTree_class(treecls):
             object.__setattr__(self, 'right', right)
             return self
 
-        def calc_hash_data(self):
-            """Calculate the data that is hashed to produce the node hash"""
-            return self.left.hash + self.right.hash + b'\x01'
+        if sums:
+            def calc_hash_data(self):
+                """Calculate the data that is hashed to produce the node hash
+
+                Inner nodes of sum trees commit to the sums of both children,
+                so that the sum of a pruned child is committed to as well.
+                """
+                return b''.join((self.left._mt_sum().to_bytes(self.SUMSIZE, 'big'),
+                                 self.right._mt_sum().to_bytes(self.SUMSIZE, 'big'),
+                                 self.left.hash, self.right.hash, b'\x01'))
+
+        else:
+            def calc_hash_data(self):
+                """Calculate the data that is hashed to produce the node hash"""
+                return b''.join((self.left.hash, self.right.hash, b'\x01'))
 
         @classmethod
         def _mt_from_leaf_nodes(cls, leaf_nodes, depth):
@@ -326,6 +1830,84 @@ def make_MerbinnerTree_class(treecls):
             else:
                 return cls.EmptyNodeClass()
 
+        @classmethod
+        def _mt_wrap(cls, node, key, node_depth, depth):
+            """Internal: move an inner node up the tree to depth
+
+            node is the inner node that splits on bit node_depth of key; inner
+            nodes with empty siblings are added above it until it can be used
+            as a node at depth. Leaf nodes, node_depth=None, need no wrapping.
+            """
+            if node_depth is not None:
+                for wrap_depth in range(node_depth-1, depth-1, -1):
+                    if cls.key_side(key, wrap_depth):
+                        node = cls.InnerNodeClass(node, cls.EmptyNodeClass())
+                    else:
+                        node = cls.InnerNodeClass(cls.EmptyNodeClass(), node)
+            return node
+
+        @classmethod
+        def _mt_from_sorted_leaf_nodes(cls, leaf_nodes, depth):
+            """Internal: create a tree from leaf nodes sorted in tree order
+
+            Single-pass equivalent of _mt_from_leaf_nodes(). The bit that two
+            adjacent keys first differ in is the depth of the inner node that
+            splits them, so every finished left subtree waits on a stack along
+            with the depth of its parent until a key with a shallower split
+            shows up.
+            """
+            keybits = cls.KEYSIZE * 8
+
+            # (split_depth, left_node) pairs, split_depth strictly increasing
+            stack = []
+            cur_node = None
+            cur_depth = None
+            prev_key = None
+            prev_key_int = None
+
+            for leaf_node in leaf_nodes:
+                key = leaf_node.key
+                key_int = int.from_bytes(key, 'big')
+
+                if cur_node is None:
+                    cur_node = leaf_node
+                    prev_key = key
+                    prev_key_int = key_int
+                    continue
+
+                if key_int >= prev_key_int:
+                    if key_int == prev_key_int:
+                        raise ValueError('duplicate key %r' % key)
+                    raise ValueError('keys not in tree order: %r follows %r' % (key, prev_key))
+
+                split_depth = keybits - (key_int ^ prev_key_int).bit_length()
+                if split_depth < depth:
+                    raise ValueError('key %r does not belong in a subtree at depth %d' % (key, depth))
+
+                # Everything deeper than the new split is finished.
+                while stack and stack[-1][0] > split_depth:
+                    left_depth, left_node = stack.pop()
+                    right_node = cls._mt_wrap(cur_node, prev_key, cur_depth, left_depth+1)
+                    cur_node = cls.InnerNodeClass(left_node, right_node)
+                    cur_depth = left_depth
+
+                stack.append((split_depth, cls._mt_wrap(cur_node, prev_key, cur_depth, split_depth+1)))
+                cur_node = leaf_node
+                cur_depth = None
+                prev_key = key
+                prev_key_int = key_int
+
+            if cur_node is None:
+                return cls.EmptyNodeClass()
+
+            while stack:
+                left_depth, left_node = stack.pop()
+                right_node = cls._mt_wrap(cur_node, prev_key, cur_depth, left_depth+1)
+                cur_node = cls.InnerNodeClass(left_node, right_node)
+                cur_depth = left_depth
+
+            return cls._mt_wrap(cur_node, prev_key, cur_depth, depth)
+
         def _mt_get_keys(self, result, keys, depth, prove):
             if len(keys):
                 left_keys = []
@@ -348,9 +1930,9 @@ def make_MerbinnerTree_class(treecls):
                         return self
 
             elif prove:
-                return self.PrunedInnerNodeClass(self.hash)
+                return self._mt_pruned()
 
-        def _mt_put_keys(self, changed_keys, items, depth, prove):
+        def _mt_put_keys(self, old_leaves, items, depth, prove):
             if len(items):
                 # Split items up into left and right
                 left_items = []
@@ -363,8 +1945,8 @@ def make_MerbinnerTree_class(treecls):
 
                 # Our left and right sides can now recursively handle left and
                 # right items
-                new_left_node, pruned_left_node = self.left._mt_put_keys(changed_keys, left_items, depth+1, prove)
-                new_right_node, pruned_right_node = self.right._mt_put_keys(changed_keys, right_items, depth+1, prove)
+                new_left_node, pruned_left_node = self.left._mt_put_keys(old_leaves, left_items, depth+1, prove)
+                new_right_node, pruned_right_node = self.right._mt_put_keys(old_leaves, right_items, depth+1, prove)
 
                 # It's possible nothing has changed if the callee was trying to
                 # remove items that aren't present in the tree. Check for that
@@ -379,6 +1961,8 @@ def make_MerbinnerTree_class(treecls):
                     # unchanged.
                     if pruned_left_node is not self.left or pruned_right_node is not self.right:
                         pruned_node = self.InnerNodeClass(pruned_left_node, pruned_right_node)
+                    else:
+                        pruned_node = self
 
                 return (new_node, pruned_node)
 
@@ -388,50 +1972,124 @@ def make_MerbinnerTree_class(treecls):
                     # No items were changed, which means the minimum
                     # information to prove that is the pruned version of
                     # ourselves.
-                    pruned_node = self.PrunedInnerNodeClass(self.hash)
+                    pruned_node = self._mt_pruned()
 
                 return (self, pruned_node)
 
+        def _mt_merged_inner(self, nodes, left, right):
+            """Internal: inner node with the given children, equivalent to nodes
+
+            Reuses whichever of nodes already has those children.
+            """
+            for node in nodes:
+                if node.left is left and node.right is right:
+                    return node
+
+            new_node = self.InnerNodeClass(left, right)
+            try:
+                object.__setattr__(new_node, '_mt_cached_hash', self._mt_cached_hash)
+            except AttributeError:
+                pass
+            return new_node
+
         def _mt_update(self, tree, depth):
-            raise NotImplementedError
+            if tree is self or isinstance(tree, self.EmptyNodeClass):
+                return self
+            try:
+                if self._mt_cached_hash == tree._mt_cached_hash:
+                    return self
+            except AttributeError:
+                pass
+
+            if isinstance(tree, self.LazyInnerNodeClass):
+                tree = tree._mt_load()
+
+            if isinstance(tree, self.InnerNodeClass):
+                left = self.left._mt_update(tree.left, depth+1)
+                right = self.right._mt_update(tree.right, depth+1)
+                for node in (self, tree):
+                    if node.left is left and node.right is right:
+                        return node
+                return self.InnerNodeClass(left, right)
+
+            elif isinstance(tree, self.LeafNodeClass):
+                new_tree, pruned_tree = self._mt_put_keys({}, [(tree.key, tree)], depth, False)
+                return new_tree
+
+            else:
+                assert isinstance(tree, self.PrunedInnerNodeClass)
+                if self.hash == tree.hash:
+                    return self
+                raise self.PrunedError('update', None, depth)
 
         def _mt_merge(self, tree, depth):
-            raise NotImplementedError
+            if tree is self or isinstance(tree, self.PrunedInnerNodeClass):
+                return self
+            elif isinstance(tree, self.LazyInnerNodeClass):
+                return tree
+
+            left = self.left._mt_merge(tree.left, depth+1)
+            right = self.right._mt_merge(tree.right, depth+1)
+            return self._mt_merged_inner((self, tree), left, right)
 
         def _mt_iter_nodes(self):
             yield from self.left._mt_iter_nodes()
             yield from self.right._mt_iter_nodes()
             yield self
 
+        def _mt_count(self):
+            try:
+                return self._mt_cached_count
+            except AttributeError:
+                object.__setattr__(self, '_mt_cached_count', self.left._mt_count() + self.right._mt_count())
+                return self._mt_cached_count
+
+        def _mt_sum(self):
+            try:
+                return self._mt_cached_sum
+            except AttributeError:
+                object.__setattr__(self, '_mt_cached_sum', self.left._mt_sum() + self.right._mt_sum())
+                return self._mt_cached_sum
 
 
     treecls.InnerNodeClass = MerbinnerTreeInnerNodeClass
 
     class MerbinnerTreePrunedInnerNodeClass(treecls):
-        __slots__ = []
-        def __new__(cls, pruned_hash):
+        __slots__ = sum_slots + weakref_slots
+        def __new__(cls, pruned_hash, pruned_sum=None):
             self = object.__new__(cls)
             object.__setattr__(self, '_mt_cached_hash', pruned_hash)
+            if sums:
+                # Nothing else could tell us the sum of what was pruned.
+                if pruned_sum is None:
+                    raise TypeError('pruned nodes of sum trees need a sum')
+                object.__setattr__(self, '_mt_cached_sum', pruned_sum)
             return self
 
-        def _mt_get_keys(self, result, keys, depth, ignore_missing=False, prove=False):
+        def _mt_sum(self):
+            return self._mt_cached_sum
+
+        def _mt_get_keys(self, result, keys, depth, prove):
             if len(keys):
-                raise self.PrunedError('get', key, depth)
+                raise self.PrunedError('get', keys[0], depth)
             else:
                 return self
 
-        def _mt_put_keys(self, changed_keys, items, depth, prove):
+        def _mt_count(self):
+            raise self.PrunedError('count', None, None)
+
+        def _mt_put_keys(self, old_leaves, items, depth, prove):
             if len(items):
                 # We're pruned, so we don't have the information necessary to
                 # change anything in this part of the tree.
-                raise self.PrunedError('set', key, depth)
+                raise self.PrunedError('set', items[0][0], depth)
 
             else:
                 # However we do have the information necessary to do nothing.
                 return (self, self)
 
         def _mt_update(self, tree, depth):
-            if self.hash == tree.hash:
+            if isinstance(tree, self.EmptyNodeClass) or self.hash == tree.hash:
                 # Updating with a tree that is equivalent to us. Return self so
                 # that we don't unnecessarily increase the infromation stored
                 # in the tree by updating. (the other tree may be less pruned
@@ -439,8 +2097,9 @@ def make_MerbinnerTree_class(treecls):
                 return self
 
             else:
-                # FIXME: what should key be here?
-                raise self.PrunedError('update', key, depth)
+                # Whatever the other tree has needs to go somewhere in the
+                # part of the tree we've pruned.
+                raise self.PrunedError('update', getattr(tree, 'key', None), depth)
 
         def _mt_merge(self, tree, depth):
             if not isinstance(tree, MerbinnerTreePrunedInnerNodeClass):
@@ -453,20 +2112,97 @@ def make_MerbinnerTree_class(treecls):
                 return self
     treecls.PrunedInnerNodeClass = MerbinnerTreePrunedInnerNodeClass
 
+    class MerbinnerTreeLazyInnerNodeClass(treecls):
+        """Inner node that is loaded from a node store when needed
+
+        Like a pruned inner node, only the hash is kept in memory, but
+        anything that needs the contents loads them from the store instead of
+        raising PrunedError. Only inner nodes are ever lazy, as whether or not
+        a leaf is collapsed into its parent depends on it being a leaf.
+        """
+        __slots__ = ['_mt_store', '_mt_depth']
+        def __new__(cls, node_hash, store, depth):
+            self = object.__new__(cls)
+            object.__setattr__(self, '_mt_cached_hash', node_hash)
+            object.__setattr__(self, '_mt_store', store)
+            object.__setattr__(self, '_mt_depth', depth)
+            return self
+
+        def _mt_load(self):
+            """Internal: load the inner node this stands in for"""
+            return self._mt_store.load_node(self._mt_cached_hash, self._mt_depth)
+
+        @property
+        def left(self):
+            return self._mt_load().left
+
+        @property
+        def right(self):
+            return self._mt_load().right
+
+        def calc_hash_data(self):
+            return self._mt_load().calc_hash_data()
+
+        def _mt_get_keys(self, result, keys, depth, prove):
+            if len(keys):
+                return self._mt_load()._mt_get_keys(result, keys, depth, prove)
+            elif prove:
+                return self._mt_pruned()
+
+        def _mt_put_keys(self, old_leaves, items, depth, prove):
+            if len(items):
+                return self._mt_load()._mt_put_keys(old_leaves, items, depth, prove)
+            else:
+                pruned_node = None
+                if prove:
+                    pruned_node = self._mt_pruned()
+                return (self, pruned_node)
+
+        def _mt_update(self, tree, depth):
+            if tree is self or isinstance(tree, self.EmptyNodeClass):
+                return self
+            return self._mt_load()._mt_update(tree, depth)
+
+        def _mt_merge(self, tree, depth):
+            # Everything under us can be loaded, so there's nothing to add.
+            return self
+
+        def _mt_iter_nodes(self):
+            return self._mt_load()._mt_iter_nodes()
+
+        def _mt_count(self):
+            return self._mt_load()._mt_count()
+
+        def _mt_sum(self):
+            return self._mt_load()._mt_sum()
+    treecls.LazyInnerNodeClass = MerbinnerTreeLazyInnerNodeClass
+
     class MerbinnerTreeLeafNodeClass(treecls):
-        __slots__ = ['key']
+        __slots__ = ['key'] + weakref_slots
+
+        def _mt_count(self):
+            return 1
+
+        def _mt_key_view(self):
+            """Internal: our key, as any bytes-like object
+
+            Compare keys with this rather than key, which arena leaves have
+            to make from their buffer.
+            """
+            return self.key
 
         def _mt_get_keys_common(self, result, keys, depth, prove):
             found_match = False
+            key_view = self._mt_key_view()
             for key in keys:
-                if self.key == key:
+                if key_view == key:
                     found_match = True
                     result[key] = self
                     break
 
             return found_match
 
-        def _mt_put_keys(self, changed_keys, items, depth, prove):
+        def _mt_put_keys(self, old_leaves, items, depth, prove):
             # Similar to the EmptyNode implementation, we can let
             # _mt_from_leaf_nodes() do all the real work.
 
@@ -474,17 +2210,28 @@ def make_MerbinnerTree_class(treecls):
             # the tree can be filtered out of items as those keys obviously
             # don't exist.
             add_ourself = True
+            key_view = self._mt_key_view()
             leaf_nodes = []
             for key, new_node in items:
                 # If our key is present in items we're being modified, so we
                 # don't want to add ourselves to the list of leaf_nodes
-                if add_ourself and self.key == key:
-                    # This does however mean that our key is now changed.
-                    changed_keys.add(key)
+                if add_ourself and key_view == key:
                     add_ourself = False
 
+                    # Unless we're being set to the value we already have, in
+                    # which case nothing changes.
+                    if (isinstance(self, self.FullLeafNodeClass) and
+                            isinstance(new_node, self.FullLeafNodeClass) and
+                            self.value == new_node.value):
+                        leaf_nodes.append(self)
+                        continue
+
+                    old_leaves[key] = self
+
+                elif not isinstance(new_node, self.EmptyNodeClass):
+                    old_leaves[key] = None
+
                 if not isinstance(new_node, self.EmptyNodeClass):
-                    changed_keys.add(key)
                     leaf_nodes.append(new_node)
 
             if add_ourself:
@@ -499,7 +2246,7 @@ def make_MerbinnerTree_class(treecls):
             if prove:
                 # The pruned version of this node is the information necessary
                 # to perform this put operation.
-                if isinstance(pruned_tree, self.FullLeafNodeClass):
+                if isinstance(self, self.FullLeafNodeClass):
                     pruned_tree = self.PrunedLeafNodeClass.from_FullLeafNode(self)
                 else:
                     pruned_tree = self
@@ -507,16 +2254,21 @@ def make_MerbinnerTree_class(treecls):
             return (new_tree, pruned_tree)
 
         def _mt_update(self, tree, depth):
-            if self.hash == tree.hash:
+            if tree is self or isinstance(tree, self.EmptyNodeClass) or self.hash == tree.hash:
                 # Updating with a tree that is equivalent to us. Return self so
                 # that we don't unnecessarily increase the infromation stored
                 # in the tree by updating. (the other tree may be less pruned
                 # than we are)
                 return self
 
-            else:
-                # FIXME: what should key be here?
-                raise self.PrunedError('update', key, depth)
+            # The other tree's value wins if it has our key; otherwise we're
+            # added to it.
+            result = {}
+            tree._mt_get_keys(result, (self.key,), depth, False)
+            if self.key in result:
+                return tree
+            new_tree, pruned_tree = tree._mt_put_keys({}, [(self.key, self)], depth, False)
+            return new_tree
 
     treecls.LeafNodeClass = MerbinnerTreeLeafNodeClass
 
@@ -545,23 +2297,84 @@ def make_MerbinnerTree_class(treecls):
             # do, so return self to avoid unnecessarily creating extra objects.
             return self
 
-        def calc_hash_data(self):
-            return self.calc_value_hash(self.value) + self.key + b'\x02'
+        def _mt_sum(self):
+            return self.calc_value_sum(self.value)
+
+        def _mt_serialized_value(self):
+            """Internal: the value serialized, as any bytes-like object"""
+            return self.serialize_value(self.value)
+
+        if sums:
+            def calc_hash_data(self):
+                # Leaves of sum trees commit to their own sum too, which
+                # matters for a tree that's a single leaf.
+                return b''.join((self._mt_sum().to_bytes(self.SUMSIZE, 'big'),
+                                 self.calc_value_hash(self.value), self.key, b'\x02'))
+
+        else:
+            def calc_hash_data(self):
+                return self.calc_value_hash(self.value) + self.key + b'\x02'
 
     treecls.FullLeafNodeClass = MerbinnerTreeFullLeafNodeClass
 
+    class MerbinnerTreeArenaLeafNodeClass(MerbinnerTreeFullLeafNodeClass):
+        """Full leaf whose key and value stay in a shared buffer
+
+        Only the buffer, a memoryview, and where the serialized leaf starts
+        in it are kept; see deserialize(). key and value are made from the
+        buffer each time they're read, while hashing and serialization use
+        it directly.
+        """
+        __slots__ = ['_mt_arena', '_mt_pos']
+        def __new__(cls, arena, pos):
+            self = object.__new__(cls)
+            object.__setattr__(self, '_mt_arena', arena)
+            object.__setattr__(self, '_mt_pos', pos)
+            return self
+
+        def _mt_key_view(self):
+            return self._mt_arena[self._mt_pos:self._mt_pos+self.KEYSIZE]
+
+        def _mt_serialized_value(self):
+            value_len, pos = _varint_decode(self._mt_arena, self._mt_pos + self.KEYSIZE)
+            return self._mt_arena[pos:pos+value_len]
+
+        @property
+        def key(self):
+            return bytes(self._mt_key_view())
+
+        @property
+        def value(self):
+            return self.deserialize_value(self._mt_serialized_value())
+
+        if not sums:
+            def calc_hash_data(self):
+                return b''.join((self.calc_serialized_value_hash(self._mt_serialized_value()),
+                                 self._mt_key_view(), b'\x02'))
+
+    treecls.ArenaLeafNodeClass = MerbinnerTreeArenaLeafNodeClass
+
     class MerbinnerTreePrunedLeafNodeClass(MerbinnerTreeLeafNodeClass):
-        __slots__ = ['value_hash']
-        def __new__(cls, key, value_hash):
+        __slots__ = ['value_hash'] + sum_slots
+        def __new__(cls, key, value_hash, value_sum=None):
             self = object.__new__(cls)
             object.__setattr__(self, 'key', key)
             object.__setattr__(self, 'value_hash', value_hash)
+            if sums:
+                if value_sum is None:
+                    raise TypeError('pruned nodes of sum trees need a sum')
+                object.__setattr__(self, '_mt_cached_sum', value_sum)
             return self
 
         @classmethod
         def from_FullLeafNode(cls, full_leaf_node):
+            if sums:
+                return cls(full_leaf_node.key, cls.calc_value_hash(full_leaf_node.value), full_leaf_node._mt_sum())
             return cls(full_leaf_node.key, cls.calc_value_hash(full_leaf_node.value))
 
+        def _mt_sum(self):
+            return self._mt_cached_sum
+
         def _mt_get_keys(self, result, keys, depth, prove):
             self._mt_get_keys_common(result, keys, depth, prove)
 
@@ -584,25 +2397,121 @@ def make_MerbinnerTree_class(treecls):
                 # unnecessarily.
                 return self
 
-        def calc_hash_data(self):
-            return self.value_hash + self.key + b'\x02'
+        if sums:
+            def calc_hash_data(self):
+                return b''.join((self._mt_sum().to_bytes(self.SUMSIZE, 'big'),
+                                 self.value_hash, self.key, b'\x02'))
+
+        else:
+            def calc_hash_data(self):
+                return b''.join((self.value_hash, self.key, b'\x02'))
 
 
     treecls.PrunedLeafNodeClass = MerbinnerTreePrunedLeafNodeClass
 
     return treecls
 
+def _external_sort(items, max_chunk_size, tmpdir=None):
+    """Sort (key, value) items into tree order, spilling to disk
 
-@make_MerbinnerTree_class
-class SHA256MerbinnerTree(make_MerbinnerTree_baseclass()):
+    Generator; chunks of up to max_chunk_size items are sorted in memory and
+    written to temporary files, which are merged as the result is consumed.
+    """
+    sort_key = operator.itemgetter(0)
+
+    def read_chunk(chunk_file):
+        chunk_file.seek(0)
+        unpickler = pickle.Unpickler(chunk_file)
+        while True:
+            try:
+                yield unpickler.load()
+            except EOFError:
+                return
+
+    chunk_files = []
+    try:
+        items = iter(items)
+        while True:
+            chunk = []
+            for item in items:
+                chunk.append(item)
+                if len(chunk) >= max_chunk_size:
+                    break
+
+            if not chunk:
+                break
+
+            chunk.sort(key=sort_key, reverse=True)
+            if not chunk_files and len(chunk) < max_chunk_size:
+                # Everything fit in one chunk; no need to touch the disk.
+                yield from chunk
+                return
+
+            chunk_file = tempfile.TemporaryFile(dir=tmpdir)
+            chunk_files.append(chunk_file)
+            pickler = pickle.Pickler(chunk_file, pickle.HIGHEST_PROTOCOL)
+            for item in chunk:
+                pickler.dump(item)
+                pickler.clear_memo()
+            del chunk
+
+        yield from heapq.merge(*[read_chunk(chunk_file) for chunk_file in chunk_files],
+                               key=sort_key, reverse=True)
+
+    finally:
+        for chunk_file in chunk_files:
+            chunk_file.close()
+
+def _build_shard(treecls, items, depth, hash_only):
+    """Build and hash one shard for from_items_parallel()
+
+    Runs in a worker process. Returns the shard's subtree in compact form.
+    """
+    items.sort(key=operator.itemgetter(0), reverse=True)
+
+    def leaf_nodes():
+        for key, value in items:
+            treecls.check_value(value)
+            yield treecls.FullLeafNodeClass(key, value)
+
+    tree = treecls.InnerNodeClass._mt_from_sorted_leaf_nodes(leaf_nodes(), depth)
+    tree.compute_hashes()
+    return tree._mt_to_compact(hash_only)
+
+
+class _BytesMerbinnerTree(make_MerbinnerTree_baseclass()):
+    """Base for trees with 32 byte keys and hashes, and bytes values
+
+    Concrete tree classes add hash_func() and calc_value_hash(), and are
+    made with make_MerbinnerTree_class().
+    """
     __slots__ = []
     KEYSIZE = 32
+    HASHSIZE = 32
 
     @classmethod
     def check_value(cls, value):
         if not isinstance(value, bytes):
             raise TypeError('value must be bytes instance; got %r instead' % value.__class__)
 
+    @classmethod
+    def serialize_value(cls, value):
+        return value
+
+    @classmethod
+    def deserialize_value(cls, buf):
+        return bytes(buf)
+
+    @classmethod
+    def calc_serialized_value_hash(cls, buf):
+        # Values are serialized as-is.
+        return cls.calc_value_hash(buf)
+
+
+@make_MerbinnerTree_class
+class SHA256MerbinnerTree(_BytesMerbinnerTree):
+    __slots__ = []
+
     @staticmethod
     def hash_func(data):
         return hashlib.sha256(data).digest()
@@ -610,3 +2519,42 @@ class SHA256MerbinnerTree(make_MerbinnerTree_baseclass()):
     @staticmethod
     def calc_value_hash(value):
         return hashlib.sha256(value).digest()
+
+
+@make_MerbinnerTree_class
+class BLAKE2bMerbinnerTree(_BytesMerbinnerTree):
+    """Tree hashed with BLAKE2b, truncated to 32 byte digests"""
+    __slots__ = []
+
+    @staticmethod
+    def hash_func(data):
+        return hashlib.blake2b(data, digest_size=32).digest()
+
+    @staticmethod
+    def calc_value_hash(value):
+        return hashlib.blake2b(value, digest_size=32).digest()
+
+
+@make_MerbinnerTree_class
+class BLAKE2sMerbinnerTree(_BytesMerbinnerTree):
+    """Tree hashed with BLAKE2s, whose digests are 32 bytes to begin with"""
+    __slots__ = []
+
+    @staticmethod
+    def hash_func(data):
+        return hashlib.blake2s(data).digest()
+
+    @staticmethod
+    def calc_value_hash(value):
+        return hashlib.blake2s(value).digest()
+
+
+@make_MerbinnerTree_class
+class LegacySHA256MerbinnerTree(SHA256MerbinnerTree):
+    """SHA256MerbinnerTree with version 0 node hashes
+
+    For checking and migrating roots calculated before node hash data was
+    hashed.
+    """
+    __slots__ = []
+    HASH_SCHEME = HASH_SCHEME_V0
@@ -0,0 +1,198 @@
+# Copyright (C) 2014 Peter Todd <pete@petertodd.org>
+#
+# This file is part of python-merbinnertree.
+#
+# It is subject to the license terms in the LICENSE file found in the top-level
+# directory of this distribution.
+#
+# No part of python-merbinnertree, including this file, may be copied,
+# modified, propagated, or distributed except according to the terms contained
+# in the LICENSE file.
+
+"""Root hash calculation over arrays of keys, without creating nodes
+
+Uses NumPy, which is otherwise not a dependency of this library, if it's
+available; without it a pure-Python version of the same calculation is used.
+"""
+
+def _leading_zeros_table(np):
+    return np.array([8 - i.bit_length() for i in range(256)], dtype=np.int64)
+
+def root_hash_of(treecls, keys, value_hashes):
+    """Calculate the root hash of a tree with the given contents
+
+    keys and value_hashes are N x KEYSIZE and N x (value hash size) uint8
+    arrays, or anything numpy.asarray() turns into one; row i of value_hashes
+    is calc_value_hash() of the value for the key in row i. Rows may be in any
+    order. Without NumPy they can be any sequences of bytes-like rows.
+
+    The result is the same as treecls(items).hash, but no node objects are
+    created: the bit where each pair of adjacent keys (in tree order) first
+    differs is the depth of the inner node splitting them, so the tree can be
+    hashed a level at a time, deepest first.
+    """
+    if treecls.SUMSIZE is not None:
+        raise ValueError("Can't hash sum trees from arrays")
+
+    try:
+        import numpy as np
+    except ImportError:
+        return _root_hash_of_rows(treecls, [bytes(row) for row in keys], [bytes(row) for row in value_hashes])
+
+    keys = np.ascontiguousarray(keys, dtype=np.uint8)
+    value_hashes = np.ascontiguousarray(value_hashes, dtype=np.uint8)
+
+    if keys.ndim != 2 or keys.shape[1] != treecls.KEYSIZE:
+        raise ValueError('keys must be an N x %d array; got shape %r' % (treecls.KEYSIZE, keys.shape))
+    if value_hashes.ndim != 2 or value_hashes.shape[0] != keys.shape[0]:
+        raise ValueError('value_hashes must be an N x M array with one row per key; got shape %r' %
+                         (value_hashes.shape,))
+
+    n = keys.shape[0]
+    empty_hash = treecls.EmptyNodeClass().hash
+    if n == 0:
+        return empty_hash
+
+    # Sort into tree order, descending, with the first byte as the primary key.
+    order = np.lexsort(keys.T[::-1])[::-1]
+    keys = keys[order]
+    value_hashes = value_hashes[order]
+
+    # Leaf hash data, all in one go.
+    leaf_width = value_hashes.shape[1] + keys.shape[1] + 1
+    leaf_rows = np.empty((n, leaf_width), dtype=np.uint8)
+    leaf_rows[:, :value_hashes.shape[1]] = value_hashes
+    leaf_rows[:, value_hashes.shape[1]:-1] = keys
+    leaf_rows[:, -1] = 2
+    leaf_data = leaf_rows.tobytes()
+    calc_hashes = treecls.calc_hashes
+    hashes = calc_hashes([leaf_data[i:i+leaf_width] for i in range(0, n*leaf_width, leaf_width)])
+
+    def key_bits(positions, depth):
+        return (keys[positions, depth // 8] >> (7 - depth % 8)) & 1
+
+    # Depth of the node at each segment start; -1 for a leaf.
+    node_depth = np.full(n, -1, dtype=np.int64)
+
+    def wrap(positions, depth):
+        """Add empty-sibling inner nodes above the given segments up to depth"""
+        depths = node_depth[positions]
+        for wrap_depth in range(int(depths.max()) - 1, depth - 1, -1):
+            active = positions[depths > wrap_depth].tolist()
+            if not active:
+                continue
+            hash_datas = []
+            for pos, bit in zip(active, key_bits(active, wrap_depth).tolist()):
+                if bit:
+                    hash_datas.append(hashes[pos] + empty_hash + b'\x01')
+                else:
+                    hash_datas.append(empty_hash + hashes[pos] + b'\x01')
+            for pos, node_hash in zip(active, calc_hashes(hash_datas)):
+                hashes[pos] = node_hash
+
+    if n > 1:
+        # Split depth between each pair of adjacent keys.
+        diff = keys[:-1] ^ keys[1:]
+        nonzero = diff != 0
+        if not nonzero.any(axis=1).all():
+            dup = int(np.nonzero(~nonzero.any(axis=1))[0][0])
+            raise ValueError('duplicate key %r' % keys[dup].tobytes())
+        first_byte = nonzero.argmax(axis=1)
+        split_depths = first_byte * 8 + _leading_zeros_table(np)[diff[np.arange(n-1), first_byte]]
+
+        # Adjacent segments of items, tracked by their start and end indexes.
+        seg_start = np.arange(n)
+        seg_end = np.arange(n)
+
+        # Group splits by depth, deepest first. Splits at the same depth
+        # never share a segment, so each group can be merged as a batch.
+        by_depth = np.argsort(-split_depths, kind='stable')
+        sorted_depths = -split_depths[by_depth]
+        for depth in np.unique(split_depths)[::-1].tolist():
+            lo = np.searchsorted(sorted_depths, -depth, side='left')
+            hi = np.searchsorted(sorted_depths, -depth, side='right')
+            splits = by_depth[lo:hi]
+
+            left_starts = seg_start[splits]
+            right_starts = splits + 1
+            right_ends = seg_end[right_starts]
+
+            wrap(left_starts, depth+1)
+            wrap(right_starts, depth+1)
+            left_starts_list = left_starts.tolist()
+            hash_datas = [hashes[left] + hashes[right] + b'\x01'
+                          for left, right in zip(left_starts_list, right_starts.tolist())]
+            for left, node_hash in zip(left_starts_list, calc_hashes(hash_datas)):
+                hashes[left] = node_hash
+
+            node_depth[left_starts] = depth
+            seg_end[left_starts] = right_ends
+            seg_start[right_ends] = left_starts
+
+    root = np.zeros(1, dtype=np.int64)
+    wrap(root, 0)
+    return hashes[0]
+
+def _root_hash_of_rows(treecls, keys, value_hashes):
+    """Pure-Python root_hash_of(), for when NumPy isn't available
+
+    keys and value_hashes are lists of bytes. The same split depths between
+    adjacent keys are used, but the tree is hashed a node at a time rather
+    than a level at a time.
+    """
+    n = len(keys)
+    for key in keys:
+        if len(key) != treecls.KEYSIZE:
+            raise ValueError('keys must be %d bytes each; got %r' % (treecls.KEYSIZE, key))
+    if len(value_hashes) != n or len(set(map(len, value_hashes))) > 1:
+        raise ValueError('value_hashes must be one equal length row per key')
+
+    empty_hash = treecls.EmptyNodeClass().hash
+    if n == 0:
+        return empty_hash
+
+    # Sort into tree order, descending.
+    order = sorted(range(n), key=keys.__getitem__, reverse=True)
+    keys = [keys[i] for i in order]
+    value_hashes = [value_hashes[i] for i in order]
+
+    calc_hashes = treecls.calc_hashes
+    hashes = calc_hashes([value_hash + key + b'\x02' for key, value_hash in zip(keys, value_hashes)])
+
+    keybits = treecls.KEYSIZE * 8
+    key_ints = [int.from_bytes(key, 'big') for key in keys]
+
+    # Split depth between each pair of adjacent keys.
+    split_depths = []
+    for i in range(n - 1):
+        diff = key_ints[i] ^ key_ints[i+1]
+        if not diff:
+            raise ValueError('duplicate key %r' % keys[i])
+        split_depths.append(keybits - diff.bit_length())
+
+    def wrap(node_hash, node_depth, key_int, depth):
+        """Add empty-sibling inner nodes above a node up to depth"""
+        for wrap_depth in range(node_depth - 1, depth - 1, -1):
+            if key_int >> (keybits - 1 - wrap_depth) & 1:
+                hash_data = node_hash + empty_hash + b'\x01'
+            else:
+                hash_data = empty_hash + node_hash + b'\x01'
+            node_hash = calc_hashes([hash_data])[0]
+        return node_hash
+
+    def build(lo, hi):
+        """Hash and depth of the node for keys[lo:hi]; -1 for a leaf"""
+        if hi - lo == 1:
+            return hashes[lo], -1
+
+        # The shallowest split in a segment is the only one at its depth.
+        split = min(range(lo, hi - 1), key=split_depths.__getitem__)
+        depth = split_depths[split]
+        left_hash, left_depth = build(lo, split + 1)
+        right_hash, right_depth = build(split + 1, hi)
+        hash_data = (wrap(left_hash, left_depth, key_ints[lo], depth + 1) +
+                     wrap(right_hash, right_depth, key_ints[hi - 1], depth + 1) + b'\x01')
+        return calc_hashes([hash_data])[0], depth
+
+    root_hash, root_depth = build(0, n)
+    return wrap(root_hash, root_depth, key_ints[0], 0)
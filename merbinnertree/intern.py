@@ -0,0 +1,145 @@
+# Copyright (C) 2014 Peter Todd <pete@petertodd.org>
+#
+# This file is part of python-merbinnertree.
+#
+# It is subject to the license terms in the LICENSE file found in the top-level
+# directory of this distribution.
+#
+# No part of python-merbinnertree, including this file, may be copied,
+# modified, propagated, or distributed except according to the terms contained
+# in the LICENSE file.
+
+"""Interning of nodes, so that equal subtrees are the same object"""
+
+import weakref
+
+class InternTable:
+    """Table of nodes, for making equal subtrees the same object
+
+    Trees made with put() share unchanged subtrees with the tree they were
+    made from, but trees built separately, such as from the same items on
+    two replicas or by deserializing proofs, don't share anything. intern()
+    replaces every subtree of a tree that's equal to one already in the
+    table with that one. Besides the memory saved, diff(), merge() and
+    update() stop as soon as they find the same object on both sides.
+
+    Tree constructors and deserialize() take an intern table as their intern
+    argument. Nodes are held by weak references, so the table doesn't keep
+    any tree alive; only tree classes that set WEAKREFS = True can be
+    interned, so that other trees don't pay for the slot:
+
+        @make_MerbinnerTree_class
+        class InternedTree(SHA256MerbinnerTree):
+            __slots__ = []
+            WEAKREFS = True
+
+    Subtrees with nothing pruned are equal if they have the same hash, as
+    are pruned leaves and pruned inner nodes; in sum trees, which don't
+    commit to the sum of a pruned inner node in its own hash, the sum has to
+    be equal too. Inner nodes with something pruned under them, such as the
+    inner nodes of proofs, are equal if their interned children are the same
+    objects, as the same hash says nothing about what was pruned.
+
+    hits counts the nodes found in the table, and misses the nodes added to
+    it.
+    """
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+
+        # (tree class, kind) -> WeakValueDictionary of nodes, where kind is
+        # one of:
+        #
+        #   'full':         hash -> unpruned subtree
+        #   'pruned leaf':  hash -> pruned leaf
+        #   'pruned inner': hash, or (hash, sum) in sum trees -> pruned inner node
+        #   'partial':      (id(left), id(right)) -> inner node with something
+        #                   pruned under it. The node holds onto its children,
+        #                   so their ids can't be reused while it's there.
+        self._tables = {}
+
+    def __len__(self):
+        return sum(len(table) for table in self._tables.values())
+
+    def _table(self, node, kind):
+        try:
+            return self._tables[(node._mt_baseclass, kind)]
+        except KeyError:
+            table = self._tables[(node._mt_baseclass, kind)] = weakref.WeakValueDictionary()
+            return table
+
+    def intern(self, tree):
+        """Return tree with its subtrees replaced by equal ones from the table
+
+        Subtrees that aren't in the table are added to it. The result is
+        equal to tree, and is tree itself if nothing in it was replaced.
+
+        Raises TypeError if the tree's nodes can't be weakly referenced.
+        """
+        if not tree.InnerNodeClass.__weakrefoffset__:
+            raise TypeError("Can't intern %r nodes; the tree class must set WEAKREFS = True" % tree._mt_baseclass)
+        tree.compute_hashes()
+        return self._intern(tree)[0]
+
+    def _intern(self, node):
+        """Returns (interned node, true if nothing under it is pruned)"""
+        if isinstance(node, node.EmptyNodeClass):
+            # A singleton already
+            return (node, True)
+
+        elif isinstance(node, node.LazyInnerNodeClass):
+            # Belongs to its store
+            return (node, False)
+
+        elif isinstance(node, node.InnerNodeClass):
+            # Already interned?
+            full_table = self._table(node, 'full')
+            if full_table.get(node.hash) is node:
+                self.hits += 1
+                return (node, True)
+
+            partial_table = self._table(node, 'partial')
+            found = partial_table.get((id(node.left), id(node.right)))
+            if found is not None:
+                self.hits += 1
+                return (found, False)
+
+            left, left_full = self._intern(node.left)
+            right, right_full = self._intern(node.right)
+            full = left_full and right_full
+            if full:
+                table, key = full_table, node.hash
+            else:
+                table, key = partial_table, (id(left), id(right))
+
+        elif isinstance(node, node.FullLeafNodeClass):
+            full = True
+            table, key = self._table(node, 'full'), node.hash
+
+        elif isinstance(node, node.PrunedLeafNodeClass):
+            full = False
+            table, key = self._table(node, 'pruned leaf'), node.hash
+
+        else:
+            full = False
+            table = self._table(node, 'pruned inner')
+            key = node.hash if node.SUMSIZE is None else (node.hash, node._mt_sum())
+
+        found = table.get(key)
+        if found is not None:
+            self.hits += 1
+            return (found, full)
+
+        # Only made once it's known there isn't one already.
+        if isinstance(node, node.InnerNodeClass) and (left is not node.left or right is not node.right):
+            new_node = node.InnerNodeClass(left, right)
+            object.__setattr__(new_node, '_mt_cached_hash', node.hash)
+            node = new_node
+
+        self.misses += 1
+        table[key] = node
+        return (node, full)
+
+    def clear(self):
+        self._tables.clear()
@@ -0,0 +1,165 @@
+# Copyright (C) 2014 Peter Todd <pete@petertodd.org>
+#
+# This file is part of python-merbinnertree.
+#
+# It is subject to the license terms in the LICENSE file found in the top-level
+# directory of this distribution.
+#
+# No part of python-merbinnertree, including this file, may be copied,
+# modified, propagated, or distributed except according to the terms contained
+# in the LICENSE file.
+
+"""Caching of proofs for keys that are asked about over and over"""
+
+import collections
+
+class ProofCache:
+    """LRU cache of prove_contains() proofs
+
+    Proofs are cached by the root hash of the tree and the set of keys
+    proven, both as pruned trees and serialized. At most max_entries proofs
+    and max_bytes bytes of serialized proofs are kept, either of which may be
+    None for no limit.
+
+    When the root moves, proofs for the old root simply stop being asked
+    for and age out; invalidate() drops them right away. A proof for keys
+    that were proven against an earlier root is built by reusing every
+    subtree of the earlier proof whose hash didn't change, so only the parts
+    of the tree that changed are walked again.
+
+    hits, misses and reuses (misses that reused an earlier proof) count what
+    the cache has done so far, and bytes_saved the total size of the
+    serialized proofs it returned without building them.
+    """
+
+    def __init__(self, max_entries=None, max_bytes=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+
+        self.n_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.reuses = 0
+        self.bytes_saved = 0
+
+        # (root_hash, keys) -> [proof, serialized proof]
+        self._entries = collections.OrderedDict()
+
+        # root_hash -> set of keys sets cached for that root
+        self._roots = {}
+
+        # keys -> root hash of the latest proof for those keys
+        self._latest = {}
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def prove_contains(self, tree, keys):
+        """Return tree.prove_contains(keys), from the cache if possible"""
+        return self._get(tree, keys)[0]
+
+    def prove_contains_serialized(self, tree, keys):
+        """Return tree.prove_contains(keys).serialize(), from the cache if possible"""
+        return self._get(tree, keys)[1]
+
+    def _get(self, tree, keys):
+        keys = frozenset(keys)
+        for key in keys:
+            tree.check_key(key)
+        root_hash = tree.hash
+        cache_key = (root_hash, keys)
+
+        entry = self._entries.get(cache_key)
+        if entry is not None:
+            self._entries.move_to_end(cache_key)
+            self.hits += 1
+            self.bytes_saved += len(entry[1])
+            return entry
+
+        self.misses += 1
+        old_entry = None
+        old_root_hash = self._latest.get(keys)
+        if old_root_hash is not None:
+            old_entry = self._entries.get((old_root_hash, keys))
+
+        if old_entry is None:
+            proof = tree.prove_contains(keys)
+        else:
+            self.reuses += 1
+            proof = self._prove_reusing(tree, old_entry[0], sorted(keys, reverse=True), 0)
+
+        entry = [proof, proof.serialize()]
+        self._add(cache_key, entry)
+        return entry
+
+    def _prove_reusing(self, node, old_proof, keys, depth):
+        """Prove keys under node, reusing the parts of old_proof that are the same
+
+        old_proof proves the same keys under a node in the same place in
+        another tree, or is None.
+        """
+        if old_proof is not None and old_proof.hash == node.hash:
+            return old_proof
+
+        if keys and isinstance(node, node.LazyInnerNodeClass):
+            node = node._mt_load()
+        if not keys or not isinstance(node, node.InnerNodeClass):
+            return node._mt_get_keys({}, keys, depth, True)
+
+        left_keys = []
+        right_keys = []
+        for key in keys:
+            if node.key_side(key, depth):
+                left_keys.append(key)
+            else:
+                right_keys.append(key)
+
+        old_left = old_right = None
+        if isinstance(old_proof, node.InnerNodeClass):
+            old_left = old_proof.left
+            old_right = old_proof.right
+
+        left = self._prove_reusing(node.left, old_left, left_keys, depth+1)
+        right = self._prove_reusing(node.right, old_right, right_keys, depth+1)
+        return node.InnerNodeClass(left, right)
+
+    def _add(self, cache_key, entry):
+        root_hash, keys = cache_key
+        size = len(entry[1])
+
+        while self._entries and ((self.max_entries is not None and len(self._entries) + 1 > self.max_entries)
+                                 or (self.max_bytes is not None and self.n_bytes + size > self.max_bytes)):
+            self._discard(next(iter(self._entries)))
+
+        self._entries[cache_key] = entry
+        self.n_bytes += size
+        self._roots.setdefault(root_hash, set()).add(keys)
+        self._latest[keys] = root_hash
+
+    def _discard(self, cache_key):
+        root_hash, keys = cache_key
+        entry = self._entries.pop(cache_key)
+        self.n_bytes -= len(entry[1])
+
+        root_keys = self._roots[root_hash]
+        root_keys.discard(keys)
+        if not root_keys:
+            del self._roots[root_hash]
+        if self._latest.get(keys) == root_hash:
+            del self._latest[keys]
+
+    def invalidate(self, root_hash):
+        """Drop every proof for the tree with the given root hash"""
+        for keys in list(self._roots.get(bytes(root_hash), ())):
+            self._discard((bytes(root_hash), keys))
+
+    def clear(self):
+        self._entries.clear()
+        self._roots.clear()
+        self._latest.clear()
+        self.n_bytes = 0
@@ -0,0 +1,256 @@
+# Copyright (C) 2014 Peter Todd <pete@petertodd.org>
+#
+# This file is part of python-merbinnertree.
+#
+# It is subject to the license terms in the LICENSE file found in the top-level
+# directory of this distribution.
+#
+# No part of python-merbinnertree, including this file, may be copied,
+# modified, propagated, or distributed except according to the terms contained
+# in the LICENSE file.
+
+"""Frozen, array-backed snapshots of trees
+
+A tree of node objects costs a few hundred bytes per item before counting its
+keys and values. A Snapshot keeps the same tree in a handful of flat buffers
+instead, for keeping many read-only versions of a tree in memory at once.
+"""
+
+import array
+
+# Child references in a snapshot: an inner node's index, EMPTY_REF for the
+# empty node, or LEAF_REF - i for leaf i.
+EMPTY_REF = -1
+LEAF_REF = -2
+
+class Snapshot:
+    """Read-only copy of a tree in struct-of-arrays form
+
+    Leaves are numbered in tree order. Their keys are concatenated in one
+    buffer, their serialized values in another, and the start of each value
+    is in an array of offsets. Inner nodes are numbered in pre-order; each
+    has a left and right child reference, and its hash, in a buffer of
+    hashes, so proofs don't need anything rehashed but the leaves in them.
+
+    Snapshots support lookups, iteration and prove_contains() like the tree
+    they were made from, and to_tree() turns them back into one. Pruned
+    trees and sum trees can't be snapshotted.
+    """
+
+    def __init__(self, treecls, root, keys, values, value_offsets, left, right, inner_hashes):
+        self.treecls = treecls._mt_baseclass
+        self._root = root
+        self._keys = keys
+        self._values = values
+        self._value_offsets = value_offsets
+        self._left = left
+        self._right = right
+        self._inner_hashes = inner_hashes
+
+    @classmethod
+    def from_tree(cls, tree):
+        """Make a snapshot of a tree
+
+        Raises PrunedError if any of the tree is pruned.
+        """
+        treecls = tree._mt_baseclass
+        if treecls.SUMSIZE is not None:
+            raise ValueError("Can't snapshot sum trees")
+        tree.compute_hashes()
+
+        keys = bytearray()
+        values = bytearray()
+        value_offsets = array.array('q', [0])
+        left = array.array('i')
+        right = array.array('i')
+        inner_hashes = bytearray()
+        n_leaves = 0
+
+        # Pre-order, left first, which visits the leaves in tree order.
+        # Each entry has the children array and index the node's reference
+        # goes in, if any.
+        root = [None]
+        stack = [(tree, root, 0)]
+        while stack:
+            node, refs, i = stack.pop()
+            if isinstance(node, treecls.LazyInnerNodeClass):
+                node = node._mt_load()
+
+            if isinstance(node, treecls.InnerNodeClass):
+                ref = len(left)
+                left.append(0)
+                right.append(0)
+                inner_hashes += node.hash
+                stack.append((node.right, right, ref))
+                stack.append((node.left, left, ref))
+
+            elif isinstance(node, treecls.EmptyNodeClass):
+                ref = EMPTY_REF
+
+            elif isinstance(node, treecls.FullLeafNodeClass):
+                ref = LEAF_REF - n_leaves
+                n_leaves += 1
+                keys += node.key
+                values += treecls.serialize_value(node.value)
+                value_offsets.append(len(values))
+
+            else:
+                raise treecls.PrunedError('snapshot', getattr(node, 'key', None), None)
+
+            refs[i] = ref
+
+        return cls(treecls, root[0], bytes(keys), bytes(values), value_offsets, left, right, bytes(inner_hashes))
+
+    @property
+    def nbytes(self):
+        """Size of the buffers and arrays the snapshot is made of"""
+        return (len(self._keys) + len(self._values) + len(self._inner_hashes)
+                + sum(a.itemsize * len(a) for a in (self._value_offsets, self._left, self._right)))
+
+    def __len__(self):
+        return len(self._value_offsets) - 1
+
+    def _key(self, i):
+        keysize = self.treecls.KEYSIZE
+        return self._keys[i*keysize:(i+1)*keysize]
+
+    def _value(self, i):
+        return self.treecls.deserialize_value(memoryview(self._values)[self._value_offsets[i]:self._value_offsets[i+1]])
+
+    def _leaf_node(self, i, full):
+        """Leaf i as a leaf node, pruned unless full is true"""
+        treecls = self.treecls
+        if full:
+            return treecls.FullLeafNodeClass(self._key(i), self._value(i))
+        else:
+            return treecls.PrunedLeafNodeClass(self._key(i), treecls.calc_value_hash(self._value(i)))
+
+    def _inner_hash(self, ref):
+        hashsize = self.treecls.HASHSIZE
+        return self._inner_hashes[ref*hashsize:(ref+1)*hashsize]
+
+    @property
+    def hash(self):
+        if self._root >= 0:
+            return self._inner_hash(self._root)
+        elif self._root == EMPTY_REF:
+            return self.treecls.EmptyNodeClass().hash
+        else:
+            return self._leaf_node(LEAF_REF - self._root, True).hash
+
+    def _find(self, key):
+        """Index of the leaf with key, or None"""
+        self.treecls.check_key(key)
+        key_int = int.from_bytes(key, 'big')
+        shift = self.treecls.KEYSIZE * 8 - 1
+        left = self._left
+        right = self._right
+
+        ref = self._root
+        while ref >= 0:
+            ref = left[ref] if key_int >> shift & 1 else right[ref]
+            shift -= 1
+
+        if ref == EMPTY_REF:
+            return None
+        i = LEAF_REF - ref
+        return i if self._key(i) == key else None
+
+    def __getitem__(self, key):
+        i = self._find(key)
+        if i is None:
+            raise KeyError(key)
+        return self._value(i)
+
+    def __contains__(self, key):
+        return self._find(key) is not None
+
+    def keys(self):
+        keysize = self.treecls.KEYSIZE
+        for i in range(0, len(self._keys), keysize):
+            yield self._keys[i:i+keysize]
+
+    def values(self):
+        for i in range(len(self)):
+            yield self._value(i)
+
+    def items(self):
+        for i in range(len(self)):
+            yield (self._key(i), self._value(i))
+
+    def prove_contains(self, keys):
+        """Prove that the tree contains or does not contain keys
+
+        Returns the same pruned tree as prove_contains() on the tree the
+        snapshot was made from.
+        """
+        treecls = self.treecls
+        keys = list(keys)
+        for key in keys:
+            treecls.check_key(key)
+
+        def prove(ref, keys, depth):
+            if ref == EMPTY_REF:
+                return treecls.EmptyNodeClass()
+
+            elif ref < 0:
+                i = LEAF_REF - ref
+                return self._leaf_node(i, self._key(i) in keys)
+
+            elif not keys:
+                return treecls.PrunedInnerNodeClass(self._inner_hash(ref))
+
+            left_keys = []
+            right_keys = []
+            for key in keys:
+                if treecls.key_side(key, depth):
+                    left_keys.append(key)
+                else:
+                    right_keys.append(key)
+
+            node = treecls.InnerNodeClass(prove(self._left[ref], left_keys, depth+1),
+                                          prove(self._right[ref], right_keys, depth+1))
+            object.__setattr__(node, '_mt_cached_hash', self._inner_hash(ref))
+            return node
+
+        return prove(self._root, keys, 0)
+
+    def to_tree(self):
+        """Convert the snapshot back to a tree of node objects
+
+        Inner nodes get their hashes from the snapshot rather than having
+        them recalculated.
+        """
+        treecls = self.treecls
+        empty_node = treecls.EmptyNodeClass()
+
+        def node_for(ref):
+            if ref == EMPTY_REF:
+                return empty_node
+            return self._leaf_node(LEAF_REF - ref, True)
+
+        if self._root < 0:
+            return node_for(self._root)
+
+        # Children are finished before their parents, which are found again
+        # on the stack once both children are in nodes.
+        nodes = []
+        stack = [(self._root, False)]
+        while stack:
+            ref, children_done = stack.pop()
+            if children_done:
+                right = nodes.pop()
+                left = nodes.pop()
+                node = treecls.InnerNodeClass(left, right)
+                object.__setattr__(node, '_mt_cached_hash', self._inner_hash(ref))
+                nodes.append(node)
+
+            elif ref >= 0:
+                stack.append((ref, True))
+                stack.append((self._right[ref], False))
+                stack.append((self._left[ref], False))
+
+            else:
+                nodes.append(node_for(ref))
+
+        return nodes[0]
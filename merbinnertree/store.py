@@ -0,0 +1,396 @@
+# Copyright (C) 2014 Peter Todd <pete@petertodd.org>
+#
+# This file is part of python-merbinnertree.
+#
+# It is subject to the license terms in the LICENSE file found in the top-level
+# directory of this distribution.
+#
+# No part of python-merbinnertree, including this file, may be copied,
+# modified, propagated, or distributed except according to the terms contained
+# in the LICENSE file.
+
+"""Disk-backed storage for trees too big to keep in memory"""
+
+import collections
+import mmap
+import os
+
+from merbinnertree import (SERIALIZATION_VERSION, TAG_INNER, TAG_PRUNED_INNER,
+                           _varint_encode, _varint_decode)
+
+STORE_MAGIC = b'MBTSTORE'
+
+class NodeCache:
+    """Memory-bounded cache of nodes loaded from a NodeStore
+
+    Holds at most max_nodes nodes and max_bytes bytes, either of which may be
+    None for no limit. A node's size in bytes is counted as the size of its
+    record, which is smaller than the node takes up in memory but
+    proportional to it.
+
+    Nodes less than pin_levels deep are pinned: every lookup goes through
+    them, so they're never evicted and don't count towards the limits.
+
+    hits, misses and evictions count what the cache has done so far.
+
+    Subclasses decide which node to evict; see LRUNodeCache and
+    ClockNodeCache.
+    """
+
+    def __init__(self, max_nodes=None, max_bytes=None, pin_levels=0):
+        self.max_nodes = max_nodes
+        self.max_bytes = max_bytes
+        self.pin_levels = pin_levels
+
+        self.n_nodes = 0
+        self.n_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._pinned = {}
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def __len__(self):
+        return len(self._pinned) + self.n_nodes
+
+    def get(self, node_hash):
+        """Return the cached node with that hash, or None"""
+        node = self._pinned.get(node_hash)
+        if node is None:
+            node = self._get(node_hash)
+        if node is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return node
+
+    def add(self, node_hash, node, depth, size):
+        """Add a node at depth, whose record is size bytes"""
+        if depth < self.pin_levels:
+            self._pinned[node_hash] = node
+            return
+
+        while self.n_nodes and ((self.max_nodes is not None and self.n_nodes + 1 > self.max_nodes)
+                                or (self.max_bytes is not None and self.n_bytes + size > self.max_bytes)):
+            self.n_bytes -= self._evict()
+            self.n_nodes -= 1
+            self.evictions += 1
+
+        self._add(node_hash, node, size)
+        self.n_nodes += 1
+        self.n_bytes += size
+
+    def clear(self):
+        """Empty the cache, including pinned nodes"""
+        self._pinned.clear()
+        self._clear()
+        self.n_nodes = 0
+        self.n_bytes = 0
+
+    def _get(self, node_hash):
+        raise NotImplementedError
+
+    def _add(self, node_hash, node, size):
+        raise NotImplementedError
+
+    def _evict(self):
+        """Evict one node, returning its size"""
+        raise NotImplementedError
+
+    def _clear(self):
+        raise NotImplementedError
+
+class LRUNodeCache(NodeCache):
+    """NodeCache that evicts the least recently used node"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._entries = collections.OrderedDict()
+
+    def _get(self, node_hash):
+        entry = self._entries.get(node_hash)
+        if entry is not None:
+            self._entries.move_to_end(node_hash)
+            return entry[0]
+
+    def _add(self, node_hash, node, size):
+        self._entries[node_hash] = (node, size)
+
+    def _evict(self):
+        node_hash, (node, size) = self._entries.popitem(last=False)
+        return size
+
+    def _clear(self):
+        self._entries.clear()
+
+class ClockNodeCache(NodeCache):
+    """NodeCache that evicts with the CLOCK algorithm
+
+    An approximation of LRU that makes hits cheaper: a hit only sets the
+    node's referenced bit, and the clock hand gives referenced nodes a second
+    chance when looking for one to evict.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._slots = {}    # node_hash -> index into self._ring
+        self._ring = []     # [node_hash, node, size, referenced]
+        self._free = []
+        self._hand = 0
+
+    def _get(self, node_hash):
+        i = self._slots.get(node_hash)
+        if i is not None:
+            entry = self._ring[i]
+            entry[3] = True
+            return entry[1]
+
+    def _add(self, node_hash, node, size):
+        entry = [node_hash, node, size, False]
+        if self._free:
+            i = self._free.pop()
+            self._ring[i] = entry
+        else:
+            i = len(self._ring)
+            self._ring.append(entry)
+        self._slots[node_hash] = i
+
+    def _evict(self):
+        ring = self._ring
+        while True:
+            if self._hand >= len(ring):
+                self._hand = 0
+            entry = ring[self._hand]
+            if entry is None:
+                pass
+            elif entry[3]:
+                entry[3] = False
+            else:
+                ring[self._hand] = None
+                del self._slots[entry[0]]
+                self._free.append(self._hand)
+                self._hand += 1
+                return entry[2]
+            self._hand += 1
+
+    def _clear(self):
+        self._slots.clear()
+        self._ring.clear()
+        self._free.clear()
+        self._hand = 0
+
+class NodeStore:
+    """Append-only, content-addressed store of tree nodes
+
+    Every inner node is stored as a record keyed by its hash. A record holds
+    the serialized node with its leaf and empty children inline, and its inner
+    children pruned to their hashes; trees that are a single leaf or empty
+    get a record of their own. Since records are keyed by hash, adding a tree
+    that shares subtrees with trees already in the store only writes the
+    nodes that are new.
+
+    Trees loaded from the store are made of lazy inner nodes (see
+    LazyInnerNodeClass) that read their records from the store the first time
+    they're needed, so only the parts of a tree that are actually used are
+    ever loaded.
+
+    The file is:
+
+        <STORE_MAGIC> <SERIALIZATION_VERSION>
+        { <node hash> <varint len(record)> <record> }*
+
+    Opening a store scans the file to index where each record is, without
+    decoding any nodes. A record left incomplete by a crash is truncated.
+
+    Loaded nodes are kept in cache, a NodeCache, if one is given; otherwise
+    every access to a lazy node loads it again.
+    """
+
+    def __init__(self, treecls, path, cache=None):
+        self.treecls = treecls._mt_baseclass
+        if self.treecls.SUMSIZE is not None:
+            raise ValueError("Can't store sum trees")
+        self.path = path
+        self.cache = cache
+
+        self._header = STORE_MAGIC + bytes([SERIALIZATION_VERSION])
+        self._index = {}
+
+        self._file = open(path, 'a+b')
+        self._file.seek(0)
+        header = self._file.read(len(self._header))
+        if not header:
+            self._file.write(self._header)
+            self._file.flush()
+        elif header != self._header:
+            self._file.close()
+            raise ValueError('%r is not a node store for this version' % path)
+
+        self._mmap = None
+        self._mmap_size = 0
+        self._scan()
+
+    def _scan(self):
+        """Build the index of record offsets"""
+        hashsize = self.treecls.HASHSIZE
+        size = os.fstat(self._file.fileno()).st_size
+        self._remap(size)
+
+        buf = self._mmap
+        pos = len(self._header)
+        try:
+            while pos < size:
+                record_hash = buf[pos:pos+hashsize]
+                length, record_pos = _varint_decode(buf, pos + hashsize)
+                if record_pos + length > size or len(record_hash) != hashsize:
+                    raise IndexError
+                self._index[record_hash] = (record_pos, length)
+                pos = record_pos + length
+        except IndexError:
+            # Incomplete last record
+            self._file.truncate(pos)
+            self._remap(pos)
+
+    def _remap(self, size):
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+        self._mmap_size = size
+        if size:
+            self._mmap = mmap.mmap(self._file.fileno(), size, access=mmap.ACCESS_READ)
+
+    def close(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def flush(self):
+        self._file.flush()
+
+    def __contains__(self, node_hash):
+        return node_hash in self._index
+
+    def __len__(self):
+        return len(self._index)
+
+    def _read_record(self, node_hash):
+        try:
+            pos, length = self._index[node_hash]
+        except KeyError:
+            raise KeyError(node_hash)
+
+        if pos + length > self._mmap_size:
+            self._file.flush()
+            self._remap(os.fstat(self._file.fileno()).st_size)
+        return self._mmap[pos:pos+length]
+
+    def _make_inner(self, node_hash, depth):
+        """Make the node standing in for an inner child of a record"""
+        if node_hash in self._index:
+            return self.treecls.LazyInnerNodeClass(node_hash, self, depth)
+        else:
+            # Stored from a pruned tree.
+            return self.treecls.PrunedInnerNodeClass(node_hash)
+
+    def load_node(self, node_hash, depth):
+        """Load the node with the given hash
+
+        Its inner children are lazy nodes. depth is the depth of the node in
+        its tree, which can't be known from the record alone.
+        """
+        cache = self.cache
+        if cache is not None:
+            node = cache.get(node_hash)
+            if node is not None:
+                return node
+
+        record = self._read_record(node_hash)
+        node, pos = self.treecls._mt_deserialize(record, 0, depth, False, self._make_inner)
+        object.__setattr__(node, '_mt_cached_hash', node_hash)
+
+        if cache is not None:
+            cache.add(node_hash, node, depth, len(record))
+        return node
+
+    def get(self, root_hash):
+        """Get the tree with the given root hash
+
+        Raises KeyError if it isn't in the store.
+        """
+        if self._read_record(root_hash)[0] == TAG_INNER:
+            return self.treecls.LazyInnerNodeClass(root_hash, self, 0)
+        return self.load_node(root_hash, 0)
+
+    def _record_parts(self, node):
+        treecls = self.treecls
+        if isinstance(node, treecls.InnerNodeClass):
+            yield bytes([TAG_INNER])
+            for child in (node.left, node.right):
+                if isinstance(child, (treecls.InnerNodeClass, treecls.LazyInnerNodeClass,
+                                      treecls.PrunedInnerNodeClass)):
+                    yield bytes([TAG_PRUNED_INNER])
+                    yield child.hash
+                else:
+                    yield from child._mt_serialized_node_parts()
+        else:
+            yield from node._mt_serialized_node_parts()
+
+    def _write_record(self, node):
+        node_hash = node.hash
+        record = b''.join(self._record_parts(node))
+        header = node_hash + _varint_encode(len(record))
+
+        self._file.seek(0, os.SEEK_END)
+        end = self._file.tell()
+        self._file.write(header + record)
+        self._index[node_hash] = (end + len(header), len(record))
+
+    def add(self, tree):
+        """Add a tree to the store
+
+        Only nodes that aren't already in the store are written; children are
+        always written before their parents. Pruned parts of the tree are
+        stored as their hashes, and stay pruned when loaded.
+
+        Returns the root hash.
+        """
+        treecls = self.treecls
+        root_hash = tree.hash
+        if root_hash in self._index:
+            return root_hash
+
+        if isinstance(tree, treecls.LazyInnerNodeClass):
+            tree = tree._mt_load()
+
+        if not isinstance(tree, treecls.InnerNodeClass):
+            self._write_record(tree)
+            return root_hash
+
+        stack = [(tree, False)]
+        while stack:
+            node, children_done = stack.pop()
+            if children_done:
+                self._write_record(node)
+                continue
+
+            stack.append((node, True))
+            for child in (node.right, node.left):
+                if (isinstance(child, (treecls.InnerNodeClass, treecls.LazyInnerNodeClass))
+                        and child.hash not in self._index):
+                    if isinstance(child, treecls.LazyInnerNodeClass):
+                        child = child._mt_load()
+                    stack.append((child, False))
+
+        return root_hash
@@ -9,11 +9,23 @@
 # modified, propagated, or distributed except according to the terms contained
 # in the LICENSE file.
 
+import hashlib
+import mmap
 import os
+import pickle
 import random
+import tempfile
 import unittest
 
-from merbinnertree import SHA256MerbinnerTree
+from merbinnertree import (SHA256MerbinnerTree, LegacySHA256MerbinnerTree,
+                           BLAKE2bMerbinnerTree, BLAKE2sMerbinnerTree, make_MerbinnerTree_class)
+from merbinnertree.arrayhash import _root_hash_of_rows
+from merbinnertree.verify import verify_proof
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 def k(key):
     return key.ljust(32, b'\x00')
@@ -53,6 +65,36 @@ class Test_MerbinnerTree(unittest.TestCase):
         tb2 = tb2.put(k(b'\x00'), b'a')
         self.assertEqual(ta2.hash, tb2.hash)
 
+    def test_hash_scheme(self):
+        def H(data):
+            return hashlib.sha256(data).digest()
+
+        tree = TestTree()
+        self.assertEqual(tree.hash, H(b'\x00'))
+
+        tree = tree.put(k(b'\x00'), b'a')
+        self.assertEqual(tree.hash, H(H(b'a') + k(b'\x00') + b'\x02'))
+
+        tree = tree.put(k(b'\xff'), b'b')
+        self.assertEqual(tree.hash, H(H(H(b'b') + k(b'\xff') + b'\x02') +
+                                      H(H(b'a') + k(b'\x00') + b'\x02') +
+                                      b'\x01'))
+
+        # Node hashes are a fixed size regardless of how big the tree is
+        tree = TestTree((os.urandom(32), os.urandom(32)) for i in range(1000))
+        self.assertEqual(len(tree.hash), 32)
+        self.assertEqual(len(tree.left.hash), 32)
+
+        # Version 0 hashes are the unhashed hash data
+        tree = LegacySHA256MerbinnerTree()
+        self.assertEqual(tree.hash, b'\x00')
+        tree = tree.put(k(b'\x00'), b'a').put(k(b'\xff'), b'b')
+        self.assertEqual(tree.hash, H(b'b') + k(b'\xff') + b'\x02' +
+                                    H(b'a') + k(b'\x00') + b'\x02' +
+                                    b'\x01')
+        self.assertIsInstance(tree, LegacySHA256MerbinnerTree.InnerNodeClass)
+        self.assertNotIsInstance(tree, TestTree.InnerNodeClass)
+
     def test_put_new_key(self):
         t0 = TestTree()
 
@@ -144,6 +186,30 @@ class Test_MerbinnerTree(unittest.TestCase):
         self.assertIn(k(b'\x00'), t1)
         self.assertNotIn(k(b'\x01'), t1)
 
+    def test_get_pruned(self):
+        """Lookups in pruned trees"""
+        tree = TestTree([(k(bytes([i])), bytes([i])) for i in range(16)])
+        pruned_tree = tree.prove_contains([k(b'\x03')])
+
+        self.assertEqual(pruned_tree[k(b'\x03')], b'\x03')
+        self.assertIn(k(b'\x03'), pruned_tree)
+
+        # Lookups that end in a pruned inner node can't be answered.
+        with self.assertRaises(TestTree.PrunedError):
+            pruned_tree[k(b'\x0f')]
+        with self.assertRaises(TestTree.PrunedError):
+            k(b'\x0f') in pruned_tree
+
+        # Nor can getting the value of a pruned leaf, although whether or not
+        # it's there can be.
+        pruned_tree = TestTree.PrunedLeafNodeClass(k(b'\x02'), TestTree.calc_value_hash(b'\x02'))
+        self.assertIn(k(b'\x02'), pruned_tree)
+        self.assertNotIn(k(b'\x03'), pruned_tree)
+        with self.assertRaises(TestTree.PrunedError):
+            pruned_tree[k(b'\x02')]
+        with self.assertRaises(KeyError):
+            pruned_tree[k(b'\x03')]
+
     def test___contains___with_invalid_keys(self):
         t0 = TestTree()
 
@@ -298,8 +364,9 @@ class Test_MerbinnerTree(unittest.TestCase):
         t1 = t0.put(k(b'\x00'), b'a')
         t2 = t1.remove(k(b'\x00'))
         self.assertNotIn(k(b'\x00'), t2)
-        with self.assertRaises(KeyError):
+        with self.assertRaises(KeyError) as cm:
             t2.remove(k(b'\x00'))
+        self.assertEqual(cm.exception.args, (k(b'\x00'),))
 
         # t2 is now identical to our starting tree
         self.assertEqual(t2.hash, t0.hash)
@@ -427,3 +494,807 @@ class Test_MerbinnerTree(unittest.TestCase):
             tree = tree.remove(k)
 
         self.assertIs(tree, TestTree())
+
+    def test_from_sorted_items(self):
+        # Empty and single item trees
+        self.assertIs(TestTree.from_sorted_items([]), TestTree())
+        tree = TestTree.from_sorted_items([(k(b'\x00'), b'a')])
+        self.assertIsInstance(tree, TestTree.FullLeafNodeClass)
+
+        # Keys colliding on the first bit need an inner node with an empty
+        # sibling above them.
+        tree = TestTree.from_sorted_items([(k(b'\xff'), b'a'), (k(b'\x80'), b'b')])
+        self.assertIsInstance(tree.left, TestTree.InnerNodeClass)
+        self.assertIsInstance(tree.right, TestTree.EmptyNodeClass)
+        self.assertEqual(tree.left.left.key, k(b'\xff'))
+        self.assertEqual(tree.left.right.key, k(b'\x80'))
+
+        # Random contents hash the same as trees built by put()
+        for n in (2, 3, 10, 100, 1000):
+            items = [(os.urandom(32), os.urandom(32)) for i in range(n)]
+            expected_tree = TestTree()
+            for key, value in items:
+                expected_tree = expected_tree.put(key, value)
+
+            items.sort(reverse=True)
+            tree = TestTree.from_sorted_items(iter(items))
+            self.assertEqual(tree.hash, expected_tree.hash)
+            self.assertEqual(list(tree.keys()), [key for key, value in items])
+
+        # Out of order and duplicate keys are rejected
+        with self.assertRaises(ValueError):
+            TestTree.from_sorted_items([(k(b'\x00'), b'a'), (k(b'\xff'), b'b')])
+        with self.assertRaises(ValueError):
+            TestTree.from_sorted_items([(k(b'\x00'), b'a'), (k(b'\x00'), b'b')])
+        with self.assertRaises(ValueError):
+            TestTree([(k(b'\x00'), b'a'), (k(b'\x00'), b'b')])
+
+    def test_from_unsorted_items(self):
+        items = [(os.urandom(32), os.urandom(32)) for i in range(1000)]
+        expected_tree = TestTree(items)
+
+        # Small chunks force the external sort to spill to disk
+        for max_chunk_size in (1, 7, 1000, 10000):
+            tree = TestTree.from_unsorted_items(iter(items), max_chunk_size=max_chunk_size)
+            self.assertEqual(tree.hash, expected_tree.hash)
+
+        self.assertIs(TestTree.from_unsorted_items([], max_chunk_size=1), TestTree())
+
+    def test_root_hash_of(self):
+        def check(treecls, items):
+            expected = treecls(items).hash
+            keys = [key for key, value in items]
+            value_hashes = [treecls.calc_value_hash(value) for key, value in items]
+            self.assertEqual(_root_hash_of_rows(treecls, keys, value_hashes), expected)
+            if numpy is not None:
+                key_array = numpy.array([list(key) for key in keys], dtype=numpy.uint8).reshape(-1, 32)
+                value_hash_array = numpy.array([list(value_hash) for value_hash in value_hashes],
+                                               dtype=numpy.uint8).reshape(-1, 32)
+                self.assertEqual(treecls.root_hash_of(key_array, value_hash_array), expected)
+
+        # Hand-picked structures, including chains of inner nodes with empty
+        # siblings.
+        for keys in ([],
+                     [k(b'\x00')],
+                     [k(b'\x00'), k(b'\xff')],
+                     [k(b'\xff'), k(b'\x80')],
+                     [k(b'\xff\x80'), k(b'\xff\x00'), k(b'\x00')],
+                     [k(b'\xf0'), k(b'\xff'), k(b'\x00'), k(b'\x00\x01')]):
+            items = [(key, key[0:2]) for key in keys]
+            check(TestTree, items)
+            check(LegacySHA256MerbinnerTree, items)
+
+        for n in (2, 3, 100, 1000):
+            check(TestTree, [(os.urandom(32), os.urandom(32)) for i in range(n)])
+
+        keys = [k(b'\x00'), k(b'\x00')]
+        value_hashes = [TestTree.calc_value_hash(b'a'), TestTree.calc_value_hash(b'b')]
+        with self.assertRaises(ValueError):
+            _root_hash_of_rows(TestTree, keys, value_hashes)
+        with self.assertRaises(ValueError):
+            _root_hash_of_rows(TestTree, [key[1:] for key in keys], value_hashes)
+        if numpy is not None:
+            with self.assertRaises(ValueError):
+                TestTree.root_hash_of(numpy.array([list(key) for key in keys], dtype=numpy.uint8),
+                                      numpy.zeros((2, 32), dtype=numpy.uint8))
+            with self.assertRaises(ValueError):
+                TestTree.root_hash_of(numpy.zeros((2, 31), dtype=numpy.uint8),
+                                      numpy.zeros((2, 32), dtype=numpy.uint8))
+
+    def test_put_many(self):
+        items = [(os.urandom(32), os.urandom(32)) for i in range(500)]
+
+        added = set()
+        tree = TestTree().put_many(items, added)
+        self.assertEqual(tree.hash, TestTree(items).hash)
+        self.assertEqual(added, set(key for key, value in items))
+
+        # Modify half the keys and add some more
+        new_items = [(key, os.urandom(32)) for key, value in items[0:250]]
+        new_items += [(os.urandom(32), os.urandom(32)) for i in range(100)]
+        added = set()
+        modified = set()
+        tree2 = tree.put_many(new_items, added, modified)
+        self.assertEqual(tree2.hash, TestTree(dict(items + new_items).items()).hash)
+        self.assertEqual(added, set(key for key, value in new_items[250:]))
+        self.assertEqual(modified, set(key for key, value in new_items[0:250]))
+
+        # Setting keys to the values they already have changes nothing
+        added = set()
+        modified = set()
+        self.assertIs(tree.put_many(items[0:10], added, modified), tree)
+        self.assertEqual(added | modified, set())
+        modified = set()
+        tree3 = tree.put_many(items[0:10] + [(items[10][0], b'changed')], modified=modified)
+        self.assertEqual(modified, {items[10][0]})
+        self.assertIs(tree3._mt_get_leaf(items[0][0]), tree._mt_get_leaf(items[0][0]))
+
+        # Pruned leaves are compared by value hash
+        pruned = TestTree(items[0:2]).prove_contains([items[0][0]])
+        self.assertIsInstance(pruned._mt_get_leaf(items[1][0]), TestTree.PrunedLeafNodeClass)
+        modified = set()
+        self.assertEqual(pruned.put_many(items[0:2], modified=modified).hash, pruned.hash)
+        self.assertEqual(modified, set())
+        pruned.put_many([(items[1][0], b'changed')], modified=modified)
+        self.assertEqual(modified, {items[1][0]})
+
+        # Nothing to do
+        self.assertIs(tree.put_many([]), tree)
+
+        with self.assertRaises(ValueError):
+            tree.put_many([(k(b'\x00'), b'a'), (k(b'\x00'), b'b')])
+        with self.assertRaises(TypeError):
+            tree.put_many([(k(b'\x00'), None)])
+
+    def test_remove_many(self):
+        items = [(os.urandom(32), os.urandom(32)) for i in range(500)]
+        tree = TestTree(items)
+
+        removed = set()
+        tree2 = tree.remove_many([key for key, value in items[0:250]], removed)
+        self.assertEqual(tree2.hash, TestTree(items[250:]).hash)
+        self.assertEqual(removed, set(key for key, value in items[0:250]))
+
+        self.assertIs(tree.remove_many([key for key, value in items]), TestTree())
+
+        # Missing keys are all reported
+        missing_keys = [os.urandom(32), os.urandom(32)]
+        with self.assertRaises(KeyError) as cm:
+            tree.remove_many([items[0][0]] + missing_keys)
+        self.assertEqual(len(cm.exception.args), 1)
+        self.assertEqual(set(cm.exception.args[0]), set(missing_keys))
+
+        with self.assertRaises(ValueError):
+            tree.remove_many([items[0][0], items[0][0]])
+
+    def test_apply(self):
+        items = [(os.urandom(32), os.urandom(32)) for i in range(500)]
+        tree = TestTree(items)
+
+        expected_dict = dict(items)
+        changes = []
+        for key, value in items[0:100]:
+            changes.append((key, None))
+            del expected_dict[key]
+        for key, value in items[100:200]:
+            changes.append((key, b'modified'))
+            expected_dict[key] = b'modified'
+        for i in range(100):
+            new_item = (os.urandom(32), os.urandom(32))
+            changes.append(new_item)
+            expected_dict[new_item[0]] = new_item[1]
+        random.shuffle(changes)
+
+        added, modified, removed = set(), set(), set()
+        tree2 = tree.apply(changes + [items[200]], added, modified, removed)
+        self.assertEqual(tree2.hash, TestTree(expected_dict.items()).hash)
+        self.assertEqual(removed, set(key for key, value in items[0:100]))
+        self.assertEqual(modified, set(key for key, value in items[100:200]))
+        self.assertEqual(added, set(key for key, value in changes) - removed - modified)
+
+        with self.assertRaises(KeyError):
+            tree.apply([(os.urandom(32), None)])
+
+        # Changes inside pruned parts of the tree fail
+        pruned_tree = tree.prove_contains([items[0][0]])
+        pruned_tree.apply([(items[0][0], None)])
+        with self.assertRaises(TestTree.PrunedError) as cm:
+            pruned_tree.apply([(items[0][0], None)] + [(key, None) for key, value in items[1:]])
+        self.assertIsInstance(cm.exception.key, bytes)
+
+    def test_diff(self):
+        def D(old, new, unresolved=None):
+            return [(key, old_leaf and old_leaf.hash, new_leaf and new_leaf.hash)
+                    for key, old_leaf, new_leaf in old.diff(new, unresolved)]
+
+        t0 = TestTree()
+        t1 = t0.put(k(b'\x00'), b'a')
+        self.assertEqual(D(t0, t0), [])
+        self.assertEqual(D(t0, t1), [(k(b'\x00'), None, t1.hash)])
+        self.assertEqual(D(t1, t0), [(k(b'\x00'), t1.hash, None)])
+
+        t2 = t1.put(k(b'\x00'), b'b')
+        self.assertEqual(D(t1, t2), [(k(b'\x00'), t1.hash, t2.hash)])
+
+        # Leaf against inner node
+        t3 = t1.put(k(b'\x80'), b'c').put(k(b'\xff'), b'd')
+        self.assertEqual([key for key, old, new in t1.diff(t3)], [k(b'\xff'), k(b'\x80')])
+        self.assertEqual([key for key, old, new in t2.diff(t3)], [k(b'\xff'), k(b'\x80'), k(b'\x00')])
+
+        # Leaves under a pruned region of the other side can't be diffed, so
+        # only the region is reported
+        a = TestTree([(k(b'\x00'), b'a'), (k(b'\x01'), b'b'), (k(b'\xff'), b'c')])
+        proof = a.prove_contains([k(b'\xff')])
+        b = TestTree([(k(b'\x00'), b'a')])
+        for old, new in ((proof, b), (b, proof)):
+            unresolved = []
+            self.assertEqual([key for key, old_leaf, new_leaf in old.diff(new, unresolved)], [k(b'\xff')])
+            self.assertEqual(unresolved, [(k(b'\x00'), 1)])
+            with self.assertRaises(TestTree.PrunedError):
+                list(old.diff(new))
+
+        def in_region(key, region):
+            prefix, depth = region
+            shift = 256 - depth
+            return int.from_bytes(key, 'big') >> shift == int.from_bytes(prefix, 'big') >> shift
+
+        rng = random.Random(1)
+        items = {rng.getrandbits(256).to_bytes(32, 'big'): b'%d' % i for i in range(200)}
+        full = TestTree(items.items())
+        proof = full.prove_contains(rng.sample(sorted(items), 5))
+        changed = rng.sample(sorted(items), 20)
+        other = full.apply([(key, None) for key in changed[0:10]] + [(key, b'x') for key in changed[10:]])
+        for old, new in ((proof, other), (other, proof)):
+            unresolved = []
+            found = [key for key, old_leaf, new_leaf in old.diff(new, unresolved)]
+            self.assertTrue(unresolved)
+            for key in found:
+                self.assertFalse(any(in_region(key, region) for region in unresolved))
+            for key in changed:
+                self.assertTrue(key in found or any(in_region(key, region) for region in unresolved))
+
+        # Random changes to a big tree, compared against diffing the items
+        rng = random.Random(0)
+        items = {rng.getrandbits(256).to_bytes(32, 'big'): b'%d' % i for i in range(1000)}
+        old = TestTree(items.items())
+        changes = {}
+        for key in rng.sample(sorted(items), 10):
+            changes[key] = None
+        for key in rng.sample(sorted(items), 10):
+            changes[key] = b'changed'
+        for i in range(10):
+            changes[rng.getrandbits(256).to_bytes(32, 'big')] = b'new'
+        new = old.apply(changes.items())
+
+        expected = []
+        for key in sorted(changes, reverse=True):
+            old_value = items.get(key)
+            new_value = changes[key]
+            if old_value != new_value:
+                expected.append((key, old_value, new_value))
+        self.assertEqual([(key, old_leaf and old_leaf.value, new_leaf and new_leaf.value)
+                          for key, old_leaf, new_leaf in old.diff(new)],
+                         expected)
+
+        # Equal subtrees are skipped by hash once hashes are known, even if
+        # they aren't the same objects.
+        old.hash
+        new2 = TestTree(new.items())
+        new2.hash
+        self.assertEqual(len(list(old.diff(new2))), len(expected))
+
+        # Pruned trees
+        pruned = new.prove_contains([key for key, old_value, new_value in expected[0:3]])
+        with self.assertRaises(TestTree.PrunedError):
+            list(old.diff(pruned))
+        unresolved = []
+        self.assertEqual([key for key, old_leaf, new_leaf in old.diff(pruned, unresolved)],
+                         [key for key, old_value, new_value in expected[0:3]])
+        self.assertTrue(unresolved)
+        for prefix, depth in unresolved:
+            self.assertEqual(len(prefix), 32)
+            self.assertTrue(0 < depth < 256)
+
+        with self.assertRaises(TypeError):
+            list(old.diff({}))
+        with self.assertRaises(TypeError):
+            list(old.diff(LegacySHA256MerbinnerTree(old.items())))
+
+    def test_update(self):
+        rng = random.Random(0)
+        def random_items(n):
+            return {rng.getrandbits(256).to_bytes(32, 'big'): b'%d' % rng.getrandbits(32) for i in range(n)}
+
+        for n_a, n_b in ((0, 0), (1, 0), (0, 1), (1, 1), (10, 1), (1, 10), (100, 100)):
+            items_a = random_items(n_a)
+            items_b = random_items(n_b)
+            # Some keys in both
+            for key in list(items_a)[0:n_a//2]:
+                items_b[key] = b'b'
+
+            a = TestTree(items_a.items())
+            b = TestTree(items_b.items())
+            expected = dict(items_a)
+            expected.update(items_b)
+            self.assertEqual(a.update(b).hash, TestTree(expected.items()).hash)
+
+        # Unchanged parts are reused
+        a = TestTree(random_items(100).items())
+        key = next(a.keys())
+        b = a.put(key, b'changed')
+        self.assertIs(a.update(a), a)
+        self.assertIs(a.update(TestTree()), a)
+        self.assertIs(a.update(b).right, a.right)
+
+        # Pruned trees
+        pruned_a = a.prove_contains([key])
+        self.assertEqual(pruned_a.update(b.prove_contains([key])).hash, b.hash)
+        self.assertIs(a.update(pruned_a), a)
+        with self.assertRaises(TestTree.PrunedError):
+            pruned_a.update(TestTree([(next(iter(a.right.keys())), b'')]))
+
+        with self.assertRaises(TypeError):
+            a.update({})
+        # Subclasses hash differently, so they don't mix either
+        with self.assertRaises(TypeError):
+            a.update(LegacySHA256MerbinnerTree(random_items(10).items()))
+
+    def test_merge(self):
+        tree = TestTree((bytes([i]) * 32, bytes([i])) for i in range(64))
+        keys = list(tree.keys())
+        proofs = [tree.prove_contains(keys[i:i+8]) for i in range(0, 64, 8)]
+
+        merged = proofs[0]
+        for proof in proofs[1:]:
+            merged = merged.merge(proof)
+        self.assertEqual(merged.hash, tree.hash)
+        self.assertEqual(dict(merged.items()), dict(tree.items()))
+
+        for merged in (TestTree.merge_all(proofs), TestTree.merge_all(reversed(proofs))):
+            self.assertEqual(merged.hash, tree.hash)
+            self.assertEqual(dict(merged.items()), dict(tree.items()))
+
+        # Merging with a more pruned tree returns the existing tree
+        self.assertIs(tree.merge(proofs[0]), tree)
+        self.assertIs(proofs[0].merge(tree), tree)
+        self.assertIs(TestTree.merge_all([proofs[0], tree, proofs[1]]), tree)
+        self.assertIs(proofs[0].merge(proofs[0]), proofs[0])
+
+        # Only the parts proven by both are new nodes
+        merged = proofs[0].merge(proofs[7])
+        self.assertIs(merged.right.right.left, proofs[0].right.right.left)
+        self.assertIs(merged.right.right.right.right, proofs[7].right.right.right.right)
+        self.assertEqual(merged[keys[0]], tree[keys[0]])
+        self.assertEqual(merged[keys[63]], tree[keys[63]])
+
+        with self.assertRaises(ValueError):
+            tree.merge(TestTree())
+        with self.assertRaises(ValueError):
+            TestTree.merge_all([tree, TestTree()])
+        with self.assertRaises(ValueError):
+            TestTree.merge_all([])
+        with self.assertRaises(TypeError):
+            tree.merge({})
+        legacy = LegacySHA256MerbinnerTree(tree.items())
+        with self.assertRaises(TypeError):
+            tree.merge(legacy)
+        with self.assertRaises(TypeError):
+            TestTree.merge_all([tree, legacy])
+
+    def test_witness(self):
+        rng = random.Random(0)
+        for n in (0, 1, 2, 10, 300):
+            items = {rng.getrandbits(256).to_bytes(32, 'big'): b'%d' % i for i in range(n)}
+            tree = TestTree(items.items())
+
+            for i in range(10):
+                changes = {}
+                for key in rng.sample(sorted(items), min(len(items), rng.randrange(4))):
+                    changes[key] = rng.choice((None, b'changed'))
+                for j in range(rng.randrange(4)):
+                    changes[rng.getrandbits(256).to_bytes(32, 'big')] = b'new'
+
+                witness = tree.prove_put_many(changes.items())
+                self.assertEqual(witness.hash, tree.hash)
+                self.assertFalse(any(isinstance(node, TestTree.FullLeafNodeClass)
+                                     for node in witness._mt_iter_nodes()))
+
+                new_tree = TestTree.apply_with_witness(witness, changes.items(), tree.hash)
+                self.assertEqual(new_tree.hash, tree.apply(changes.items()).hash)
+
+        # Proving nothing needs nothing but the root hash
+        self.assertIsInstance(tree.prove_put_many([]), TestTree.PrunedInnerNodeClass)
+
+        key = next(tree.keys())
+        witness = tree.prove_put_many([(key, b'a')])
+        with self.assertRaises(ValueError):
+            TestTree.apply_with_witness(witness, [(key, b'a')], TestTree().hash)
+        with self.assertRaises(TestTree.PrunedError):
+            TestTree.apply_with_witness(witness, [(key, b'a'), (bytes(32), b'b')], tree.hash)
+        with self.assertRaises(KeyError):
+            tree.prove_put_many([(bytes(32), None)])
+
+    def test_iter_proofs(self):
+        rng = random.Random(0)
+        for n in (0, 1, 2, 100):
+            tree = TestTree((rng.getrandbits(256).to_bytes(32, 'big'), b'%d' % i) for i in range(n))
+            keys = list(tree.keys())
+            keys.extend(rng.getrandbits(256).to_bytes(32, 'big') for i in range(50))
+            keys.sort(reverse=True)
+
+            for group_size in (1, 2, 7):
+                groups = [keys[i:i+group_size] for i in range(0, len(keys), group_size)]
+
+                proofs = list(tree.iter_proofs(keys, group_size))
+                self.assertEqual([group for group, proof in proofs], groups)
+                for group, proof in proofs:
+                    self.assertEqual(proof, tree.prove_contains(group).serialize())
+
+                for group, proof in tree.iter_proofs(iter(keys), group_size, encode=False):
+                    self.assertEqual(proof.serialize(), tree.prove_contains(group).serialize())
+
+        with self.assertRaises(ValueError):
+            list(tree.iter_proofs([k(b'\x00'), k(b'\x01')]))
+        with self.assertRaises(TestTree.PrunedError):
+            list(tree.prove_contains([keys[0]]).iter_proofs([keys[0], keys[-1]]))
+
+    def test_iteration(self):
+        rng = random.Random(0)
+        items = sorted(((rng.getrandbits(256).to_bytes(32, 'big'), b'%d' % i) for i in range(200)), reverse=True)
+        tree = TestTree(items)
+
+        self.assertEqual(list(tree.items()), items)
+        self.assertEqual(list(tree.keys()), [key for key, value in items])
+        self.assertEqual(list(tree.values()), [value for key, value in items])
+        self.assertEqual(list(TestTree().items()), [])
+
+        self.assertEqual(list(tree.range()), items)
+        self.assertEqual(list(tree.range(reverse=True)), items[::-1])
+        for i in range(20):
+            start, end = sorted(rng.getrandbits(256).to_bytes(32, 'big') for j in range(2))
+            expected = [(key, value) for key, value in items if start <= key < end]
+            self.assertEqual(list(tree.range(start, end)), expected)
+            self.assertEqual(list(tree.range(start, end, reverse=True)), expected[::-1])
+            self.assertEqual(list(tree.range(start)), [item for item in items if start <= item[0]])
+            self.assertEqual(list(tree.range(end=end)), [item for item in items if item[0] < end])
+            self.assertEqual(list(tree.range(end, start)), [])
+
+        # Bounds are inclusive and exclusive respectively
+        key = items[10][0]
+        self.assertEqual(list(tree.range(key, key)), [])
+        self.assertEqual(list(tree.range(key, items[9][0])), [items[10]])
+
+        for prefix, nbits in ((b'', None), (b'\x80', 1), (b'\xab', None), (b'\xab\xcd', 12), (items[5][0], None)):
+            def bits(key):
+                return int.from_bytes(key, 'big') >> (256 - (len(prefix) * 8 if nbits is None else nbits))
+            expected = [(key, value) for key, value in items if bits(key) == bits(prefix.ljust(32, b'\x00'))]
+            self.assertEqual(list(tree.iter_prefix(prefix, nbits)), expected)
+            self.assertEqual(list(tree.iter_prefix(prefix, nbits, reverse=True)), expected[::-1])
+        with self.assertRaises(ValueError):
+            tree.iter_prefix(b'\x00', 9)
+
+        # Pruned trees: plain iteration skips what's pruned, ranges don't
+        pruned_tree = tree.prove_contains([items[0][0], items[-1][0]])
+        self.assertEqual(list(pruned_tree.items()), [items[0], items[-1]])
+        self.assertGreater(len(list(pruned_tree.keys())), 2)    # pruned leaves too
+        self.assertEqual(list(pruned_tree.range(items[0][0])), [items[0]])
+        with self.assertRaises(TestTree.PrunedError):
+            list(pruned_tree.range(items[40][0]))
+        with self.assertRaises(TestTree.PrunedError):
+            list(pruned_tree.range(items[1][0]))
+
+    def test_neighbors(self):
+        rng = random.Random(0)
+        items = sorted(((rng.getrandbits(256).to_bytes(32, 'big'), b'%d' % i) for i in range(200)))
+        keys = [key for key, value in items]
+        tree = TestTree(items)
+
+        for key in [rng.getrandbits(256).to_bytes(32, 'big') for i in range(50)] + keys[0:3] + keys[-3:]:
+            after = [item for item in items if item[0] > key]
+            before = [item for item in items if item[0] < key]
+            expected_successor = after[0] if after else None
+            expected_predecessor = before[-1] if before else None
+            self.assertEqual(tree.successor(key), expected_successor)
+            self.assertEqual(tree.predecessor(key), expected_predecessor)
+
+            key_int = int.from_bytes(key, 'big')
+            expected_closest = min(items, key=lambda item: (abs(int.from_bytes(item[0], 'big') - key_int), item[0]))
+            self.assertEqual(tree.closest(key), expected_closest)
+
+            predecessor, successor, proof = tree.prove_neighbors(key)
+            self.assertEqual(predecessor, expected_predecessor and expected_predecessor[0])
+            self.assertEqual(successor, expected_successor and expected_successor[0])
+            self.assertEqual(proof.hash, tree.hash)
+            self.assertEqual(proof.successor(key), expected_successor)
+            self.assertEqual(proof.predecessor(key), expected_predecessor)
+            self.assertEqual(proof.closest(key), expected_closest)
+
+        self.assertIsNone(TestTree().successor(k(b'')))
+        self.assertIsNone(TestTree().closest(k(b'')))
+        self.assertEqual(TestTree().prove_neighbors(k(b'')), (None, None, TestTree()))
+
+        # Answers in pruned parts of the tree can't be found
+        proof = tree.prove_contains([keys[0]])
+        with self.assertRaises(TestTree.PrunedError):
+            proof.successor(keys[0])
+        self.assertEqual(proof.predecessor(keys[0]), None)
+
+    def test_counts(self):
+        rng = random.Random(0)
+        items = sorted(((rng.getrandbits(256).to_bytes(32, 'big'), b'%d' % i) for i in range(200)), reverse=True)
+        tree = TestTree(items)
+
+        self.assertEqual(len(TestTree()), 0)
+        self.assertFalse(TestTree())
+        self.assertEqual(len(TestTree(items[0:1])), 1)
+        self.assertEqual(len(tree), 200)
+        self.assertEqual(len(tree.put(items[0][0], b'')), 200)
+        self.assertEqual(len(tree.put(k(b''), b'')), 201)
+        self.assertEqual(len(tree.remove(items[0][0])), 199)
+
+        for i, item in enumerate(items):
+            self.assertEqual(tree.select(i), item)
+            self.assertEqual(tree.rank(item[0]), i)
+        self.assertEqual(tree.select(-1), items[-1])
+        for i in (200, -201):
+            with self.assertRaises(IndexError):
+                tree.select(i)
+
+        for i in range(20):
+            key = rng.getrandbits(256).to_bytes(32, 'big')
+            self.assertEqual(tree.rank(key), len([item for item in items if item[0] > key]))
+
+        sample = tree.sample(50, random.Random(0))
+        self.assertEqual(len(sample), 50)
+        self.assertEqual(len(set(sample)), 50)
+        self.assertTrue(set(sample) <= set(items))
+        self.assertEqual(sorted(tree.sample(200)), sorted(items))
+        with self.assertRaises(ValueError):
+            tree.sample(201)
+
+        # Pruned trees
+        pruned_tree = tree.prove_contains([items[0][0]])
+        self.assertTrue(pruned_tree)
+        with self.assertRaises(TestTree.PrunedError):
+            len(pruned_tree)
+        self.assertEqual(pruned_tree.rank(items[0][0]), 0)
+        self.assertEqual(len(TestTree.PrunedLeafNodeClass(k(b''), b'')), 1)
+
+    def test_hash_backends(self):
+        items = [(bytes([i]) * 32, bytes([i])) for i in range(16)]
+        key = items[3][0]
+        root_hashes = set()
+        for treecls, hash_func in ((SHA256MerbinnerTree, hashlib.sha256),
+                                   (BLAKE2bMerbinnerTree, lambda data: hashlib.blake2b(data, digest_size=32)),
+                                   (BLAKE2sMerbinnerTree, hashlib.blake2s)):
+            tree = treecls(items)
+            leaf = tree.prove_contains([key])._mt_get_leaf(key)
+            self.assertEqual(leaf.hash, hash_func(hash_func(items[3][1]).digest() + key + b'\x02').digest())
+            self.assertEqual(treecls.hash_many([b'a', b'b']), [hash_func(b'a').digest(), hash_func(b'b').digest()])
+
+            proof = tree.prove_contains([key]).serialize()
+            self.assertEqual(treecls.deserialize(proof).hash, tree.hash)
+            self.assertEqual(verify_proof(treecls, proof, tree.hash, [key]), {key: treecls.calc_value_hash(bytes([3]))})
+            root_hashes.add(tree.hash)
+        self.assertEqual(len(root_hashes), 3)
+
+        # Trees with different hashes don't mix
+        with self.assertRaises(TypeError):
+            SHA256MerbinnerTree(items).update(BLAKE2bMerbinnerTree(items))
+
+        # Batches of node hash data go through hash_many()
+        @make_MerbinnerTree_class
+        class CountingTree(SHA256MerbinnerTree):
+            __slots__ = []
+            batches = []
+
+            @classmethod
+            def hash_many(cls, datas):
+                cls.batches.append(len(datas))
+                return super().hash_many(datas)
+
+        tree = CountingTree(items)
+        self.assertEqual(tree.compute_hashes(), SHA256MerbinnerTree(items).hash)
+        self.assertEqual(sum(CountingTree.batches), 16 + 15 + 4)
+        self.assertEqual(len(CountingTree.batches), 9)
+
+    def test_compute_hashes(self):
+        def iter_nodes(tree):
+            stack = [tree]
+            while stack:
+                node = stack.pop()
+                yield node
+                if isinstance(node, TestTree.InnerNodeClass):
+                    stack.append(node.left)
+                    stack.append(node.right)
+
+        items = [(os.urandom(32), os.urandom(32)) for i in range(1000)]
+        expected_hash = TestTree(items).hash
+
+        for max_workers in (None, 1, 4):
+            tree = TestTree(items)
+            self.assertEqual(tree.compute_hashes(max_workers=max_workers), expected_hash)
+            for node in iter_nodes(tree):
+                node._mt_cached_hash
+
+            # Only the changed spine needs hashing after an update
+            new_items = [(os.urandom(32), os.urandom(32)) for i in range(10)]
+            tree2 = tree.put_many(new_items)
+            self.assertEqual(tree2.compute_hashes(max_workers=max_workers),
+                             TestTree(items + new_items).hash)
+
+        self.assertEqual(TestTree().compute_hashes(), TestTree().hash)
+        tree = TestTree().put(k(b'\x00'), b'a')
+        self.assertEqual(tree.compute_hashes(max_workers=4), tree.hash)
+
+        # Pruned trees have some hashes that can't be recalculated
+        pruned_tree = TestTree(items).prove_contains([items[0][0]])
+        self.assertEqual(pruned_tree.compute_hashes(max_workers=4), expected_hash)
+
+    def test_from_items_parallel(self):
+        items = [(os.urandom(32), os.urandom(32)) for i in range(2000)]
+        items.append((k(b'\x00'), b'a'))
+        items.append((k(b'\x00\x01'), b'b'))
+        expected_hash = TestTree(items).hash
+
+        for shard_bits in (0, 1, 3, 9):
+            tree = TestTree.from_items_parallel(items, max_workers=2, shard_bits=shard_bits)
+            self.assertEqual(tree.hash, expected_hash)
+            self.assertEqual(set(tree.items()), set(items))
+
+            pruned_tree = TestTree.from_items_parallel(items, max_workers=2, shard_bits=shard_bits,
+                                                       hash_only=True)
+            self.assertEqual(pruned_tree.hash, expected_hash)
+
+        # Trees smaller than the number of shards
+        for items in ([], [(k(b'\x00'), b'a')], [(k(b'\x00'), b'a'), (k(b'\x01'), b'b')]):
+            tree = TestTree.from_items_parallel(items, max_workers=2, shard_bits=4)
+            self.assertEqual(tree.hash, TestTree(items).hash)
+            if len(items) < 2:
+                self.assertIs(type(tree), type(TestTree(items)))
+
+        with self.assertRaises(ValueError):
+            TestTree.from_items_parallel([(k(b'\x00'), b'a'), (k(b'\x00'), b'b')], max_workers=2)
+
+    def test_serialize(self):
+        # Each node type
+        self.assertEqual(TestTree().serialize(), b'\x01\x00')
+
+        tree = TestTree().put(k(b'\x00'), b'a')
+        self.assertEqual(tree.serialize(), b'\x01\x03' + k(b'\x00') + b'\x01a')
+
+        pruned_tree = tree.prove_contains([])
+        self.assertEqual(pruned_tree.serialize(),
+                         b'\x01\x04' + k(b'\x00') + hashlib.sha256(b'a').digest())
+
+        tree = tree.put(k(b'\xff'), b'b')
+        self.assertEqual(tree.serialize(),
+                         b'\x01\x01\x03' + k(b'\xff') + b'\x01b' + b'\x03' + k(b'\x00') + b'\x01a')
+        self.assertEqual(tree.prove_contains([]).serialize(), b'\x01\x02' + tree.hash)
+
+        tree = TestTree().put(k(b'\xff'), b'a').put(k(b'\x80'), b'b')
+        self.assertEqual(tree.serialize()[0:3], b'\x01\x01\x01')
+        self.assertEqual(tree.serialize()[-1:], b'\x00')
+
+        # Values longer than one varint byte
+        tree = TestTree().put(k(b'\x00'), b'a' * 1000)
+        self.assertEqual(tree.serialize()[34:36], b'\xe8\x07')
+
+        # Streaming to a file-like object gives the same result
+        import io
+        tree = TestTree((os.urandom(32), os.urandom(32)) for i in range(100))
+        f = io.BytesIO()
+        tree.stream_serialize(f)
+        self.assertEqual(f.getvalue(), tree.serialize())
+
+        with self.assertRaises(ValueError):
+            LegacySHA256MerbinnerTree().serialize()
+
+    def test_deserialize(self):
+        def T(data):
+            return TestTree.deserialize(data)
+
+        self.assertIs(T(b'\x01\x00'), TestTree())
+        tree = TestTree().put(k(b'\xff'), b'a').put(k(b'\x80'), b'b')
+        self.assertEqual(T(tree.serialize()).hash, tree.hash)
+
+        # Pruned hashes are copied out of the buffer, which can then change
+        pruned_tree = tree.prove_contains([k(b'\xff')])
+        buf = bytearray(pruned_tree.serialize())
+        pruned_tree2 = T(buf)
+        self.assertEqual(pruned_tree2.hash, tree.hash)
+        self.assertIs(type(pruned_tree2.left.right.value_hash), bytes)
+        pruned_inner = T(tree.prove_contains([]).serialize())
+        self.assertIs(type(pruned_inner.hash), bytes)
+        self.assertEqual(pickle.loads(pickle.dumps(pruned_inner.hash)), tree.hash)
+        buf.clear()
+        self.assertEqual(pruned_tree2.hash, tree.hash)
+
+        for bad in (b'',
+                    b'\x02\x00',              # unknown version
+                    b'\x01',                  # truncated
+                    b'\x01\x01\x00',
+                    b'\x01\x02' + b'\x00'*31,
+                    b'\x01\x03' + k(b'\x00'),
+                    b'\x01\x03' + k(b'\x00') + b'\x02a',
+                    b'\x01\x03' + k(b'\x00') + b'\x81\x00a',  # non-minimal varint
+                    b'\x01\x00\x00',          # extra bytes
+                    b'\x01\x05',              # unknown tag
+                    b'\x01\x01\x00\x00',      # not collapsed
+                    b'\x01\x01\x00\x03' + k(b'\x00') + b'\x01a',
+                    b'\x01\x01\x03' + k(b'\x00') + b'\x01a\x00',
+                    # leaves on the wrong sides
+                    b'\x01\x01\x03' + k(b'\x00') + b'\x01a\x03' + k(b'\xff') + b'\x01b',
+                    b'\x01' + b'\x01\x00' * 256 + b'\x00',  # too deep
+                    b'\x01\x03' + k(b'\x00') + b'\xff' * 10 + b'\x01'):  # varint too large
+            with self.assertRaises(TestTree.DeserializationError):
+                T(bad)
+
+    def test_deserialize_limits(self):
+        tree = TestTree((bytes([i]) * 32, bytes([i])) for i in range(16))
+        buf = tree.prove_contains([bytes([3]) * 32]).serialize()
+        n_nodes = 2 * 8 + 1     # eight levels deep, with a leaf at the bottom
+
+        self.assertEqual(TestTree.deserialize(buf, max_depth=8, max_nodes=n_nodes, max_bytes=len(buf)).hash,
+                         tree.hash)
+        for limits in ({'max_depth': 7}, {'max_nodes': n_nodes - 1}, {'max_bytes': len(buf) - 1}):
+            with self.assertRaises(TestTree.DeserializationError):
+                TestTree.deserialize(buf, **limits)
+
+        # Depth is never more than the key size allows
+        with self.assertRaises(TestTree.DeserializationError):
+            TestTree.deserialize(b'\x01' + b'\x01\x00' * 256 + b'\x00', max_depth=1000)
+
+    def test_deserialize_arena(self):
+        rng = random.Random(0)
+        items = [(rng.getrandbits(256).to_bytes(32, 'big'), b'%d' % i) for i in range(300)]
+        tree = TestTree(items)
+        buf = tree.serialize()
+
+        arena_tree = TestTree.deserialize(buf, arena=True)
+        self.assertEqual(arena_tree.hash, tree.hash)
+        self.assertEqual(arena_tree.serialize(), buf)
+        self.assertEqual(list(arena_tree.items()), list(tree.items()))
+        key, value = items[0]
+        self.assertEqual(arena_tree[key], value)
+        self.assertIsInstance(arena_tree._mt_get_leaf(key), TestTree.ArenaLeafNodeClass)
+        self.assertIs(type(arena_tree._mt_get_leaf(key).key), bytes)
+
+        # Arena leaves mix with ordinary ones
+        changes = [(key, b'changed'), (os.urandom(32), b'new')]
+        new_tree = arena_tree.put_many(changes)
+        self.assertEqual(new_tree.hash, tree.put_many(changes).hash)
+        self.assertEqual([k for k, old, new in arena_tree.diff(new_tree)],
+                         [k for k, old, new in tree.diff(new_tree)])
+        self.assertEqual(arena_tree.prove_contains([key]).serialize(), tree.prove_contains([key]).serialize())
+
+        # Straight from a mapped file
+        with tempfile.TemporaryFile() as f:
+            f.write(buf)
+            f.flush()
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                mapped_tree = TestTree.deserialize(m, arena=True)
+                self.assertEqual(mapped_tree.compute_hashes(), tree.hash)
+                self.assertEqual(mapped_tree[key], value)
+                del mapped_tree
+
+    def test_serialize_roundtrip_fuzz(self):
+        rng = random.Random(0)
+        for n in (0, 1, 2, 3, 10, 100, 500):
+            items = [(rng.getrandbits(256).to_bytes(32, 'big'), os.urandom(rng.randrange(0, 300)))
+                     for i in range(n)]
+            # Some keys sharing long prefixes
+            items += [(k(b'\x55' * rng.randrange(1, 31) + bytes([i])), b'x') for i in range(3)]
+            tree = TestTree(items)
+            keys = [key for key, value in items]
+
+            for i in range(10):
+                subset = rng.sample(keys, rng.randrange(0, len(keys)+1))
+                subset += [os.urandom(32) for j in range(rng.randrange(0, 3))]
+                pruned_tree = tree.prove_contains(subset)
+
+                buf = pruned_tree.serialize()
+                pruned_tree2 = TestTree.deserialize(buf)
+                self.assertEqual(pruned_tree2.hash, tree.hash)
+                self.assertEqual(pruned_tree2.serialize(), buf)
+                for key in subset:
+                    self.assertEqual(key in pruned_tree2, key in tree)
+
+                # Damaged serializations either fail cleanly, or deserialize
+                # into something that serializes back to the same bytes.
+                for j in range(20):
+                    bad = bytearray(buf)
+                    what = rng.randrange(3)
+                    if what == 0:
+                        bad[rng.randrange(len(bad))] = rng.randrange(256)
+                    elif what == 1:
+                        del bad[rng.randrange(len(bad)):]
+                    else:
+                        bad.insert(rng.randrange(len(bad)+1), rng.randrange(256))
+                    bad = bytes(bad)
+
+                    try:
+                        bad_tree = TestTree.deserialize(bad)
+                    except TestTree.DeserializationError:
+                        continue
+                    self.assertEqual(bad_tree.serialize(), bad)
@@ -0,0 +1,137 @@
+# Copyright (C) 2014 Peter Todd <pete@petertodd.org>
+#
+# This file is part of python-merbinnertree.
+#
+# It is subject to the license terms in the LICENSE file found in the top-level
+# directory of this distribution.
+#
+# No part of python-merbinnertree, including this file, may be copied,
+# modified, propagated, or distributed except according to the terms contained
+# in the LICENSE file.
+
+import gc
+import hashlib
+import random
+import unittest
+
+from merbinnertree import SHA256MerbinnerTree, make_MerbinnerTree_baseclass, make_MerbinnerTree_class
+from merbinnertree.intern import InternTable
+
+@make_MerbinnerTree_class
+class TestTree(SHA256MerbinnerTree):
+    __slots__ = []
+    WEAKREFS = True
+
+def random_items(n, seed=0):
+    rng = random.Random(seed)
+    return [(rng.getrandbits(256).to_bytes(32, 'big'), b'%d' % i) for i in range(n)]
+
+class Test_InternTable(unittest.TestCase):
+    def test_replicas(self):
+        items = random_items(200)
+        table = InternTable()
+
+        tree1 = TestTree(items, intern=table)
+        self.assertEqual(table.hits, 0)
+        self.assertEqual(len(table), table.misses)
+
+        # The same items built separately give the same object
+        misses = table.misses
+        tree2 = TestTree(list(reversed(items)), intern=table)
+        self.assertIs(tree2, tree1)
+        self.assertEqual(table.misses, misses)
+
+        # Interning a tree that's already interned finds it right away
+        hits = table.hits
+        self.assertIs(table.intern(tree1), tree1)
+        self.assertEqual(table.hits, hits + 1)
+
+        # A tree that differs in one item shares everything else
+        tree3 = TestTree.from_sorted_items(sorted(items[1:], reverse=True), intern=table)
+        self.assertEqual(tree3.hash, tree1.remove(items[0][0]).hash)
+        shared = {id(node) for node in tree1._mt_iter_nodes()}
+        new_nodes = [node for node in tree3._mt_iter_nodes() if id(node) not in shared]
+        self.assertLess(len(new_nodes), 20)
+        self.assertEqual(list(tree1.diff(tree3)), [(items[0][0], tree1._mt_get_leaf(items[0][0]), None)])
+
+    def test_proofs(self):
+        items = random_items(200)
+        tree = TestTree(items)
+        table = InternTable()
+
+        key1, key2 = items[0][0], items[1][0]
+        proof1 = TestTree.deserialize(tree.prove_contains([key1]).serialize(), intern=table)
+        proof2 = TestTree.deserialize(tree.prove_contains([key1, key2]).serialize(), intern=table)
+        self.assertGreater(table.hits, 0)
+        proof1_nodes = {id(node) for node in proof1._mt_iter_nodes()}
+        self.assertTrue(any(id(node) in proof1_nodes for node in proof2._mt_iter_nodes()))
+        self.assertEqual(proof2.merge(proof1).hash, tree.hash)
+
+        # Pruned nodes aren't made into full ones, or the other way around
+        full = TestTree.deserialize(tree.serialize(), intern=table)
+        self.assertEqual(full.serialize(), tree.serialize())
+        self.assertEqual(TestTree.deserialize(proof1.serialize(), intern=table).serialize(), proof1.serialize())
+
+    def test_weak(self):
+        table = InternTable()
+        tree = TestTree(random_items(100), intern=table)
+        self.assertGreater(len(table), 100)
+        del tree
+        gc.collect()
+        self.assertEqual(len(table), 0)
+
+    def test_opt_in(self):
+        # Trees that don't set WEAKREFS don't pay for the slot, and can't be
+        # interned
+        tree = SHA256MerbinnerTree(random_items(10))
+        self.assertEqual(SHA256MerbinnerTree.InnerNodeClass.__weakrefoffset__, 0)
+        self.assertEqual(SHA256MerbinnerTree.FullLeafNodeClass.__weakrefoffset__, 0)
+        with self.assertRaises(TypeError):
+            InternTable().intern(tree)
+        with self.assertRaises(TypeError):
+            SHA256MerbinnerTree(random_items(10), intern=InternTable())
+
+        self.assertEqual(TestTree(random_items(10)).hash, tree.hash)
+
+    def test_basecls(self):
+        # A basecls without __slots__ already has a __weakref__ slot
+        class Base:
+            pass
+
+        @make_MerbinnerTree_class
+        class BaseTree(make_MerbinnerTree_baseclass(Base)):
+            __slots__ = []
+            KEYSIZE = 32
+            HASHSIZE = 32
+
+            @classmethod
+            def check_value(cls, value):
+                pass
+
+            @staticmethod
+            def hash_func(data):
+                return hashlib.sha256(data).digest()
+
+            @staticmethod
+            def calc_value_hash(value):
+                return hashlib.sha256(value).digest()
+
+        items = random_items(100)
+        table = InternTable()
+        tree = BaseTree(items, intern=table)
+        self.assertIsInstance(tree, Base)
+        self.assertEqual(tree.hash, TestTree(items).hash)
+        self.assertIs(BaseTree(items, intern=table), tree)
+        del tree
+        gc.collect()
+        self.assertEqual(len(table), 0)
+
+        # Setting WEAKREFS as well doesn't add a second slot
+        @make_MerbinnerTree_class
+        class WeakBaseTree(BaseTree):
+            __slots__ = []
+            WEAKREFS = True
+        self.assertIs(WeakBaseTree(items, intern=table), WeakBaseTree(items, intern=table))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,100 @@
+# Copyright (C) 2014 Peter Todd <pete@petertodd.org>
+#
+# This file is part of python-merbinnertree.
+#
+# It is subject to the license terms in the LICENSE file found in the top-level
+# directory of this distribution.
+#
+# No part of python-merbinnertree, including this file, may be copied,
+# modified, propagated, or distributed except according to the terms contained
+# in the LICENSE file.
+
+import random
+import unittest
+
+from merbinnertree import SHA256MerbinnerTree
+from merbinnertree.proofcache import ProofCache
+
+TestTree = SHA256MerbinnerTree
+
+def random_tree(n, seed=0):
+    rng = random.Random(seed)
+    return TestTree((rng.getrandbits(256).to_bytes(32, 'big'), b'%d' % i) for i in range(n))
+
+class Test_ProofCache(unittest.TestCase):
+    def test_hits(self):
+        tree = random_tree(100)
+        keys = list(tree.keys())
+        cache = ProofCache()
+
+        proof = cache.prove_contains(tree, keys[0:2])
+        self.assertEqual(proof.serialize(), tree.prove_contains(keys[0:2]).serialize())
+        self.assertEqual((cache.hits, cache.misses), (0, 1))
+
+        # Order of the keys doesn't matter
+        self.assertIs(cache.prove_contains(tree, reversed(keys[0:2])), proof)
+        buf = cache.prove_contains_serialized(tree, keys[0:2])
+        self.assertEqual(buf, proof.serialize())
+        self.assertEqual((cache.hits, cache.misses), (2, 1))
+        self.assertEqual(cache.hit_rate, 2/3)
+        self.assertEqual(cache.bytes_saved, 2 * len(buf))
+
+        with self.assertRaises(TypeError):
+            cache.prove_contains(tree, ['a'])
+
+    def test_eviction(self):
+        tree = random_tree(100)
+        keys = list(tree.keys())
+
+        cache = ProofCache(max_entries=2)
+        for key in keys[0:3]:
+            cache.prove_contains(tree, [key])
+        self.assertEqual(len(cache), 2)
+        cache.prove_contains(tree, [keys[1]])
+        cache.prove_contains(tree, [keys[0]])
+        self.assertEqual(cache.hits, 1)
+
+        # The least recently used, keys[2], was evicted
+        cache.prove_contains(tree, [keys[1]])
+        self.assertEqual(cache.hits, 2)
+
+        size = len(tree.prove_contains([keys[0]]).serialize())
+        cache = ProofCache(max_bytes=size * 3 // 2)
+        cache.prove_contains(tree, [keys[0]])
+        cache.prove_contains(tree, [keys[1]])
+        self.assertEqual(len(cache), 1)
+        self.assertLessEqual(cache.n_bytes, size * 3 // 2)
+
+    def test_root_changes(self):
+        tree = random_tree(1000)
+        keys = list(tree.keys())
+        hot_keys = keys[0:3]
+        cache = ProofCache()
+        old_proof = cache.prove_contains(tree, hot_keys)
+
+        # Change something on the other side of the tree
+        new_tree = tree.put(keys[-1], b'changed')
+        new_proof = cache.prove_contains(new_tree, hot_keys)
+        self.assertEqual(cache.reuses, 1)
+        self.assertEqual(new_proof.serialize(), new_tree.prove_contains(hot_keys).serialize())
+        self.assertIs(new_proof.left, old_proof.left)
+
+        # Change one of the hot keys
+        newer_tree = new_tree.put(hot_keys[0], b'changed')
+        newer_proof = cache.prove_contains(newer_tree, hot_keys)
+        self.assertEqual(cache.reuses, 2)
+        self.assertEqual(newer_proof.serialize(), newer_tree.prove_contains(hot_keys).serialize())
+        self.assertEqual(newer_proof[hot_keys[0]], b'changed')
+
+        # Proofs for the old roots are still there until invalidated
+        self.assertIs(cache.prove_contains(tree, hot_keys), old_proof)
+        cache.invalidate(tree.hash)
+        cache.invalidate(new_tree.hash)
+        self.assertEqual(len(cache), 1)
+        self.assertIsNot(cache.prove_contains(tree, hot_keys), old_proof)
+
+        cache.clear()
+        self.assertEqual((len(cache), cache.n_bytes), (0, 0))
+
+if __name__ == '__main__':
+    unittest.main()
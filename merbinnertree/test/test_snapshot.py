@@ -0,0 +1,71 @@
+# Copyright (C) 2014 Peter Todd <pete@petertodd.org>
+#
+# This file is part of python-merbinnertree.
+#
+# It is subject to the license terms in the LICENSE file found in the top-level
+# directory of this distribution.
+#
+# No part of python-merbinnertree, including this file, may be copied,
+# modified, propagated, or distributed except according to the terms contained
+# in the LICENSE file.
+
+import random
+import unittest
+
+from merbinnertree import SHA256MerbinnerTree
+from merbinnertree.snapshot import Snapshot
+
+TestTree = SHA256MerbinnerTree
+
+def k(key):
+    return key.ljust(32, b'\x00')
+
+class Test_Snapshot(unittest.TestCase):
+    def test_small_trees(self):
+        for items in ([], [(k(b'\x00'), b'a')], [(k(b'\x00'), b'a'), (k(b'\xff'), b'')]):
+            tree = TestTree(items)
+            snapshot = Snapshot.from_tree(tree)
+            self.assertEqual(snapshot.hash, tree.hash)
+            self.assertEqual(len(snapshot), len(items))
+            self.assertEqual(list(snapshot.items()), list(tree.items()))
+            self.assertEqual(snapshot.to_tree().hash, tree.hash)
+            self.assertEqual(snapshot.prove_contains([k(b'\x00')]).serialize(),
+                             tree.prove_contains([k(b'\x00')]).serialize())
+
+    def test_random(self):
+        rng = random.Random(0)
+        items = [(rng.getrandbits(256).to_bytes(32, 'big'), b'%d' % i) for i in range(500)]
+        tree = TestTree(items)
+        snapshot = Snapshot.from_tree(tree)
+
+        self.assertEqual(snapshot.hash, tree.hash)
+        self.assertEqual(list(snapshot.items()), list(tree.items()))
+        self.assertEqual(list(snapshot.keys()), list(tree.keys()))
+        self.assertEqual(list(snapshot.values()), list(tree.values()))
+
+        for key, value in items[0:50]:
+            self.assertIn(key, snapshot)
+            self.assertEqual(snapshot[key], value)
+        missing_key = rng.getrandbits(256).to_bytes(32, 'big')
+        self.assertNotIn(missing_key, snapshot)
+        with self.assertRaises(KeyError):
+            snapshot[missing_key]
+        with self.assertRaises(TypeError):
+            snapshot['a']
+
+        for i in range(20):
+            keys = [key for key, value in rng.sample(items, rng.randrange(4))]
+            keys.append(rng.getrandbits(256).to_bytes(32, 'big'))
+            self.assertEqual(snapshot.prove_contains(keys).serialize(), tree.prove_contains(keys).serialize())
+
+        tree2 = snapshot.to_tree()
+        self.assertEqual(list(tree2.items()), list(tree.items()))
+        self.assertEqual(tree2.compute_hashes(), tree.hash)
+
+    def test_pruned(self):
+        tree = TestTree([(k(b'\x00'), b'a'), (k(b'\xff'), b'b')])
+        with self.assertRaises(TestTree.PrunedError):
+            Snapshot.from_tree(tree.prove_contains([k(b'\x00')]))
+
+if __name__ == '__main__':
+    unittest.main()
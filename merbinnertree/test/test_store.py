@@ -0,0 +1,196 @@
+# Copyright (C) 2014 Peter Todd <pete@petertodd.org>
+#
+# This file is part of python-merbinnertree.
+#
+# It is subject to the license terms in the LICENSE file found in the top-level
+# directory of this distribution.
+#
+# No part of python-merbinnertree, including this file, may be copied,
+# modified, propagated, or distributed except according to the terms contained
+# in the LICENSE file.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from merbinnertree import SHA256MerbinnerTree
+from merbinnertree.store import NodeStore, LRUNodeCache, ClockNodeCache
+
+def k(key):
+    return key.ljust(32, b'\x00')
+
+TestTree = SHA256MerbinnerTree
+
+class Test_NodeStore(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'nodes')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_small_trees(self):
+        with NodeStore(TestTree, self.path) as store:
+            for tree in (TestTree(),
+                         TestTree().put(k(b'\x00'), b'a'),
+                         TestTree().put(k(b'\x00'), b'a').put(k(b'\xff'), b'b'),
+                         TestTree().put(k(b'\xff'), b'a').put(k(b'\x80'), b'b')):
+                root_hash = store.add(tree)
+                self.assertEqual(root_hash, tree.hash)
+                tree2 = store.get(root_hash)
+                self.assertEqual(tree2.hash, tree.hash)
+                self.assertEqual(set(tree2.items()), set(tree.items()))
+
+            self.assertIs(store.get(TestTree().hash), TestTree())
+
+            with self.assertRaises(KeyError):
+                store.get(os.urandom(32))
+
+    def test_lazy_loading(self):
+        items = [(os.urandom(32), os.urandom(32)) for i in range(1000)]
+        tree = TestTree(items)
+
+        with NodeStore(TestTree, self.path) as store:
+            root_hash = store.add(tree)
+
+        size = os.path.getsize(self.path)
+
+        with NodeStore(TestTree, self.path) as store:
+            tree2 = store.get(root_hash)
+            self.assertIsInstance(tree2, TestTree.LazyInnerNodeClass)
+            self.assertIsInstance(tree2.left, TestTree.LazyInnerNodeClass)
+            self.assertEqual(tree2.hash, root_hash)
+
+            for key, value in items[0:10]:
+                self.assertEqual(tree2[key], value)
+            self.assertNotIn(os.urandom(32), tree2)
+            self.assertEqual(set(tree2.items()), set(items))
+
+            # Proofs from lazy trees are the same as from the in-memory tree
+            pruned_tree = tree2.prove_contains([items[0][0]])
+            self.assertEqual(pruned_tree.serialize(), tree.prove_contains([items[0][0]]).serialize())
+            self.assertEqual(tree2.serialize(), tree.serialize())
+
+            # Modifying a lazy tree only loads and copies the changed path,
+            # and storing the result only writes the new nodes.
+            tree3 = tree2.put(items[0][0], b'changed').remove(items[1][0])
+            self.assertIsInstance(tree3.left, (TestTree.LazyInnerNodeClass, TestTree.InnerNodeClass))
+            self.assertEqual(tree3.hash, TestTree([(items[0][0], b'changed')] + items[2:]).hash)
+
+            n = len(store)
+            self.assertEqual(store.add(tree3), tree3.hash)
+            self.assertLess(len(store) - n, 100)
+            self.assertEqual(store.get(tree3.hash).hash, tree3.hash)
+            self.assertEqual(store.get(root_hash).hash, root_hash)
+
+            # Adding the same tree again writes nothing
+            store.flush()
+            size = os.path.getsize(self.path)
+            store.add(tree)
+            store.add(tree3)
+            store.flush()
+            self.assertEqual(os.path.getsize(self.path), size)
+
+    def test_pruned_trees(self):
+        items = [(os.urandom(32), os.urandom(32)) for i in range(100)]
+        tree = TestTree(items)
+        pruned_tree = tree.prove_contains([items[0][0]])
+
+        with NodeStore(TestTree, self.path) as store:
+            store.add(pruned_tree)
+            tree2 = store.get(tree.hash)
+            self.assertEqual(tree2[items[0][0]], items[0][1])
+            with self.assertRaises(TestTree.PrunedError):
+                tree2[items[1][0]]
+
+    def test_truncated_record(self):
+        items = [(os.urandom(32), os.urandom(32)) for i in range(10)]
+        with NodeStore(TestTree, self.path) as store:
+            root_hash = store.add(TestTree(items[0:5]))
+            store.flush()
+            size = os.path.getsize(self.path)
+            store.add(TestTree(items))
+
+        with open(self.path, 'r+b') as fd:
+            fd.truncate(size + 10)
+
+        with NodeStore(TestTree, self.path) as store:
+            self.assertEqual(os.path.getsize(self.path), size)
+            self.assertEqual(set(store.get(root_hash).items()), set(items[0:5]))
+
+    def test_bad_header(self):
+        with open(self.path, 'wb') as fd:
+            fd.write(b'not a node store')
+        with self.assertRaises(ValueError):
+            NodeStore(TestTree, self.path)
+
+class Test_NodeCache(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'nodes')
+
+        self.items = [(os.urandom(32), os.urandom(32)) for i in range(1000)]
+        with NodeStore(TestTree, self.path) as store:
+            self.root_hash = store.add(TestTree(self.items))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_policies(self):
+        for cachecls in (LRUNodeCache, ClockNodeCache):
+            for max_nodes, max_bytes in ((None, None), (50, None), (None, 3000), (1, None)):
+                cache = cachecls(max_nodes=max_nodes, max_bytes=max_bytes, pin_levels=3)
+                with NodeStore(TestTree, self.path, cache=cache) as store:
+                    tree = store.get(self.root_hash)
+                    for i in range(3):
+                        for key, value in self.items[0:300]:
+                            self.assertEqual(tree[key], value)
+
+                    if max_nodes is not None:
+                        self.assertLessEqual(cache.n_nodes, max_nodes)
+                    if max_bytes is not None:
+                        self.assertLessEqual(cache.n_bytes, max_bytes)
+                    if max_nodes is None and max_bytes is None:
+                        self.assertEqual(cache.evictions, 0)
+                    else:
+                        self.assertGreater(cache.evictions, 0)
+
+                    # The top of the tree is pinned
+                    self.assertEqual(len(cache._pinned), 7)
+                    self.assertGreater(cache.hits, 0)
+                    self.assertEqual(cache.hit_rate, cache.hits / (cache.hits + cache.misses))
+
+                    self.assertEqual(set(tree.items()), set(self.items))
+
+                    cache.clear()
+                    self.assertEqual(len(cache), 0)
+                    self.assertEqual(tree[self.items[0][0]], self.items[0][1])
+
+    def test_hits_return_same_node(self):
+        cache = LRUNodeCache()
+        with NodeStore(TestTree, self.path, cache=cache) as store:
+            tree = store.get(self.root_hash)
+            self.assertIs(tree.left, tree.left)
+            self.assertEqual(cache.misses, 1)
+            self.assertEqual(cache.hits, 1)
+
+    def test_lru_order(self):
+        cache = LRUNodeCache(max_nodes=2)
+        cache.add(b'a', 'A', 5, 1)
+        cache.add(b'b', 'B', 5, 1)
+        self.assertEqual(cache.get(b'a'), 'A')
+        cache.add(b'c', 'C', 5, 1)
+        self.assertIsNone(cache.get(b'b'))
+        self.assertEqual(cache.get(b'a'), 'A')
+        self.assertEqual(cache.get(b'c'), 'C')
+
+    def test_clock_second_chance(self):
+        cache = ClockNodeCache(max_nodes=2)
+        cache.add(b'a', 'A', 5, 1)
+        cache.add(b'b', 'B', 5, 1)
+        self.assertEqual(cache.get(b'a'), 'A')
+        cache.add(b'c', 'C', 5, 1)
+        self.assertIsNone(cache.get(b'b'))
+        self.assertEqual(cache.get(b'a'), 'A')
+        self.assertEqual(cache.get(b'c'), 'C')
@@ -0,0 +1,140 @@
+# Copyright (C) 2014 Peter Todd <pete@petertodd.org>
+#
+# This file is part of python-merbinnertree.
+#
+# It is subject to the license terms in the LICENSE file found in the top-level
+# directory of this distribution.
+#
+# No part of python-merbinnertree, including this file, may be copied,
+# modified, propagated, or distributed except according to the terms contained
+# in the LICENSE file.
+
+import random
+import unittest
+
+from merbinnertree import SHA256MerbinnerTree, make_MerbinnerTree_class
+from merbinnertree.verify import verify_proof
+
+@make_MerbinnerTree_class
+class SumTree(SHA256MerbinnerTree):
+    """Sum tree where each value adds its length"""
+    __slots__ = []
+    SUMSIZE = 8
+
+    @staticmethod
+    def calc_value_sum(value):
+        return len(value)
+
+def random_items(n, seed=0):
+    rng = random.Random(seed)
+    return [(rng.getrandbits(256).to_bytes(32, 'big'), b'x' * rng.randrange(100)) for i in range(n)]
+
+def slow_range_sum(items, start, end):
+    return sum(len(value) for key, value in items
+               if (start is None or start <= key) and (end is None or key < end))
+
+class Test_SumTree(unittest.TestCase):
+    def test_sums(self):
+        self.assertEqual(SumTree().sum(), 0)
+        self.assertEqual(SumTree([(b'\x00' * 32, b'abc')]).sum(), 3)
+
+        items = random_items(200)
+        tree = SumTree(items)
+        self.assertEqual(tree.sum(), sum(len(value) for key, value in items))
+        self.assertNotEqual(tree.hash, SHA256MerbinnerTree(items).hash)
+
+        rng = random.Random(1)
+        keys = sorted(key for key, value in items)
+        for i in range(100):
+            start, end = sorted(rng.sample(keys, 2))
+            self.assertEqual(tree.range_sum(start, end), slow_range_sum(items, start, end))
+        self.assertEqual(tree.range_sum(keys[10]), slow_range_sum(items, keys[10], None))
+        self.assertEqual(tree.range_sum(None, keys[10]), slow_range_sum(items, None, keys[10]))
+        self.assertEqual(tree.range_sum(keys[10], keys[10]), 0)
+
+        # Sums follow changes
+        tree2 = tree.put(keys[0], b'x' * 1000).remove(keys[1])
+        self.assertEqual(tree2.sum(), tree.sum() + 1000 - len(tree[keys[0]]) - len(tree[keys[1]]))
+
+        # Same value, different sum, different hash
+        leaf = SumTree.FullLeafNodeClass(keys[0], b'')
+        self.assertNotEqual(leaf.hash, SumTree.PrunedLeafNodeClass(keys[0], SumTree.calc_value_hash(b''), 1).hash)
+
+        with self.assertRaises(TypeError):
+            SHA256MerbinnerTree(items).sum()
+        with self.assertRaises(TypeError):
+            SumTree.PrunedInnerNodeClass(tree.hash)
+
+    def test_prove_range_sum(self):
+        items = random_items(1000)
+        tree = SumTree(items)
+        keys = sorted(key for key, value in items)
+        start, end = keys[100], keys[900]
+
+        expected = slow_range_sum(items, start, end)
+        range_sum, proof = tree.prove_range_sum(start, end)
+        self.assertEqual(range_sum, expected)
+        self.assertEqual(proof.hash, tree.hash)
+        self.assertEqual(proof.range_sum(start, end), expected)
+
+        # Only the paths to either end are in the proof
+        self.assertLess(len(list(proof._mt_iter_nodes())), 4 * 2 * 20)
+
+        proof2 = SumTree.deserialize(proof.serialize())
+        self.assertEqual(proof2.hash, tree.hash)
+        self.assertEqual(proof2.range_sum(start, end), expected)
+
+        with self.assertRaises(SumTree.PrunedError):
+            proof.range_sum(keys[500], end)
+
+        total, proof = tree.prove_range_sum()
+        self.assertEqual(proof.range_sum(), total)
+        self.assertEqual(proof.sum(), tree.sum())
+
+        # Nothing commits to the sum of a pruned root.
+        with self.assertRaises(SumTree.PrunedError):
+            tree.prove_contains([]).sum()
+
+    def test_serialization(self):
+        items = random_items(100)
+        tree = SumTree(items)
+        keys = [key for key, value in items[0:3]]
+        proof = tree.prove_contains(keys)
+        buf = proof.serialize()
+
+        proof2 = SumTree.deserialize(buf)
+        self.assertEqual(proof2.hash, tree.hash)
+        self.assertEqual(proof2.sum(), tree.sum())
+        self.assertEqual(proof2.serialize(), buf)
+
+        # Changing a pruned node's sum changes the hash
+        for i in range(len(buf)):
+            bad_buf = bytearray(buf)
+            bad_buf[i] ^= 1
+            try:
+                bad_proof = SumTree.deserialize(bytes(bad_buf))
+            except SumTree.DeserializationError:
+                continue
+            self.assertNotEqual(bad_proof.hash, tree.hash)
+
+        self.assertEqual(SumTree.from_items_parallel(items, max_workers=2, hash_only=True).sum(), tree.sum())
+
+        with self.assertRaises(ValueError):
+            verify_proof(SumTree, buf, tree.hash, keys)
+
+    def test_mixed_classes(self):
+        # SumTree subclasses SHA256MerbinnerTree, but hashes differently
+        items = random_items(10)
+        tree = SHA256MerbinnerTree(items)
+        sum_tree = SumTree(items)
+        with self.assertRaises(TypeError):
+            tree.update(sum_tree)
+        with self.assertRaises(TypeError):
+            sum_tree.update(tree)
+        with self.assertRaises(TypeError):
+            tree.merge(sum_tree)
+        with self.assertRaises(TypeError):
+            SumTree.merge_all([sum_tree, tree])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,127 @@
+# Copyright (C) 2014 Peter Todd <pete@petertodd.org>
+#
+# This file is part of python-merbinnertree.
+#
+# It is subject to the license terms in the LICENSE file found in the top-level
+# directory of this distribution.
+#
+# No part of python-merbinnertree, including this file, may be copied,
+# modified, propagated, or distributed except according to the terms contained
+# in the LICENSE file.
+
+import os
+import random
+import unittest
+
+from merbinnertree import SHA256MerbinnerTree, LegacySHA256MerbinnerTree
+from merbinnertree.verify import verify_proof, verify_proofs, VerificationError
+
+def k(key):
+    return key.ljust(32, b'\x00')
+
+TestTree = SHA256MerbinnerTree
+
+class Test_verify_proof(unittest.TestCase):
+    def test_small_trees(self):
+        H = TestTree.calc_value_hash
+
+        for tree in (TestTree(),
+                     TestTree([(k(b'\x00'), b'a')]),
+                     TestTree([(k(b'\x00'), b'a'), (k(b'\xff'), b'b')]),
+                     TestTree([(k(b'\xff\x80'), b'a'), (k(b'\xff\x00'), b'b')])):
+            for keys in ([], [k(b'\x00')], [k(b'\xff\x00'), k(b'\x01')], [k(b'\x00'), k(b'\xff')]):
+                proof = tree.prove_contains(keys).serialize()
+                expected = {}
+                for key in keys:
+                    expected[key] = H(tree[key]) if key in tree else None
+                self.assertEqual(verify_proof(TestTree, proof, tree.hash, keys), expected)
+
+    def test_random(self):
+        rng = random.Random(0)
+        items = [(rng.getrandbits(256).to_bytes(32, 'big'), os.urandom(rng.randrange(40)))
+                 for i in range(300)]
+        tree = TestTree(items)
+
+        for i in range(50):
+            present = [key for key, value in rng.sample(items, rng.randrange(5))]
+            absent = [rng.getrandbits(256).to_bytes(32, 'big') for j in range(rng.randrange(5))]
+            keys = present + absent
+            proof = tree.prove_contains(keys).serialize()
+
+            results = verify_proof(TestTree, proof, tree.hash, keys)
+            self.assertEqual(set(results), set(keys))
+            for key in present:
+                self.assertEqual(results[key], TestTree.calc_value_hash(tree[key]))
+            for key in absent:
+                self.assertIsNone(results[key])
+
+    def test_batch(self):
+        rng = random.Random(0)
+        tree = TestTree((rng.getrandbits(256).to_bytes(32, 'big'), b'') for i in range(100))
+        keys = list(tree.keys())
+        batch = [(tree.prove_contains([key]).serialize(), tree.hash, [key]) for key in keys[0:10]]
+
+        results = verify_proofs(TestTree, batch)
+        self.assertEqual([list(result) for result in results], [[key] for key in keys[0:10]])
+
+        # Proof of a key at the other end of the tree
+        batch[3] = (batch[3][0], batch[3][1], [keys[-1]])
+        with self.assertRaises(VerificationError) as cm:
+            verify_proofs(TestTree, batch)
+        self.assertEqual(cm.exception.args[0], 3)
+
+    def test_failures(self):
+        tree = TestTree((bytes([i]) * 32, bytes([i])) for i in range(16))
+        key = bytes([3]) * 32
+        proof = tree.prove_contains([key]).serialize()
+
+        # Wrong root hash
+        with self.assertRaises(VerificationError):
+            verify_proof(TestTree, proof, TestTree().hash, [key])
+
+        # Key that the proof doesn't cover
+        with self.assertRaises(VerificationError):
+            verify_proof(TestTree, proof, tree.hash, [bytes([15]) * 32])
+
+        # Truncated, extended and corrupted proofs
+        for bad_proof in (proof[:-1], proof + b'\x00', b'\x00' + proof[1:], b''):
+            with self.assertRaises(VerificationError):
+                verify_proof(TestTree, bad_proof, tree.hash, [key])
+        for i in range(len(proof)):
+            bad_proof = bytearray(proof)
+            bad_proof[i] ^= 1
+            with self.assertRaises(VerificationError):
+                verify_proof(TestTree, bad_proof, tree.hash, [key])
+
+        # Leaf in the wrong place
+        left = TestTree.PrunedLeafNodeClass(k(b'\x00'), TestTree.calc_value_hash(b'a'))
+        right = TestTree.PrunedLeafNodeClass(k(b'\xff'), TestTree.calc_value_hash(b'b'))
+        bad_proof = b'\x01\x01' + left.serialize()[1:] + right.serialize()[1:]
+        bad_root = TestTree.hash_func(left.hash + right.hash + b'\x01')
+        with self.assertRaises(VerificationError):
+            verify_proof(TestTree, bad_proof, bad_root, [])
+
+        # Bad keys are the caller's fault
+        with self.assertRaises(TypeError):
+            verify_proof(TestTree, proof, tree.hash, ['a'])
+
+        with self.assertRaises(ValueError):
+            verify_proof(LegacySHA256MerbinnerTree, proof, tree.hash, [key])
+
+    def test_limits(self):
+        tree = TestTree((bytes([i]) * 32, bytes([i])) for i in range(16))
+        key = bytes([3]) * 32
+        proof = tree.prove_contains([key]).serialize()
+        n_nodes = 2 * 8 + 1
+
+        self.assertEqual(verify_proof(TestTree, proof, tree.hash, [key],
+                                      max_depth=8, max_nodes=n_nodes, max_bytes=len(proof)),
+                         {key: TestTree.calc_value_hash(bytes([3]))})
+        for limits in ({'max_depth': 7}, {'max_nodes': n_nodes - 1}, {'max_bytes': len(proof) - 1}):
+            with self.assertRaises(VerificationError):
+                verify_proof(TestTree, proof, tree.hash, [key], **limits)
+            with self.assertRaises(VerificationError):
+                verify_proofs(TestTree, [(proof, tree.hash, [key])], **limits)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,222 @@
+# Copyright (C) 2014 Peter Todd <pete@petertodd.org>
+#
+# This file is part of python-merbinnertree.
+#
+# It is subject to the license terms in the LICENSE file found in the top-level
+# directory of this distribution.
+#
+# No part of python-merbinnertree, including this file, may be copied,
+# modified, propagated, or distributed except according to the terms contained
+# in the LICENSE file.
+
+"""Verification of serialized proofs against trusted root hashes
+
+A proof is a serialized pruned tree, such as prove_contains(keys).serialize().
+The verifier works directly on the serialized bytes in a single pass, without
+creating any tree objects: it recalculates the root hash while checking each
+requested key against the part of the tree that covers it.
+"""
+
+from merbinnertree import (HASH_SCHEME_V1, SERIALIZATION_VERSION,
+                           TAG_EMPTY, TAG_INNER, TAG_PRUNED_INNER, TAG_FULL_LEAF, TAG_PRUNED_LEAF,
+                           _varint_decode)
+
+class VerificationError(ValueError):
+    """Raised when a proof doesn't prove what it's supposed to"""
+
+class _Verifier:
+    """Verifier for one tree class, with everything it needs looked up once"""
+
+    def __init__(self, treecls):
+        treecls = treecls._mt_baseclass
+        if treecls.HASH_SCHEME != HASH_SCHEME_V1:
+            raise ValueError("Can't verify proofs for hash scheme %r" % treecls.HASH_SCHEME)
+        if treecls.SUMSIZE is not None:
+            raise ValueError("Can't verify proofs for sum trees; deserialize them and check the hash instead")
+
+        self.treecls = treecls
+        self.keysize = treecls.KEYSIZE
+        self.keybits = treecls.KEYSIZE * 8
+        self.hashsize = treecls.HASHSIZE
+        self.hash_func = treecls.hash_func
+        self.empty_hash = treecls.EmptyNodeClass().hash
+
+    def verify(self, proof, root_hash, keys, max_depth=None, max_nodes=None, max_bytes=None):
+        treecls = self.treecls
+        keysize = self.keysize
+        keybits = self.keybits
+        hashsize = self.hashsize
+        hash_func = self.hash_func
+        empty_hash = self.empty_hash
+
+        if max_depth is None or max_depth > keybits:
+            max_depth = keybits
+        n_nodes = 0
+
+        # Requested keys in tree order, as ints so their prefixes can be
+        # compared with shifts.
+        for key in keys:
+            treecls.check_key(key)
+        keys = sorted(set(keys), reverse=True)
+        key_ints = [int.from_bytes(key, 'big') for key in keys]
+        results = {}
+
+        # Index of the next key to be checked. Pre-order, left first, visits
+        # the terminal nodes in tree order, so each one covers the keys from
+        # here that share its prefix.
+        next_key = 0
+
+        buf = memoryview(proof).cast('B')
+        if max_bytes is not None and len(buf) > max_bytes:
+            raise VerificationError('proof is %d bytes; limit is %d' % (len(buf), max_bytes))
+        if not len(buf) or buf[0] != SERIALIZATION_VERSION:
+            raise VerificationError('unknown serialization version')
+        pos = 1
+
+        # Inner nodes whose children are still being verified, as
+        # [prefix, left_hash, left_tag] lists; left_hash is None until the
+        # left child is done.
+        stack = []
+        prefix = 0
+        try:
+            while True:
+                depth = len(stack)
+                tag = buf[pos]
+                pos += 1
+
+                n_nodes += 1
+                if max_nodes is not None and n_nodes > max_nodes:
+                    raise VerificationError('more than %d nodes' % max_nodes)
+
+                if tag == TAG_INNER:
+                    if depth >= max_depth:
+                        raise VerificationError('proof deeper than %d levels' % max_depth)
+                    stack.append([prefix, None, None])
+                    prefix = prefix << 1 | 1
+                    continue
+
+                # Keys covered by this node.
+                shift = keybits - depth
+                first_key = next_key
+                while next_key < len(key_ints) and key_ints[next_key] >> shift == prefix:
+                    next_key += 1
+
+                if tag == TAG_EMPTY:
+                    node_hash = empty_hash
+                    for i in range(first_key, next_key):
+                        results[keys[i]] = None
+
+                elif tag == TAG_PRUNED_INNER:
+                    if first_key != next_key:
+                        raise VerificationError('key %r is in a pruned part of the proof' % keys[first_key])
+                    node_hash = buf[pos:pos+hashsize]
+                    if len(node_hash) != hashsize:
+                        raise IndexError
+                    pos += hashsize
+
+                elif tag == TAG_FULL_LEAF or tag == TAG_PRUNED_LEAF:
+                    leaf_key = buf[pos:pos+keysize]
+                    if len(leaf_key) != keysize:
+                        raise IndexError
+                    pos += keysize
+                    leaf_key_int = int.from_bytes(leaf_key, 'big')
+                    if depth and leaf_key_int >> shift != prefix:
+                        raise VerificationError('leaf key %r in the wrong place' % leaf_key.tobytes())
+
+                    if tag == TAG_FULL_LEAF:
+                        value_len, pos = _varint_decode(buf, pos)
+                        if pos + value_len > len(buf):
+                            raise IndexError
+                        value_hash = treecls.calc_serialized_value_hash(buf[pos:pos+value_len])
+                        pos += value_len
+                    else:
+                        value_hash = buf[pos:pos+hashsize].tobytes()
+                        if len(value_hash) != hashsize:
+                            raise IndexError
+                        pos += hashsize
+
+                    node_hash = hash_func(b''.join((value_hash, leaf_key, b'\x02')))
+                    for i in range(first_key, next_key):
+                        results[keys[i]] = value_hash if key_ints[i] == leaf_key_int else None
+
+                else:
+                    raise VerificationError('unknown node tag %r' % tag)
+
+                # Hash the finished node into its parent, finishing the parent
+                # too if this was its right child, and so on.
+                while stack:
+                    frame = stack[-1]
+                    if frame[1] is None:
+                        frame[1] = node_hash
+                        frame[2] = tag
+                        prefix = frame[0] << 1
+                        break
+
+                    stack.pop()
+                    left_tag = frame[2]
+                    if ((left_tag == TAG_EMPTY and tag in (TAG_EMPTY, TAG_FULL_LEAF, TAG_PRUNED_LEAF))
+                            or (tag == TAG_EMPTY and left_tag in (TAG_FULL_LEAF, TAG_PRUNED_LEAF))):
+                        raise VerificationError('inner node that should have been collapsed')
+                    node_hash = hash_func(b''.join((frame[1], node_hash, b'\x01')))
+                    tag = TAG_INNER
+
+                else:
+                    break
+
+        except IndexError:
+            raise VerificationError('proof truncated')
+        except ValueError as err:
+            if isinstance(err, VerificationError):
+                raise
+            raise VerificationError(str(err))
+
+        if pos != len(buf):
+            raise VerificationError('%d extra bytes after proof' % (len(buf) - pos))
+        if node_hash != root_hash:
+            raise VerificationError('proof does not match root hash')
+
+        assert next_key == len(keys)
+        return results
+
+_verifiers = {}
+
+def _get_verifier(treecls):
+    try:
+        return _verifiers[treecls]
+    except KeyError:
+        verifier = _verifiers[treecls] = _Verifier(treecls)
+        return verifier
+
+def verify_proof(treecls, proof, root_hash, keys, max_depth=None, max_nodes=None, max_bytes=None):
+    """Verify a serialized proof about keys against a trusted root hash
+
+    Returns a dict mapping every key in keys to the hash of its value,
+    calc_value_hash(value), if the proof shows the key is in the tree, or to
+    None if the proof shows it isn't.
+
+    max_depth, max_nodes and max_bytes limit the proof as they do for
+    deserialize(); proofs over a limit are rejected as soon as that's found.
+
+    Raises VerificationError if the proof is malformed, over a limit, doesn't
+    match root_hash, or has any of the keys in a pruned part of the tree.
+    """
+    return _get_verifier(treecls).verify(proof, root_hash, keys, max_depth, max_nodes, max_bytes)
+
+def verify_proofs(treecls, proofs, max_depth=None, max_nodes=None, max_bytes=None):
+    """Verify a batch of proofs
+
+    proofs is an iterable of (proof, root_hash, keys) tuples; returns a list
+    with the verify_proof() result for each, with the limits applying to each
+    proof separately. The first proof that fails to verify raises
+    VerificationError, with the proof's index in the batch prepended to its
+    arguments.
+    """
+    verify = _get_verifier(treecls).verify
+    results = []
+    for i, (proof, root_hash, keys) in enumerate(proofs):
+        try:
+            results.append(verify(proof, root_hash, keys, max_depth, max_nodes, max_bytes))
+        except VerificationError as err:
+            err.args = (i,) + err.args
+            raise
+    return results